@@ -1,7 +1,7 @@
 // ==UserScript==
 // @name         LMArena API Bridge (No-404 Solid)
 // @namespace    http://tampermonkey.net/
-// @version      2.7.0
+// @version      2.13.0
 // @description  使用本地WS桥接LMArena；自动记住真实接口的域名/前缀/方法，避免404；无需控制台与额外操作。
 // @match        https://lmarena.ai/*
 // @match        https://*.lmarena.ai/*
@@ -18,17 +18,73 @@
   const API_HOST_5102 = "http://127.0.0.1:5102";
   const ID_SERVER_5103 = "http://127.0.0.1:5103/update";
 
+  // 多标签页：每次页面加载生成一个标签页ID，后端据此分发请求并在断开时只清理本标签页的请求
+  const TAB_ID = "tab-" + ((crypto && crypto.randomUUID) ? crypto.randomUUID().slice(0, 8) : Math.random().toString(16).slice(2, 10));
+  const MAX_CONCURRENCY = 3; // 本标签页可同时处理的请求数
+
   // 如确定环境可手动指定（否则留空，自动识别）
   const FORCE_ORIGIN = ""; // 例如 "https://lmarena.ai"
   const FORCE_PREFIX = ""; // 例如 "/zh-CN" 或 "/en"
   const FORCE_METHOD = ""; // "PUT" 或 "POST"
 
-  let socket;
+  // 当前连接。后端计划内重启时发送 reconnect：立即连上新进程，旧连接只用于完成已经收到的请求（不刷新页面）。
+  let conn = null;
+  const requestConns = new Map(); // request_id -> 收到该请求的连接，响应始终从同一连接回传
   let isCaptureModeActive = false;   // ID捕获开关（由后端指令触发）
   let apiOrigin = "";                // 真实接口域名（从“重试”请求中学习）
   let apiPathPrefix = "";            // 语言/区域前缀（从“重试”请求中学习）
   let apiMethod = "PUT";             // 真实方法（PUT/POST，从“重试”请求中学习）
 
+  // 协议 v2（后端确认后启用）：请求以二进制 OPEN 帧到达，每个请求对应一个整数流ID；
+  // 响应以原始字节回传，同一轮事件循环中多个请求的数据块合并到一个 DATA 帧。帧格式见后端 modules/ws_protocol.py。
+  const SUPPORTS_DEFLATE = typeof DecompressionStream !== 'undefined';
+  const textEncoder = new TextEncoder();
+
+  // 附件引用：后端只在载荷中放入附件的内容哈希 (ref)，本标签页首次用到时取回 data URL 并缓存，
+  // 多轮对话中重复发送的图片之后不再经过 WebSocket。
+  const ATTACHMENT_CACHE_MAX_CHARS = 64 * 1024 * 1024;
+  const attachmentCache = new Map(); // ref -> data URL（Map 的插入顺序即 LRU 顺序）
+  let attachmentCacheChars = 0;
+
+  // 流控：后端某个请求的响应积压过多时发送 pause，消费跟上后发送 resume。
+  // 暂停期间不再读取 LMArena 的响应体，由浏览器的 TCP 背压让上游放慢。
+  const pausedRequests = new Map(); // request_id -> 等待 resume 的回调列表
+
+  function waitIfPaused(requestId) {
+    const waiters = pausedRequests.get(requestId);
+    return waiters ? new Promise((resolve) => waiters.push(resolve)) : null;
+  }
+
+  function resumeRequest(requestId) {
+    const waiters = pausedRequests.get(requestId);
+    pausedRequests.delete(requestId);
+    if (waiters) waiters.forEach((resolve) => resolve());
+  }
+
+  // 取消：客户端断开或后端超时后，后端发送 cancel，本标签页中止对应的 fetch（释放 LMArena 与本标签页的并发），
+  // 并回复 { cancelled: request_id }，后端据此统计取消延迟。
+  const abortControllers = new Map(); // request_id -> AbortController
+  // 本脚本自己发出的 fetch 的 init 对象：拦截器据此区分页面请求与桥接请求（多个请求并发时不能用全局开关）
+  const bridgeFetchInits = new WeakSet();
+  const cancelledEarly = new Set();   // 开始请求 LMArena 之前就收到 cancel 的 request_id
+
+  function cancelRequest(requestId) {
+    const controller = abortControllers.get(requestId);
+    if (controller) {
+      controller.abort();
+      resumeRequest(requestId); // 暂停中的请求也要唤醒，读取时随即抛出 AbortError
+      return;
+    }
+    if (cancelledEarly.size > 1000) cancelledEarly.clear();
+    cancelledEarly.add(requestId);
+  }
+
+  function sendCancelled(requestId) {
+    const c = requestConns.get(requestId);
+    if (c && c.ws.readyState === WebSocket.OPEN) c.ws.send(JSON.stringify({ cancelled: requestId }));
+    sendToServer(requestId, "[DONE]"); // 协议 v2 需要结束记录来释放流ID
+  }
+
   // 工具：URL拼接（避免双斜杠）
   function joinUrl(origin, path) {
     const o = (origin || "").replace(/\/+$/, "");
@@ -38,26 +94,58 @@
 
   // 建立与本地后端的WS连接
   function connect() {
-    const ws = new WebSocket(SERVER_WS);
-    socket = ws;
+    const ws = new WebSocket(`${SERVER_WS}?tab_id=${encodeURIComponent(TAB_ID)}&max_concurrency=${MAX_CONCURRENCY}&protocol=2&attachments=ref&reconnect=drain&heartbeat=1${SUPPORTS_DEFLATE ? '&compress=deflate-raw' : ''}`);
+    ws.binaryType = 'arraybuffer';
+    // 每个连接各自的 v2 流ID（request_id -> 流ID）与待发送的 DATA 记录
+    const c = { ws, streamIds: new Map(), outbox: [], outboxBytes: 0, flushScheduled: false, draining: false };
+    conn = c;
 
     ws.onopen = () => {
       if (!document.title.startsWith("✅ ")) document.title = "✅ " + document.title;
     };
 
     ws.onmessage = async (event) => {
+      // 协议 v2 的请求帧
+      if (event.data instanceof ArrayBuffer) {
+        let opened;
+        try { opened = await decodeOpenFrame(event.data); } catch (e) {
+          const view = new DataView(event.data);
+          if (view.byteLength >= 6) failStream(c, view.getUint32(2), `无法解析请求帧: ${e.message || e}`);
+          return;
+        }
+        c.streamIds.set(opened.request_id, opened.streamId);
+        requestConns.set(opened.request_id, c);
+        await executeFetchAndStreamBack(opened.request_id, opened.payload);
+        return;
+      }
+
       let msg;
       try { msg = JSON.parse(event.data); } catch { return; }
 
       // 控制指令
       if (msg && msg.command) {
-        if (msg.command === 'refresh' || msg.command === 'reconnect') {
+        if (msg.command === 'ping') {
+          // 应用层心跳：立即应答，后端据此测量往返时间；页面被冻结时不会应答，后端会移除本标签页
+          if (ws.readyState === WebSocket.OPEN) ws.send(JSON.stringify({ pong: msg.seq }));
+        } else if (msg.command === 'protocol') {
+          // 后端确认协议 v2：之后的请求以二进制帧到达（旧版后端不会发送此指令，继续使用 v1）
+        } else if (msg.command === 'reconnect') {
+          // 计划内重启：旧进程已停止接收请求，连接新进程；本连接上的请求继续回传，完成后由后端关闭
+          c.draining = true;
+          connect();
+        } else if (msg.command === 'refresh') {
           location.reload();
         } else if (msg.command === 'activate_id_capture') {
           isCaptureModeActive = true;
           if (!document.title.startsWith("🎯 ")) document.title = "🎯 " + document.title;
         } else if (msg.command === 'send_page_source') {
           sendPageSource();
+        } else if (msg.command === 'pause' && msg.request_id) {
+          if (!pausedRequests.has(msg.request_id)) pausedRequests.set(msg.request_id, []);
+        } else if (msg.command === 'resume' && msg.request_id) {
+          resumeRequest(msg.request_id);
+        } else if (msg.command === 'cancel' && msg.request_id) {
+          cancelRequest(msg.request_id);
         }
         return;
       }
@@ -65,10 +153,17 @@
       // 正常请求
       const { request_id, payload } = msg || {};
       if (!request_id || !payload) return;
+      requestConns.set(request_id, c);
       await executeFetchAndStreamBack(request_id, payload);
     };
 
     ws.onclose = () => {
+      // 连接断开后后端已放弃这些请求，不再等待 resume
+      for (const [requestId, owner] of requestConns) {
+        if (owner === c) { requestConns.delete(requestId); resumeRequest(requestId); }
+      }
+      c.streamIds.clear(); c.outbox = []; c.outboxBytes = 0;
+      if (c.draining) return; // 已经连上新进程
       if (document.title.startsWith("✅ ")) document.title = document.title.substring(2);
       setTimeout(connect, 1500);
     };
@@ -78,80 +173,207 @@
     };
   }
 
-  // 发送数据到本地后端
+  // 发送数据到本地后端：v2 的请求写入待发送的 DATA 记录，v1 为 JSON 文本帧。
+  // data 为字符串、Uint8Array（原始响应字节，仅 v2）、"[DONE]" 或 { error }。
   function sendToServer(requestId, data) {
-    if (socket && socket.readyState === WebSocket.OPEN) {
-      socket.send(JSON.stringify({ request_id: requestId, data }));
+    const c = requestConns.get(requestId); // 所属连接已断开时后端已放弃该请求
+    if (!c || c.ws.readyState !== WebSocket.OPEN) return;
+    const streamId = c.streamIds.get(requestId);
+    if (streamId === undefined) {
+      c.ws.send(JSON.stringify({ request_id: requestId, data }));
+      return;
+    }
+    if (data === "[DONE]") {
+      queueRecord(c, 1, streamId, new Uint8Array(0));
+      c.streamIds.delete(requestId);
+    } else if (data && data.error !== undefined) {
+      queueRecord(c, 2, streamId, textEncoder.encode(String(data.error)));
+    } else {
+      queueRecord(c, 0, streamId, data instanceof Uint8Array ? data : textEncoder.encode(String(data)));
     }
   }
 
-  // 执行真正的 LMArena 请求，并把流回传
-  async function executeFetchAndStreamBack(requestId, payload) {
-    const { is_image_request, message_templates, target_model_id, session_id, message_id } = payload || {};
+  function isV2Request(requestId) {
+    const c = requestConns.get(requestId);
+    return !!c && c.streamIds.has(requestId);
+  }
 
-    if (!session_id || !message_id) {
-      sendToServer(requestId, { error: "会话ID为空；请在后端UI点“开始捕获”，回聊天页点一次“重试/Retry”" });
-      sendToServer(requestId, "[DONE]");
-      return;
+  function failStream(c, streamId, message) {
+    queueRecord(c, 2, streamId, textEncoder.encode(message));
+    queueRecord(c, 1, streamId, new Uint8Array(0));
+  }
+
+  // DATA 记录: u8 种类(0 数据/1 结束/2 错误) + u32 流ID + u32 长度 + 字节；本轮事件循环结束后统一发送
+  function queueRecord(c, kind, streamId, bytes) {
+    c.outbox.push([kind, streamId, bytes]);
+    c.outboxBytes += 9 + bytes.length;
+    if (c.outboxBytes >= 64 * 1024) { flushOutbox(c); return; }
+    if (!c.flushScheduled) { c.flushScheduled = true; setTimeout(() => flushOutbox(c), 0); }
+  }
+
+  function flushOutbox(c) {
+    c.flushScheduled = false;
+    if (!c.outbox.length) return;
+    const frame = new Uint8Array(2 + c.outboxBytes);
+    const view = new DataView(frame.buffer);
+    frame[0] = 2; frame[1] = 0;
+    let off = 2;
+    for (const [kind, streamId, bytes] of c.outbox) {
+      view.setUint8(off, kind); view.setUint32(off + 1, streamId); view.setUint32(off + 5, bytes.length);
+      frame.set(bytes, off + 9);
+      off += 9 + bytes.length;
     }
-    if (!message_templates || !message_templates.length) {
-      sendToServer(requestId, { error: "message_templates 为空" });
-      sendToServer(requestId, "[DONE]");
-      return;
+    c.outbox = []; c.outboxBytes = 0;
+    if (c.ws.readyState === WebSocket.OPEN) c.ws.send(frame.buffer);
+  }
+
+  // OPEN 帧: u8 类型=1 + u8 标志(0x01 = JSON 经 deflate-raw 压缩) + u32 流ID + u32 JSON长度 + JSON + u16 附件数 + [u32 长度 + 字节]...
+  async function decodeOpenFrame(buffer) {
+    const view = new DataView(buffer);
+    const bytes = new Uint8Array(buffer);
+    if (view.getUint8(0) !== 1) throw new Error("不是 OPEN 帧");
+    const flags = view.getUint8(1);
+    const streamId = view.getUint32(2);
+    const jsonLen = view.getUint32(6);
+    let off = 10;
+    let jsonBytes = bytes.subarray(off, off + jsonLen);
+    off += jsonLen;
+    if (flags & 1) {
+      const stream = new Blob([jsonBytes]).stream().pipeThrough(new DecompressionStream('deflate-raw'));
+      jsonBytes = new Uint8Array(await new Response(stream).arrayBuffer());
+    }
+    const msg = JSON.parse(new TextDecoder().decode(jsonBytes));
+    const blobs = [];
+    const count = view.getUint16(off); off += 2;
+    for (let i = 0; i < count; i++) {
+      const len = view.getUint32(off); off += 4;
+      blobs.push(bytes.subarray(off, off + len));
+      off += len;
     }
+    // 被提取的附件还原为 data URL（浏览器原生编码）
+    for (const t of (msg.payload && msg.payload.message_templates) || []) {
+      for (const a of t.attachments || []) {
+        if (typeof a.blob === 'number') {
+          a.url = await bytesToDataUrl(blobs[a.blob], a.blob_type);
+          delete a.blob; delete a.blob_type;
+        }
+      }
+    }
+    return { streamId, request_id: msg.request_id, payload: msg.payload };
+  }
 
-    // 构造消息链（最后一条 pending，其它 success）
-    const newMessages = [];
-    let lastMsgId = null;
-    for (let i = 0; i < message_templates.length; i++) {
-      const t = message_templates[i];
-      const id = (crypto && crypto.randomUUID) ? crypto.randomUUID() : (Date.now() + '-' + Math.random().toString(16).slice(2));
-      const parents = lastMsgId ? [lastMsgId] : [];
-      const status = is_image_request ? 'success' : ((i === message_templates.length - 1) ? 'pending' : 'success');
-      newMessages.push({
-        role: t.role, content: t.content, id,
-        evaluationId: null, evaluationSessionId: session_id, parentMessageIds: parents,
-        experimental_attachments: t.attachments || [],
-        failureReason: null, metadata: null,
-        participantPosition: t.participantPosition || "a",
-        createdAt: new Date().toISOString(), updatedAt: new Date().toISOString(),
-        status
-      });
-      lastMsgId = id;
+  function bytesToDataUrl(bytes, type) {
+    return new Promise((resolve, reject) => {
+      const reader = new FileReader();
+      reader.onload = () => resolve(reader.result);
+      reader.onerror = () => reject(reader.error);
+      reader.readAsDataURL(new Blob([bytes], { type: type || 'application/octet-stream' }));
+    });
+  }
+
+  async function getAttachment(ref) {
+    let dataUrl = attachmentCache.get(ref);
+    if (dataUrl !== undefined) {
+      attachmentCache.delete(ref); attachmentCache.set(ref, dataUrl);
+      return dataUrl;
     }
-    const body = { messages: newMessages, modelId: target_model_id };
-
-    // 生成候选“域名/前缀/方法”
-    const origins = Array.from(new Set([
-      (FORCE_ORIGIN || "").trim(),
-      (apiOrigin || "").trim(),
-      location.origin
-    ].filter(Boolean)));
-
-    const htmlLang = (document.documentElement.getAttribute('lang') || '').trim(); // zh-CN/en-US
-    const shortLang = htmlLang.split('-')[0] || '';                                 // zh/en
-    const pathFirst = (location.pathname.split('/')[1] || '').trim();               // 可能是 zh-CN/en
-
-    const prefixesUnique = Array.from(new Set([
-      (FORCE_PREFIX || "").trim(),
-      (apiPathPrefix || "").trim(),
-      htmlLang ? '/' + htmlLang : '',
-      shortLang ? '/' + shortLang : '',
-      (/^[a-zA-Z-]+$/.test(pathFirst) ? '/' + pathFirst : ''),
-      ''
-    ]));
-    const prefixes = prefixesUnique.map(p => (p === '/' ? '' : p));
-
-    const methods = Array.from(new Set([
-      (FORCE_METHOD || "").toUpperCase(),
-      (apiMethod || "").toUpperCase(),
-      'PUT', 'POST'
-    ].filter(Boolean)));
-
-    // 逐个组合尝试，直到成功
-    window.isApiBridgeRequest = true;
+    const res = await fetch(joinUrl(API_HOST_5102, `/internal/attachments/${ref}`));
+    if (!res.ok) throw new Error(`取回附件失败 (${res.status})`);
+    dataUrl = await res.text();
+    attachmentCache.set(ref, dataUrl);
+    attachmentCacheChars += dataUrl.length;
+    for (const [oldRef, oldUrl] of attachmentCache) {
+      if (attachmentCacheChars <= ATTACHMENT_CACHE_MAX_CHARS || oldRef === ref) break;
+      attachmentCache.delete(oldRef);
+      attachmentCacheChars -= oldUrl.length;
+    }
+    return dataUrl;
+  }
+
+  // 把附件引用还原为 data URL（不同附件并行取回）
+  async function resolveAttachments(templates) {
+    const pending = [];
+    for (const t of templates) {
+      for (const a of t.attachments || []) {
+        if (a.ref && !a.url) {
+          pending.push(getAttachment(a.ref).then((url) => { a.url = url; delete a.ref; delete a.size; }));
+        }
+      }
+    }
+    await Promise.all(pending);
+  }
+
+  // 执行真正的 LMArena 请求，并把流回传
+  async function executeFetchAndStreamBack(requestId, payload) {
+    const { is_image_request, message_templates, target_model_id, session_id, message_id } = payload || {};
+
+    // 提前返回（参数错误、附件取回失败）也要经过 finally，清理 requestConns 等按请求记录的状态
+    const controller = new AbortController();
+    abortControllers.set(requestId, controller);
+    if (cancelledEarly.delete(requestId)) controller.abort();
     let response = null, used = null, lastErr = '';
     try {
+      if (!session_id || !message_id) {
+        sendToServer(requestId, { error: "会话ID为空；请在后端UI点“开始捕获”，回聊天页点一次“重试/Retry”" });
+        sendToServer(requestId, "[DONE]");
+        return;
+      }
+      if (!message_templates || !message_templates.length) {
+        sendToServer(requestId, { error: "message_templates 为空" });
+        sendToServer(requestId, "[DONE]");
+        return;
+      }
+      await resolveAttachments(message_templates); // 失败时由下方 catch 回传错误
+
+      // 构造消息链（最后一条 pending，其它 success）
+      const newMessages = [];
+      let lastMsgId = null;
+      for (let i = 0; i < message_templates.length; i++) {
+        const t = message_templates[i];
+        const id = (crypto && crypto.randomUUID) ? crypto.randomUUID() : (Date.now() + '-' + Math.random().toString(16).slice(2));
+        const parents = lastMsgId ? [lastMsgId] : [];
+        const status = is_image_request ? 'success' : ((i === message_templates.length - 1) ? 'pending' : 'success');
+        newMessages.push({
+          role: t.role, content: t.content, id,
+          evaluationId: null, evaluationSessionId: session_id, parentMessageIds: parents,
+          experimental_attachments: t.attachments || [],
+          failureReason: null, metadata: null,
+          participantPosition: t.participantPosition || "a",
+          createdAt: new Date().toISOString(), updatedAt: new Date().toISOString(),
+          status
+        });
+        lastMsgId = id;
+      }
+      const body = { messages: newMessages, modelId: target_model_id };
+
+      // 生成候选“域名/前缀/方法”
+      const origins = Array.from(new Set([
+        (FORCE_ORIGIN || "").trim(),
+        (apiOrigin || "").trim(),
+        location.origin
+      ].filter(Boolean)));
+
+      const htmlLang = (document.documentElement.getAttribute('lang') || '').trim(); // zh-CN/en-US
+      const shortLang = htmlLang.split('-')[0] || '';                                 // zh/en
+      const pathFirst = (location.pathname.split('/')[1] || '').trim();               // 可能是 zh-CN/en
+
+      const prefixesUnique = Array.from(new Set([
+        (FORCE_PREFIX || "").trim(),
+        (apiPathPrefix || "").trim(),
+        htmlLang ? '/' + htmlLang : '',
+        shortLang ? '/' + shortLang : '',
+        (/^[a-zA-Z-]+$/.test(pathFirst) ? '/' + pathFirst : ''),
+        ''
+      ]));
+      const prefixes = prefixesUnique.map(p => (p === '/' ? '' : p));
+
+      const methods = Array.from(new Set([
+        (FORCE_METHOD || "").toUpperCase(),
+        (apiMethod || "").toUpperCase(),
+        'PUT', 'POST'
+      ].filter(Boolean)));
+
+      // 逐个组合尝试，直到成功
       outer:
       for (const or of origins) {
         for (const pre of prefixes) {
@@ -159,15 +381,19 @@
           const url = joinUrl(or, path);
           for (const m of methods) {
             try {
-              response = await fetch(url, {
+              const init = {
                 method: m,
                 headers: { 'Content-Type': 'text/plain;charset=UTF-8', 'Accept': '*/*' },
                 body: JSON.stringify(body),
-                credentials: 'include'
-              });
+                credentials: 'include',
+                signal: controller.signal
+              };
+              bridgeFetchInits.add(init);
+              response = await fetch(url, init);
               if (response && response.ok && response.body) { used = { url, m }; break outer; }
               if (response) { try { lastErr = (await response.text() || '').slice(0, 800); } catch {} }
             } catch (e) {
+              if (controller.signal.aborted) throw e;
               lastErr = String(e).slice(0, 300);
               response = null;
             }
@@ -186,16 +412,27 @@
       const reader = response.body.getReader();
       const decoder = new TextDecoder();
       while (true) {
+        const paused = waitIfPaused(requestId);
+        if (paused) await paused;
         const { value, done } = await reader.read();
         if (done) { sendToServer(requestId, "[DONE]"); break; }
-        sendToServer(requestId, decoder.decode(value));
+        // v2 直接回传原始字节，由后端按流增量解码
+        sendToServer(requestId, isV2Request(requestId) ? value : decoder.decode(value, { stream: true }));
       }
 
     } catch (e) {
-      sendToServer(requestId, { error: e.message || String(e) });
-      sendToServer(requestId, "[DONE]");
+      if (controller.signal.aborted) {
+        sendCancelled(requestId);
+      } else {
+        sendToServer(requestId, { error: e.message || String(e) });
+        sendToServer(requestId, "[DONE]");
+      }
     } finally {
-      window.isApiBridgeRequest = false;
+      abortControllers.delete(requestId);
+      pausedRequests.delete(requestId);
+      const c = requestConns.get(requestId);
+      if (c) c.streamIds.delete(requestId);
+      requestConns.delete(requestId);
     }
   }
 
@@ -220,7 +457,7 @@
         const re = /^\/(?:[a-zA-Z-]+\/)?api\/stream\/retry-evaluation-session-message\/([a-f0-9-]+)\/messages\/([a-f0-9-]+)/;
         const m = p.match(re);
 
-        if (m && !window.isApiBridgeRequest) {
+        if (m && !bridgeFetchInits.has(args[1])) {
           // 1) 记住域名/前缀/方法
           apiOrigin = (FORCE_ORIGIN || u.origin || apiOrigin || "");
           const idx = p.indexOf('/api/stream/');
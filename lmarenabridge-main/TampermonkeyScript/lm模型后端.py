@@ -8,7 +8,8 @@
 # - 终极修复版：save_config_ids 函数已完全修复，可安全地更新或追加键值，不会破坏 JSON 格式。
 # - 语法修复版：修正了 internal_generate_models 函数中的字符串引号错误。
 
-import sys, subprocess, os, json, asyncio, re, uuid, time, random, mimetypes, socket
+import sys, subprocess, os, json, asyncio, re, uuid, time, mimetypes, socket
+from collections import deque
 from datetime import datetime
 from typing import Dict, Any, Optional
 
@@ -28,17 +29,57 @@ from aiohttp import web, WSMsgType
 PROJECT_DIR = os.environ.get("LMARENA_PROJECT_DIR", "/storage/emulated/0/Download/lmarenabridge-main")
 SAVE_DIR    = "/storage/emulated/0/LM对话"
 
+# 共享模块（modules/）位于项目目录中
+_BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for _p in (_BASE_DIR, PROJECT_DIR):
+    if os.path.isdir(os.path.join(_p, "modules")) and _p not in sys.path: sys.path.insert(0, _p)
+from modules.worker_pool import WorkerPool, BrowserWorker, DEFAULT_MAX_CONCURRENCY
+from modules.stream_parser import LMArenaStreamParser, classify_browser_error
+from modules.config_store import ConfigStore, ConfigSnapshot, CONFIG_FILE, MODELS_FILE, ENDPOINT_MAP_FILE
+from modules.session_pool import SessionPool
+from modules.response_channel import ResponseChannel, CHANNEL_OVERFLOW_ERROR
+from modules.admission import AdmissionController, AdmissionRejected
+from modules.metrics import BridgeMetrics, metered_send, utf8_len, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from modules.response_cache import ResponseCache, CachedResponse, cache_key, should_bypass, BYPASS_HEADER
+from modules.ws_protocol import StreamCodec, negotiate, hello_message, PROTOCOL_V2, DEFAULT_COMPRESS_MIN_BYTES
+from modules.attachment_store import AttachmentStore, is_valid_ref, REF_URL_PREFIX
+from modules.chat_log import ChatLogWriter
+from modules.model_extractor import extract_models, diff_models, load_models
+from modules.body_ingest import ingest_json, check_content_length, limits_from_config, BodyTooLarge
+from modules.cancellation import CancelTracker, until_disconnected, ack_request_id
+from modules.sse_encoder import ChunkEncoder
+from modules.json_codec import loads as json_loads, dumps as json_dumps
+from modules.coalesce import coalesce_content, settings_from_config as coalesce_settings
+from modules.failover import with_failover, settings_from_config as failover_settings
+from modules.hedging import HedgeTracker, with_hedge, wants_hedge
+from modules.traffic_capture import TrafficCapture
+from modules.context_budget import ContextBudget
+from modules.tracing import Tracer
+from modules.heartbeat import run_heartbeat, settings_from_config as heartbeat_settings, pong_seq
+
 # 全局状态
 CONFIG: Dict[str, Any] = {}
 MODEL_NAME_TO_ID_MAP: Dict[str, Dict[str, Optional[str]]] = {}
 MODEL_ENDPOINT_MAP: Dict[str, Any] = {}
-BROWSER_WS: Optional[web.WebSocketResponse] = None
-RESPONSE_CHANNELS: Dict[str, asyncio.Queue] = {}
+CONFIG_STORE = ConfigStore(PROJECT_DIR)  # 配置快照：文件变化时才重新解析，请求路径上不读磁盘
+WORKER_POOL = WorkerPool()  # 每个浏览器标签页一个 WebSocket 连接，请求按负载分发
+SESSION_POOL = SessionPool()  # 映射会话的健康统计：加权最小负载选择 + 失败冷却
+ADMISSION = AdmissionController(WORKER_POOL)  # 准入控制：全局/标签页/模型并发上限 + 有界等待队列，过载时 429/503 + Retry-After
+BROWSER_DISCONNECTED_ERROR = "Browser disconnected"
+RESPONSE_CHANNELS: Dict[str, ResponseChannel] = {}  # 有界通道：积压过多时通知标签页暂停读取（pause/resume）
+METRICS = BridgeMetrics(); METRICS.register_gauges(WORKER_POOL, ADMISSION, RESPONSE_CHANNELS)  # /metrics（Prometheus 文本格式）
+RESPONSE_CACHE = ResponseCache(PROJECT_DIR); METRICS.register_cache(RESPONSE_CACHE)  # 完全相同请求的响应缓存（response_cache_enabled 开启后生效）
+ATTACHMENT_STORE = AttachmentStore(); METRICS.register_attachments(ATTACHMENT_STORE)  # 按内容哈希保存附件，载荷只携带引用，标签页按需取回
+CANCELS = CancelTracker(); METRICS.register_cancellations(CANCELS)  # 请求在标签页完成前结束（客户端断开、超时）时通知标签页中止 fetch
+HEDGES = HedgeTracker(); METRICS.register_hedging(HEDGES)  # 各模型近期首字延迟（决定对冲延迟）与对冲的发出/胜出次数
+CAPTURE = TrafficCapture(PROJECT_DIR)  # 按 traffic_capture_rate 抽样记录浏览器回传的原始数据块（benchmarks/replay_capture.py 离线重放）
+CONTEXT_BUDGET = ContextBudget()  # 按 context_budget_kb 在发送前裁剪超出模型预算的对话历史
+TRACER = Tracer()  # 按 trace_sample_rate 记录请求各阶段的时间，GET /debug/trace 导出为 Chrome trace
 LAST_ACTIVITY_AT: Optional[float] = None
 
 LAST_DEBUG: Dict[str, Any] = {}
-DEBUG_HISTORY: list = []
 DEBUG_HISTORY_MAX = 30
+DEBUG_HISTORY: deque = deque(maxlen=DEBUG_HISTORY_MAX)  # 环形缓冲区，追加时自动淘汰最旧的记录
 LAST_PAYLOAD: Dict[str, Any] = {}
 LAST_RESPONSE: Dict[str, Any] = {}
 
@@ -98,7 +139,7 @@ async function updateStatusOnly(){
   try{
     const r=await api('/status'); const j=await r.json();
     $('ver').textContent=j.version||'N/A';
-    $('wsState').textContent=j.ws_connected?'✅ 已连接油猴脚本':'❌ 未连接（请打开lmarena.ai页面）';
+    $('wsState').textContent=j.ws_connected?`✅ 已连接油猴脚本（${(j.tabs||[]).length} 个标签页）`:'❌ 未连接（请打开lmarena.ai页面）';
     $('wsState').className=j.ws_connected?'ok':'err';
     $('cfgDir').textContent=j.project_dir; $('saveDir').textContent=j.save_dir;
     $('defaultIds').textContent=(j.config.session_id||'')+' / '+(j.config.message_id||'');
@@ -143,50 +184,29 @@ def ensure_dir(p):
     try: os.makedirs(p, exist_ok=True)
     except Exception as e: print(f"[WARN] 创建目录失败: {p} => {e}")
 
-def jsonc_load(path)->Dict[str,Any]:
-    try:
-        with open(path,"r",encoding="utf-8") as f: c=f.read()
-        c=re.sub(r'//.*','',c); c=re.sub(r'/\*.*?\*/','',c,flags=re.DOTALL)
-        return json.loads(c) if c.strip() else {}
-    except FileNotFoundError:
-        print(f"[ERR] 文件不存在: {path}"); return {}
-    except Exception as e:
-        print(f"[ERR] 读取 {path} 失败: {e}"); return {}
-
-def load_config():
-    global CONFIG
-    cfg=os.path.join(PROJECT_DIR,"config.jsonc")
-    CONFIG=jsonc_load(cfg)
-    print(f"[INFO] 配置已加载({cfg})。酒馆模式={'ON' if CONFIG.get('tavern_mode_enabled') else 'OFF'}，绕过={'ON' if CONFIG.get('bypass_enabled') else 'OFF'}")
-
-def load_model_map():
-    global MODEL_NAME_TO_ID_MAP
-    p=os.path.join(PROJECT_DIR,'models.json')
-    try:
-        raw=json.load(open(p,'r',encoding='utf-8'))
-        out={}
-        for name,val in raw.items():
-            if isinstance(val,str) and ':' in val:
-                mid,typ=val.split(':',1); mid=None if mid and mid.lower()=='null' else mid
-                out[name]={"id":mid,"type":typ}
-            else:
-                out[name]={"id":val,"type":"text"}
-        MODEL_NAME_TO_ID_MAP=out
-        print(f"[INFO] 已加载模型映射 {len(MODEL_NAME_TO_ID_MAP)} 个（{p}）。")
-    except Exception as e:
-        print(f"[ERR] 读取 {p} 失败: {e}"); MODEL_NAME_TO_ID_MAP={}
-
-def load_model_endpoint_map():
-    global MODEL_ENDPOINT_MAP
-    p=os.path.join(PROJECT_DIR,'model_endpoint_map.json')
-    try:
-        s=open(p,'r',encoding='utf-8').read()
-        MODEL_ENDPOINT_MAP=json.loads(s) if s.strip() else {}
-        print(f"[INFO] 已加载模型端点映射 {len(MODEL_ENDPOINT_MAP)} 个（{p}）。")
-    except FileNotFoundError:
-        MODEL_ENDPOINT_MAP={}; print(f"[WARN] {p} 未找到，使用空映射。")
-    except Exception as e:
-        MODEL_ENDPOINT_MAP={}; print(f"[ERR] 读取 {p} 失败: {e}")
+def apply_config_snapshot(snap: ConfigSnapshot):
+    """切换到新的配置快照（config.jsonc / models.json / model_endpoint_map.json 一起替换）。"""
+    global CONFIG, MODEL_NAME_TO_ID_MAP, MODEL_ENDPOINT_MAP
+    CONFIG, MODEL_NAME_TO_ID_MAP, MODEL_ENDPOINT_MAP = snap.config, snap.models, snap.endpoint_map
+    SESSION_POOL.configure(snap.config); SESSION_POOL.prune(snap.endpoint_map); ADMISSION.configure(snap.config); RESPONSE_CACHE.configure(snap.config); ATTACHMENT_STORE.configure(snap.config); CHAT_LOGGER.configure(snap.config); CAPTURE.configure(snap.config); CONTEXT_BUDGET.configure(snap.config); TRACER.configure(snap.config)
+
+def log_config_changes(changes: dict):
+    for name, err in changes.get("errors", {}).items(): print(f"[ERR] 读取 {os.path.join(PROJECT_DIR, name)} 失败: {err}（保留上次成功加载的内容）")
+    for name, d in changes.items():
+        if name == "errors": continue
+        print(f"[INFO] 已加载 {name}: 新增 {len(d['added'])}，移除 {len(d['removed'])}，变更 {len(d['changed'])}" + (f"（{', '.join(d['changed'][:10])}）" if d['changed'] else ""))
+    if CONFIG_FILE in changes: print(f"[INFO] 配置已加载({PROJECT_DIR})。酒馆模式={'ON' if CONFIG.get('tavern_mode_enabled') else 'OFF'}，绕过={'ON' if CONFIG.get('bypass_enabled') else 'OFF'}")
+    if MODELS_FILE in changes: print(f"[INFO] 当前模型映射 {len(MODEL_NAME_TO_ID_MAP)} 个。")
+    if ENDPOINT_MAP_FILE in changes: print(f"[INFO] 当前模型端点映射 {len(MODEL_ENDPOINT_MAP)} 个。")
+
+def reload_configs(force: bool = False) -> dict:
+    """只重新解析发生变化的配置文件，并切换到新快照。返回变化摘要。"""
+    changes = CONFIG_STORE.reload(force=force)
+    apply_config_snapshot(CONFIG_STORE.snapshot); log_config_changes(changes)
+    return changes
+
+def _on_config_files_changed(changes: dict):
+    apply_config_snapshot(CONFIG_STORE.snapshot); log_config_changes(changes)
 
 def save_config_ids(session_id: str, message_id: str):
     """终极修复版：安全更新 config.jsonc 中的 session_id 和 message_id"""
@@ -260,9 +280,8 @@ def save_config_ids(session_id: str, message_id: str):
         with open(path, 'w', encoding='utf-8') as f:
             f.write(content)
 
-        # 5. 更新内存中的配置并打印日志
-        CONFIG["session_id"] = session_id
-        CONFIG["message_id"] = message_id
+        # 5. 重新加载配置快照并打印日志
+        reload_configs()
         print(f"[INFO] ✅ 已更新 config.jsonc:")
         print(f"       session_id: ...{session_id[-8:]}")
         print(f"       message_id: ...{message_id[-8:]}")
@@ -273,65 +292,7 @@ def save_config_ids(session_id: str, message_id: str):
         traceback.print_exc()
 
 # ChatLogger
-class ChatLogger:
-    def __init__(self, base_dir: str): self.dir=base_dir; ensure_dir(self.dir)
-    
-    @staticmethod
-    def _safe(s:str): return re.sub(r'[\\/:*?"<>|]+','_',s)
-    
-    def save(self, model: str, req: Dict[str, Any], reply: str, reason: str):
-        ts = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        
-        # 提取用户提问的摘要作为文件名的一部分
-        prompt_snippet = "无提问"
-        messages = req.get("messages", [])
-        if messages and isinstance(messages, list):
-            # 找到最后一个用户消息
-            for msg in reversed(messages):
-                if msg.get("role") == "user":
-                    content = msg.get("content")
-                    if isinstance(content, str):
-                        prompt_snippet = content.strip()[:20] or "空提问"
-                    elif isinstance(content, list): # 处理 vision model
-                        for part in content:
-                           if part.get("type") == "text":
-                               prompt_snippet = part.get("text", "").strip()[:20] or "图片提问"
-                               break
-                    break
-        
-        safe_snippet = self._safe(prompt_snippet)
-        base = f"{ts}_{self._safe(model or 'unknown')}_{safe_snippet}"
-        
-        jp=os.path.join(self.dir,f"{base}.json")
-        mp=os.path.join(self.dir,f"{base}.md")
-        rec={"timestamp":ts,"model":model,"finish_reason":reason,"request":req,"reply":reply}
-        
-        try:
-            with open(jp,"w",encoding="utf-8") as f:
-                json.dump(rec, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            print(f"[WARN] 保存JSON日志失败: {e}")
-        
-        try:
-            md_content = [
-                f"# 模型: {model or 'unknown'}",
-                f"- 时间: {ts}",
-                f"- 结束原因: {reason}",
-                "",
-                "## 提问",
-                "```json",
-                json.dumps(req.get("messages",[]),ensure_ascii=False,indent=2),
-                "```",
-                "",
-                "## 回复",
-                reply or ""
-            ]
-            with open(mp, "w", encoding="utf-8") as f:
-                f.write("\n".join(md_content))
-        except Exception as e:
-            print(f"[WARN] 保存Markdown日志失败: {e}")
-
-CHAT_LOGGER = ChatLogger(SAVE_DIR)
+CHAT_LOGGER = ChatLogWriter(SAVE_DIR); METRICS.register_chat_log(CHAT_LOGGER)  # 对话记录由后台线程批量写入，请求路径上只入队
 
 # 处理OpenAI消息为 LMArena 模板
 def _process_openai_message(m:dict)->dict:
@@ -342,18 +303,22 @@ def _process_openai_message(m:dict)->dict:
             if part.get("type")=="text": parts.append(part.get("text",""))
             elif part.get("type")=="image_url":
                 d=part.get("image_url",{}); url=d.get("url"); orig=d.get("detail")
-                if url and isinstance(url,str) and url.startswith("data:"):
+                if url and isinstance(url,str) and (url.startswith("data:") or url.startswith(REF_URL_PREFIX)):
                     try:
-                        ctype=url.split(';')[0].split(':')[1]
+                        if url.startswith(REF_URL_PREFIX):
+                            ref=url[len(REF_URL_PREFIX):]; described=ATTACHMENT_STORE.describe(ref)  # 读取请求体时已存入附件存储（见 body_ingest.py）
+                            if described is None: raise ValueError("附件已被淘汰")
+                            ctype,size=described
+                        else: ctype=url.split(';')[0].split(':')[1]; ref=ATTACHMENT_STORE.put(url); size=len(url)  # data URL 存入附件存储，载荷只带引用
                         if orig and isinstance(orig,str): fname=orig
                         else:
                             if '/' in ctype: main,sub=ctype.split('/')
                             else: main,sub='application','octet-stream'
                             pref="image" if main=="image" else ("audio" if main=="audio" else "file")
                             ext=mimetypes.guess_extension(ctype); ext=(ext.lstrip('.') if ext else (sub if len(sub)<20 else 'bin'))
-                            fname=f"{pref}_{uuid.uuid4()}.{ext}"
-                        atts.append({"name":fname,"contentType":ctype,"url":url})
-                    except Exception: pass
+                            fname=f"{pref}_{ref[:16]}.{ext}"
+                        atts.append({"name":fname,"contentType":ctype,"ref":ref,"size":size})
+                    except (IndexError, ValueError) as e: print(f"[WARN] 无法解析的 base64 data URI: {url[:60]}... 错误: {e}")
         txt="\n\n".join(parts)
     elif isinstance(content,str):
         txt=content
@@ -361,29 +326,35 @@ def _process_openai_message(m:dict)->dict:
         txt=" "
     return {"role":role,"content":txt,"attachments":atts}
 
-def convert_openai_to_lmarena_payload(data:dict,session_id:str,message_id:str,mode_override:Optional[str]=None,battle_target_override:Optional[str]=None)->dict:
+def convert_openai_to_lmarena_payload(data:dict,session_id:str,message_id:str,mode_override:Optional[str]=None,battle_target_override:Optional[str]=None,snap:Optional[ConfigSnapshot]=None)->dict:
+    cfg=snap.config if snap else CONFIG; models=snap.models if snap else MODEL_NAME_TO_ID_MAP
     msgs=data.get("messages",[])
     for msg in msgs:
         if msg.get("role")=="developer": msg["role"]="system"
     processed=[_process_openai_message(x.copy()) for x in msgs]
+    for p,x in zip(processed,msgs):
+        if x.get("pinned"): p["pinned"]=True  # 客户端标记的消息不会被上下文预算裁剪
 
-    if CONFIG.get("tavern_mode_enabled"):
+    if cfg.get("tavern_mode_enabled"):
         sysps=[m['content'] for m in processed if m['role']=='system']; others=[m for m in processed if m['role']!='system']
         merged="\n\n".join(sysps); final=[]
         if merged: final.append({"role":"system","content":merged,"attachments":[]})
         final.extend(others); processed=final
 
     model_name=data.get("model","")
-    info=MODEL_NAME_TO_ID_MAP.get(model_name,{})
+    info=models.get(model_name,{})
     target_id=info.get("id")
 
+    processed,trim=CONTEXT_BUDGET.trim(processed,model_name)  # 按模型的上下文预算裁剪较早的历史
+    if trim: print(f"[INFO] 上下文预算({trim['budget']//1024}KB): 载荷 {trim['before']//1024}KB → {trim['after']//1024}KB，丢弃 {trim['dropped']} 条消息，去掉 {trim['stripped']} 个附件")
+
     templates=[{"role":m["role"],"content":m.get("content",""),"attachments":m.get("attachments",[])} for m in processed]
 
-    if CONFIG.get("bypass_enabled") and info.get("type","text")=="text":
+    if cfg.get("bypass_enabled") and info.get("type","text")=="text":
         templates.append({"role":"user","content":" ","participantPosition":"a","attachments":[]})
 
-    mode=mode_override or CONFIG.get("id_updater_last_mode","direct_chat")
-    target=(battle_target_override or CONFIG.get("id_updater_battle_target","A")).lower()
+    mode=mode_override or cfg.get("id_updater_last_mode","direct_chat")
+    target=(battle_target_override or cfg.get("id_updater_battle_target","A")).lower()
     for t in templates:
         if t['role']=='system':
             t['participantPosition']= (target if mode=='battle' else 'b')
@@ -405,74 +376,69 @@ def format_lmstudio_non_stream_response(content:str,model:str,rid:str,reason:str
             "usage":{"prompt_tokens":0,"completion_tokens":len(content)//4,"total_tokens":len(content)//4}}
 
 # 解析浏览器流（非流式聚合，带统计）
-async def process_lmarena_stream(request_id: str):
-    queue: asyncio.Queue = RESPONSE_CHANNELS.get(request_id)
+def new_response_channel(request_id: str) -> ResponseChannel:
+    async def send_control(cmd: dict):
+        w = WORKER_POOL.owner(request_id)
+        if w: await w.send_json(cmd)
+    return ResponseChannel.from_config(request_id, CONFIG, send_control)
+
+async def process_lmarena_stream(request_id: str, timeout: Optional[float] = None, model: str = "unknown", cache_key: Optional[str] = None, report: Optional[dict] = None):
+    """解析浏览器数据流并产生 ('content'|'finish'|'error', 值) 事件；提供 cache_key 时正常结束的完整响应写入 RESPONSE_CACHE；提供 report 时结束时写入 report['outcome']（对冲落败被关闭时记为 report['closed_as']）。"""
+    queue: ResponseChannel = RESPONSE_CHANNELS.get(request_id)
     if not queue:
         yield ('error','response channel not found'); return
 
-    buffer=""; timeout=CONFIG.get("stream_response_timeout_seconds",360)
-    text_pat=re.compile(r'[ab]0:"((?:\\.|[^"\\])*)"')
-    img_pat =re.compile(r'[ab]2:(\[.*?\])')
-    fin_pat =re.compile(r'[ab]d:(\{.*?"finishReason".*?\})')
-    err_pat =re.compile(r'(\{\s*"error".*?\})', re.DOTALL)
-    cf=[r'<title>Just a moment...</title>', r'Enable JavaScript and cookies to continue']
-
+    parser=LMArenaStreamParser(); timeout=timeout or CONFIG.get("stream_response_timeout_seconds",360)
     t0=time.time(); first_chunk_ts=None; total_chunks=0; total_bytes=0
+    session_ok=None; session_err=None; first_content=True  # 会话结果：True 成功 / False 会话失败 / None 与会话无关
+    outcome='client_disconnect'  # /metrics 中的请求结果；生成器被提前关闭时保持默认值
+    model = model if model in MODEL_NAME_TO_ID_MAP else "other"  # 未知模型名归为 other，避免指标标签无限增长
+    parts = [] if cache_key else None; finish_reason = 'stop'
+    tab_finished = False  # 标签页已发来 [DONE] 或错误；否则结束时通知它取消
 
     try:
         while True:
             try: raw=await asyncio.wait_for(queue.get(),timeout=timeout)
             except asyncio.TimeoutError:
+                session_ok, session_err, outcome = False, f"timeout after {timeout}s", 'timeout'
                 yield ('error', f"Response timed out after {timeout} seconds."); return
 
             if isinstance(raw,dict) and 'error' in raw:
-                err=raw.get('error','Unknown browser error')
-                if isinstance(err,str):
-                    if '413' in err or 'too large' in err.lower(): yield ('error',"上传失败：附件大小超过了服务器限制。"); return
-                    if any(re.search(p,err,re.IGNORECASE) for p in cf): yield ('error',"检测到 Cloudflare 验证，请刷新 LMArena 页面并完成验证后重试。"); return
+                tab_finished = True; err=raw.get('error','Unknown browser error'); kind=classify_browser_error(err)
+                if kind=='attachment_too_large': outcome='attachment_too_large'; yield ('error',"上传失败：附件大小超过了服务器限制。"); return
+                if kind=='cloudflare': outcome='cloudflare'; yield ('error',"检测到 Cloudflare 验证，请刷新 LMArena 页面并完成验证后重试。"); return
+                if err == CHANNEL_OVERFLOW_ERROR: outcome='buffer_overflow'; print(f"[WARN] 请求 {request_id[:8]} 响应缓冲区超过上限，标签页未响应暂停指令，已中止。")
+                elif err == BROWSER_DISCONNECTED_ERROR: outcome='browser_disconnect'
+                elif kind=='rate_limited': session_ok, session_err, outcome = False, str(err), 'rate_limited'
+                else: session_ok, session_err, outcome = False, str(err), 'browser_error'
                 yield ('error', str(err)); return
 
-            if raw=="[DONE]": break
-
-            s = "".join(str(x) for x in raw) if isinstance(raw,list) else str(raw)
-            buffer += s
-            if first_chunk_ts is None and s: first_chunk_ts = time.time()
-            total_chunks += 1
-            total_bytes  += len(s.encode('utf-8','ignore'))
-
-            if any(re.search(p,buffer,re.IGNORECASE) for p in cf):
-                yield ('error',"检测到 Cloudflare 验证，请刷新 LMArena 页面并完成验证后重试。"); return
-
-            m=err_pat.search(buffer)
-            if m:
-                try: ej=json.loads(m.group(1)); yield ('error', ej.get("error","LMArena 未知错误")); return
-                except: pass
-
-            while True:
-                mt=text_pat.search(buffer)
-                if not mt: break
-                try:
-                    txt=json.loads(f'"{mt.group(1)}"')
-                    if txt: yield ('content', txt)
-                except: pass
-                buffer=buffer[mt.end():]
-
-            while True:
-                mi=img_pat.search(buffer)
-                if not mi: break
-                try:
-                    lst=json.loads(mi.group(1))
-                    if isinstance(lst,list) and lst:
-                        info=lst[0]
-                        if info.get("type")=="image" and "image" in info: yield ('content', f"![Image]({info['image']})")
-                except: pass
-                buffer=buffer[mi.end():]
-
-            mf=fin_pat.search(buffer)
-            if mf:
-                try: fd=json.loads(mf.group(1)); yield ('finish', fd.get("finishReason","stop"))
-                except: pass
-                buffer=buffer[mf.end():]
+            done = raw=="[DONE]"
+            if done: tab_finished = True; events=parser.close()
+            else:
+                s = "".join(str(x) for x in raw) if isinstance(raw,list) else str(raw)
+                if first_chunk_ts is None and s: first_chunk_ts = time.time(); TRACER.get(request_id).mark("first_browser_byte", request_id=request_id[:8])
+                total_chunks += 1
+                total_bytes  += len(s.encode('utf-8','ignore'))
+                if queue.last_gap is not None: METRICS.inter_chunk.labels(model).observe(queue.last_gap)
+                events=parser.feed(s)
+
+            for etype,val in events:
+                if etype=='cloudflare': outcome='cloudflare'; yield ('error',"检测到 Cloudflare 验证，请刷新 LMArena 页面并完成验证后重试。"); return
+                if etype=='error': session_ok, session_err, outcome = False, val or "LMArena 未知错误", 'lmarena_error'; yield ('error', val or "LMArena 未知错误"); return
+                if etype=='content':
+                    if first_content: first_content=False; SESSION_POOL.first_token(request_id); ttft=time.monotonic()-queue.created_at; METRICS.ttft.labels(model).observe(ttft); HEDGES.record_ttft(model, ttft)
+                    if parts is not None: parts.append(val)
+                elif etype=='finish':
+                    finish_reason=val
+                    if val=='content-filter': outcome='content_filter'
+                yield (etype, val)
+            if done:
+                session_ok=True
+                if outcome!='content_filter':
+                    outcome='success'
+                    if parts: RESPONSE_CACHE.put(cache_key, parts, finish_reason)
+                break
     finally:
         try:
             if LAST_DEBUG and LAST_DEBUG.get("request_id")==request_id:
@@ -483,8 +449,72 @@ async def process_lmarena_stream(request_id: str):
                     "duration_ms": int((time.time()-t0)*1000)
                 }
         except: pass
+        if outcome == 'client_disconnect' and report and report.get('closed_as'): outcome = report['closed_as']
+        owner = None if tab_finished else WORKER_POOL.owner(request_id)
+        if owner is not None: CANCELS.cancel(owner, request_id, outcome); print(f"[INFO] 请求 {request_id[:8]} 已结束（{outcome}），通知标签页 {owner.worker_id} 取消。")
+        WORKER_POOL.release(request_id); ADMISSION.release(request_id)
+        SESSION_POOL.end(request_id, session_ok, session_err)
+        METRICS.requests.labels(model, outcome).inc(); METRICS.duration.labels(model).observe(time.monotonic()-queue.created_at)
+        CAPTURE.end(request_id, outcome); TRACER.get(request_id).mark("stream_end", request_id=request_id[:8], outcome=outcome)
+        if report is not None: report['outcome'] = outcome
         RESPONSE_CHANNELS.pop(request_id, None)
 
+async def send_to_tab(request_id: str, worker: BrowserWorker, payload: dict, model_name: str, mapping: Optional[dict]):
+    """为已准入的请求创建响应通道并发送载荷；发送失败时清理后重新抛出异常。"""
+    RESPONSE_CHANNELS[request_id] = new_response_channel(request_id)
+    if mapping: SESSION_POOL.begin(request_id, model_name, mapping)
+    CAPTURE.begin(request_id, model_name, payload, worker.worker_id, worker.protocol)
+    try: started = time.perf_counter(); await worker.send_request(request_id, payload); TRACER.get(request_id).span("ws_send", started, request_id=request_id[:8], tab=worker.worker_id, protocol=worker.protocol)
+    except Exception:
+        CAPTURE.discard(request_id); WORKER_POOL.release(request_id); ADMISSION.release(request_id); SESSION_POOL.end(request_id, None); RESPONSE_CHANNELS.pop(request_id, None)
+        raise
+
+async def dispatch_again(fo: dict, reason: str, remaining: Optional[float] = None):
+    """把同一个请求再发一次：首个内容块之前失败后的重试（modules/failover.py），或对冲（modules/hedging.py，reason='hedge'、remaining=None，只用空闲容量）。
+    尽量换一个标签页，映射中有未用过的会话时也换会话；无法准入或发送失败时返回 None。"""
+    model_name, ch, payload = fo["model"], fo["mapping"], fo["payload"]
+    if ch and fo["entries"]:
+        cand = SESSION_POOL.choose(model_name, fo["entries"], avoid=fo["sessions"])
+        if cand and cand.get("session_id") not in fo["sessions"] and cand.get("session_id") and cand.get("message_id"):
+            ch = cand; payload = convert_openai_to_lmarena_payload(fo["openai_req"], ch["session_id"], ch["message_id"], ch.get("mode"), ch.get("battle_target"), fo["snap"])
+    request_id = str(uuid.uuid4())
+    if remaining is None:
+        worker = ADMISSION.try_acquire(request_id, model_name or "unknown", avoid=fo["tabs"])
+        if worker is None: print("[INFO] 没有空闲容量，跳过对冲。"); return None
+    else:
+        try: worker = await asyncio.wait_for(ADMISSION.acquire(request_id, model_name or "unknown", avoid=fo["tabs"]), timeout=remaining)
+        except (AdmissionRejected, asyncio.TimeoutError) as e: print(f"[WARN] 请求 {request_id[:8]} 预算内无法重新分发（{reason}）: {str(e) or '等待超时'}"); return None
+    TRACER.bind(fo["trace"], request_id); fo["trace"].mark("hedge" if reason == 'hedge' else "failover", request_id=request_id[:8], reason=reason, tab=worker.worker_id)
+    try: await send_to_tab(request_id, worker, payload, model_name, ch)
+    except Exception as e: print(f"[WARN] 请求 {request_id[:8]} 重新分发失败: {e}"); return None
+    if reason == 'hedge': print(f"[INFO] {fo['hedge_delay']:.1f} 秒内没有收到内容，已向标签页 {worker.worker_id} 发出对冲请求 {request_id[:8]}。")
+    else: METRICS.failovers.labels(reason).inc(); print(f"[INFO] 上一次尝试在首个内容块之前失败（{reason}），已重新分发为请求 {request_id[:8]}（标签页 {worker.worker_id}）。")
+    fo["tabs"].add(worker.worker_id); fo["mapping"], fo["payload"] = ch, payload
+    if ch: fo["sessions"].add(ch.get("session_id"))
+    report = {}
+    return process_lmarena_stream(request_id, model=model_name or "unknown", cache_key=fo["cache_key"], report=report), report
+
+async def replay_cached_response(cached: CachedResponse):
+    """把缓存的响应重放为与 process_lmarena_stream 相同的事件流。"""
+    for p in cached.parts: yield ('content', p)
+    yield ('finish', cached.finish_reason)
+
+async def probe_session(model_name: str, entry: dict):
+    """会话探测：用空闲标签页向该会话发送一条最短消息，结果记入 SESSION_POOL；没有空闲标签页时跳过。"""
+    worker = WORKER_POOL.pick()
+    if not worker or not worker.has_capacity(): return
+    rid = str(uuid.uuid4()); RESPONSE_CHANNELS[rid] = new_response_channel(rid); WORKER_POOL.assign(rid, worker)
+    SESSION_POOL.begin(rid, model_name, entry, probe=True)
+    try:
+        payload = convert_openai_to_lmarena_payload({"model": model_name, "messages": [{"role": "user", "content": "ping"}]},
+                                                    entry.get("session_id"), entry.get("message_id"), entry.get("mode"), entry.get("battle_target"))
+        await worker.send_request(rid, payload)
+    except Exception as e:
+        WORKER_POOL.release(rid); SESSION_POOL.end(rid, None); RESPONSE_CHANNELS.pop(rid, None)
+        print(f"[WARN] 会话探测发送失败: {e}"); return
+    async for etype, data in process_lmarena_stream(rid, timeout=60, model=model_name):
+        if etype == 'error': print(f"[WARN] 会话探测失败（{model_name} ...{str(entry.get('session_id'))[-6:]}）: {data}")
+
 # CORS
 @web.middleware
 async def cors_middleware(request, handler):
@@ -498,45 +528,109 @@ async def cors_middleware(request, handler):
         resp.headers["Access-Control-Allow-Methods"]="GET,POST,OPTIONS"
     return resp
 
-# WebSocket
+# WebSocket（每个标签页通过 /ws?tab_id=...&max_concurrency=... 注册）
 async def ws_handler(request: web.Request):
-    global BROWSER_WS
     ws = web.WebSocketResponse(); await ws.prepare(request)
-    if BROWSER_WS is not None:
-        try: await BROWSER_WS.close()
-        except: pass
-    BROWSER_WS = ws
-    print("[INFO] ✅ 油猴脚本已连接 WebSocket。")
-    async for msg in ws:
-        if msg.type == WSMsgType.TEXT:
-            try:
-                m=json.loads(msg.data); rid=m.get("request_id"); data=m.get("data")
-                if not rid or data is None: continue
-                if rid in RESPONSE_CHANNELS: await RESPONSE_CHANNELS[rid].put(data)
-                else: pass
-            except Exception as e: print(f"[ERR] WS消息处理异常: {e}")
-        elif msg.type == WSMsgType.ERROR:
-            print(f"[ERR] WS异常: {ws.exception()}")
-    if BROWSER_WS is ws: BROWSER_WS = None
-    for q in list(RESPONSE_CHANNELS.values()):
-        try: await q.put({"error": "Browser disconnected"})
-        except: pass
-    print("[INFO] ❌ 油猴脚本已断开。")
+    try: max_cc=int(request.query.get("max_concurrency") or CONFIG.get("tab_max_concurrency", DEFAULT_MAX_CONCURRENCY))
+    except ValueError: max_cc=CONFIG.get("tab_max_concurrency", DEFAULT_MAX_CONCURRENCY)
+    # 脚本带 protocol=2 时使用二进制帧协议（见 modules/ws_protocol.py），否则为 v1 的 JSON 文本帧
+    protocol, compress = negotiate(request.query, CONFIG.get("ws_protocol_v2_enabled", True)); codec = None
+    if protocol == PROTOCOL_V2:
+        codec = StreamCodec(compress, int(CONFIG.get("ws_compress_min_kb", DEFAULT_COMPRESS_MIN_BYTES // 1024)) * 1024); await ws.send_str(json.dumps(hello_message()))
+    ws_bytes_out, ws_bytes_in = METRICS.ws_bytes.labels("out"), METRICS.ws_bytes.labels("in")
+    worker = BrowserWorker(request.query.get("tab_id") or WorkerPool.new_worker_id(), metered_send(ws.send_str, ws_bytes_out), max_concurrency=max_cc, close=ws.close,
+                           send_bytes=metered_send(ws.send_bytes, ws_bytes_out), codec=codec,
+                           attachment_store=None if request.query.get("attachments") == "ref" else ATTACHMENT_STORE,  # 旧版脚本不会取回附件，发送前还原为 data URL
+                           heartbeat=request.query.get("heartbeat") == "1")  # 应答应用层心跳的脚本，连续无应答时判定失效
+    old = WORKER_POOL.register(worker)
+    if old is not None: await old.close()
+    ADMISSION.dispatch()  # 新的容量：放行排队中的请求
+    print(f"[INFO] ✅ 油猴脚本已连接 WebSocket（标签页 {worker.worker_id}，协议 v{worker.protocol}，并发上限 {worker.max_concurrency}，共 {len(WORKER_POOL)} 个）。")
+    hb_task = asyncio.create_task(run_heartbeat(worker, lambda: heartbeat_settings(CONFIG), evict_unresponsive_tab)) if worker.heartbeat else None
+    try:
+        async for msg in ws:
+            worker.touch()
+            if msg.type == WSMsgType.TEXT:
+                try:
+                    ws_bytes_in.inc(utf8_len(msg.data)); m=json_loads(msg.data)
+                    seq = pong_seq(m)
+                    if seq is not None:
+                        recovered = worker.missed_heartbeats > 0; worker.record_pong(seq)
+                        if recovered and not worker.missed_heartbeats: print(f"[INFO] 标签页 {worker.worker_id} 恢复响应。"); ADMISSION.dispatch()
+                        continue
+                    cancelled_id = ack_request_id(m)
+                    if cancelled_id is not None:
+                        latency = CANCELS.ack(cancelled_id)
+                        if latency is not None: METRICS.cancel_latency.observe(latency); print(f"[INFO] 标签页 {worker.worker_id} 已取消请求 {cancelled_id[:8]}（延迟 {latency * 1000:.0f}ms）。")
+                        continue
+                    rid=m.get("request_id"); data=m.get("data")
+                    if not rid or data is None: continue
+                    if rid in RESPONSE_CHANNELS: CAPTURE.chunk(rid, data); await RESPONSE_CHANNELS[rid].put(data)
+                    elif CANCELS.is_cancelled(rid): CANCELS.late_chunk()  # 取消指令到达标签页之前已发出的数据
+                except Exception as e: print(f"[ERR] WS消息处理异常: {e}")
+            elif msg.type == WSMsgType.BINARY:
+                ws_bytes_in.inc(len(msg.data))
+                if codec is None: continue
+                try: items = codec.decode(msg.data)  # 一个帧可能携带多个请求的数据块
+                except ValueError as e: print(f"[WARN] 标签页 {worker.worker_id} 发来无法解析的二进制帧: {e}"); continue
+                for rid, data in items:
+                    if rid in RESPONSE_CHANNELS: CAPTURE.chunk(rid, data); await RESPONSE_CHANNELS[rid].put(data)
+                    elif CANCELS.is_cancelled(rid): CANCELS.late_chunk()
+            elif msg.type == WSMsgType.ERROR:
+                print(f"[ERR] WS异常: {ws.exception()}")
+    except Exception as e: print(f"[ERR] WS处理异常（标签页 {worker.worker_id}）: {e}")
+    finally:
+        # 正常断开、异常或处理协程被取消（例如关闭服务器）时都要停止心跳并注销标签页
+        if hb_task: hb_task.cancel()
+        # 只让该标签页负责的请求失败
+        orphaned = WORKER_POOL.unregister(worker)
+        for rid in orphaned:
+            q = RESPONSE_CHANNELS.get(rid)
+            if q is None: continue
+            CAPTURE.chunk(rid, {"error": BROWSER_DISCONNECTED_ERROR})
+            try: await q.put({"error": BROWSER_DISCONNECTED_ERROR})
+            except: pass
+        print(f"[INFO] ❌ 油猴脚本已断开（标签页 {worker.worker_id}，受影响请求 {len(orphaned)} 个）。")
     return ws
 
+async def evict_unresponsive_tab(worker: BrowserWorker):
+    """连续心跳无应答：立即注销该标签页、让它负责的请求失败（不必等到超时），然后关闭连接。"""
+    METRICS.tab_evictions.inc(); orphaned = WORKER_POOL.unregister(worker)
+    print(f"[WARN] 💤 标签页 {worker.worker_id} 连续 {worker.missed_heartbeats} 次心跳无应答（最后活动于 {time.time() - worker.last_seen:.0f} 秒前），判定为失效，受影响请求 {len(orphaned)} 个。")
+    for rid in orphaned:
+        q = RESPONSE_CHANNELS.get(rid)
+        if q is not None: CAPTURE.chunk(rid, {"error": BROWSER_DISCONNECTED_ERROR}); await q.put({"error": BROWSER_DISCONNECTED_ERROR})
+    await worker.close()
+
 # 调试工具
 def _record_debug(dbg: Dict[str,Any]):
-    global LAST_DEBUG, DEBUG_HISTORY
-    LAST_DEBUG = dbg
-    DEBUG_HISTORY.append(dbg.copy())
-    if len(DEBUG_HISTORY) > DEBUG_HISTORY_MAX:
-        DEBUG_HISTORY = DEBUG_HISTORY[-DEBUG_HISTORY_MAX:]
+    global LAST_DEBUG
+    LAST_DEBUG = dbg; DEBUG_HISTORY.append(dbg)
 
 async def status_page(request: web.Request): return web.Response(text=UI_HTML, content_type="text/html")
+async def status_admission(request: web.Request): return web.json_response(ADMISSION.status())
+async def status_cache(request: web.Request): return web.json_response(RESPONSE_CACHE.status())
+async def status_chat_log(request: web.Request): return web.json_response(CHAT_LOGGER.status())
+async def status_cancellations(request: web.Request): return web.json_response(CANCELS.status())
+async def status_hedging(request: web.Request): return web.json_response(HEDGES.status(CONFIG))
+async def status_capture(request: web.Request): return web.json_response(CAPTURE.status())
+async def status_context(request: web.Request): return web.json_response(CONTEXT_BUDGET.status())
+async def internal_attachment(request: web.Request):
+    ref = request.match_info["ref"]; headers = {"Cache-Control": "private, max-age=86400, immutable", "Content-Type": "text/plain"}
+    path = ATTACHMENT_STORE.path(ref) if is_valid_ref(ref) else None
+    if path is not None: return web.FileResponse(path, headers=headers)  # 转存到临时文件的大附件直接以文件发送
+    data_url = await ATTACHMENT_STORE.get(ref) if is_valid_ref(ref) else None
+    if data_url is None: return web.json_response({"error": "附件不存在或已被淘汰。"}, status=404)
+    return web.Response(text=data_url, content_type="text/plain", headers={"Cache-Control": headers["Cache-Control"]})
+async def metrics_text(request: web.Request): return web.Response(body=METRICS.render().encode("utf-8"), headers={"Content-Type": METRICS_CONTENT_TYPE})
+async def status_sessions(request: web.Request):
+    return web.json_response({"cooldown_seconds": SESSION_POOL.cooldown_seconds, "sessions": SESSION_POOL.status()})
 async def status_json(request: web.Request):
     return web.json_response({
         "version": SERVER_VERSION,
-        "ws_connected": BROWSER_WS is not None and not BROWSER_WS.closed,
+        "ws_connected": len(WORKER_POOL) > 0,
+        "tabs": WORKER_POOL.status(),
+        "admission": ADMISSION.status(),
         "project_dir": PROJECT_DIR, "save_dir": SAVE_DIR,
         "config": {
             "session_id": CONFIG.get("session_id"),
@@ -550,10 +644,14 @@ async def status_json(request: web.Request):
         "last_activity_at": LAST_ACTIVITY_AT
     })
 async def debug_json(request: web.Request): return web.json_response(LAST_DEBUG or {})
-async def debug_history(request: web.Request): return web.json_response(DEBUG_HISTORY)
+async def debug_history(request: web.Request): return web.json_response(list(DEBUG_HISTORY))
+async def debug_trace(request: web.Request):  # Chrome trace 格式（chrome://tracing 或 ui.perfetto.dev 打开），?limit= 限制导出的已结束请求数
+    try: limit = int(request.query.get("limit", 0))
+    except ValueError: limit = 0
+    return web.json_response(TRACER.chrome_trace(limit), dumps=json_dumps)
 async def debug_reset(request: web.Request):
-    global LAST_DEBUG, DEBUG_HISTORY, LAST_PAYLOAD, LAST_RESPONSE
-    LAST_DEBUG = {}; DEBUG_HISTORY = []; LAST_PAYLOAD = {}; LAST_RESPONSE = {}
+    global LAST_DEBUG, LAST_PAYLOAD, LAST_RESPONSE
+    LAST_DEBUG = {}; DEBUG_HISTORY.clear(); LAST_PAYLOAD = {}; LAST_RESPONSE = {}
     return web.json_response({"status":"cleared"})
 async def debug_last_payload(request: web.Request): return web.json_response(LAST_PAYLOAD or {})
 async def debug_last_response(request: web.Request): return web.json_response(LAST_RESPONSE or {})
@@ -565,23 +663,6 @@ async def get_models(request: web.Request):
     data=[{"id": n, "object":"model", "created": int(time.time()), "owned_by":"LMArenaBridge"} for n in MODEL_NAME_TO_ID_MAP.keys()]
     return web.json_response({"object":"list","data":data})
 
-def extract_models_from_html(html:str):
-    models,names=[],set()
-    for m in re.finditer(r'\{\\"id\\":\\"[a-f0-9-]+\\"',html):
-        i=m.start(); ob=0; end=-1
-        for k in range(i,min(len(html),i+10000)):
-            if html[k]=='{': ob+=1
-            elif html[k]=='}':
-                ob-=1
-                if ob==0: end=k+1; break
-        if end!=-1:
-            js=html[i:end].replace('\\"','"').replace('\\\\','\\')
-            try:
-                d=json.loads(js); pn=d.get('publicName') or d.get('name')
-                if pn and pn not in names: names.add(pn); models.append(d)
-            except: pass
-    return models
-
 def save_available_models(lst,filename="available_models.json"):
     p=os.path.join(PROJECT_DIR,filename)
     try:
@@ -589,26 +670,38 @@ def save_available_models(lst,filename="available_models.json"):
         print(f"[INFO] 可用模型已写入 {p} ({len(lst)} 个)")
     except Exception as e: print(f"[ERR] 写入 {p} 失败: {e}")
 
+def update_available_models(html:bytes,filename="available_models.json"):
+    """在工作线程中运行：单次扫描提取模型（modules/model_extractor.py），与现有文件比较后保存。返回 (模型列表, 差异)。"""
+    names=("publicName","name"); models=extract_models(html.decode("utf-8","replace"),names)
+    if not models: return None,None
+    diff=diff_models(load_models(os.path.join(PROJECT_DIR,filename)),models,names); save_available_models(models,filename)
+    return models,diff
+
 async def internal_request_model_update(request: web.Request):
-    if not BROWSER_WS: return web.json_response({"error":"Browser client not connected."},status=503)
-    try: await BROWSER_WS.send_json({"command":"send_page_source"}); return web.json_response({"status":"success"})
+    worker=WORKER_POOL.any()
+    if not worker: return web.json_response({"error":"Browser client not connected."},status=503)
+    try: await worker.send_json({"command":"send_page_source"}); return web.json_response({"status":"success"})
     except Exception as e: return web.json_response({"error": str(e)}, status=500)
 
 async def internal_update_available_models(request: web.Request):
-    try: body=await request.text()
-    except Exception: body=""
+    try: body=await request.content.read()  # 页面通常超过 client_max_size（1MB），不能用 request.text()
+    except Exception: body=b""
     if not body: return web.json_response({"status":"error","message":"No HTML content received."},status=400)
-    models=extract_models_from_html(body)
-    if models: save_available_models(models); return web.json_response({"status":"success"})
+    models,diff=await asyncio.to_thread(update_available_models,body)  # 页面有几 MB，提取与写文件放到工作线程中
+    if models:
+        print(f"[INFO] 模型变化: 新增 {len(diff['added'])} 个，移除 {len(diff['removed'])} 个，内容变化 {len(diff['changed'])} 个。")
+        if diff["added"]: print(f"       新增: {', '.join(diff['added'])}")
+        if diff["removed"]: print(f"       移除: {', '.join(diff['removed'])}")
+        return web.json_response({"status":"success","count":len(models),"diff":diff})
     return web.json_response({"status":"error","message":"Could not extract model data from HTML."},status=400)
 
 async def internal_start_id_capture(request: web.Request):
-    if not BROWSER_WS: return web.json_response({"error":"Browser client not connected."},status=503)
-    try: await BROWSER_WS.send_json({"command":"activate_id_capture"}); return web.json_response({"status":"success"})
+    if not len(WORKER_POOL): return web.json_response({"error":"Browser client not connected."},status=503)
+    try: await WORKER_POOL.broadcast({"command":"activate_id_capture"}); return web.json_response({"status":"success"})
     except Exception as e: return web.json_response({"error": str(e)}, status=500)
 
 async def internal_reload(request: web.Request):
-    try: load_config(); load_model_map(); load_model_endpoint_map(); return web.json_response({"status":"reloaded"})
+    try: changes=await asyncio.to_thread(reload_configs, True); return web.json_response({"status":"reloaded","generation":CONFIG_STORE.snapshot.generation,"changes":changes})
     except Exception as e: return web.json_response({"error": str(e)}, status=500)
 
 async def internal_generate_models(request: web.Request):
@@ -636,7 +729,7 @@ async def internal_generate_models(request: web.Request):
     return web.json_response({"status":"ok","count":cnt})
 
 # SSE 工具
-async def _sse_prepare(request: web.Request) -> web.StreamResponse:
+async def _sse_prepare(request: web.Request, extra_headers: Optional[Dict[str, str]] = None) -> web.StreamResponse:
     resp = web.StreamResponse(
         status=200,
         reason='OK',
@@ -648,6 +741,7 @@ async def _sse_prepare(request: web.Request) -> web.StreamResponse:
             "Access-Control-Allow-Origin": "*",
             "Access-Control-Allow-Headers": "Content-Type, Authorization",
             "Access-Control-Allow-Methods": "GET,POST,OPTIONS",
+            **(extra_headers or {}),
         },
     )
     await resp.prepare(request)
@@ -658,6 +752,9 @@ async def _sse_send(resp: web.StreamResponse, obj: Any):
     data += "\n\n"
     await resp.write(data.encode("utf-8"))
 
+async def _sse_write(resp: web.StreamResponse, event):
+    await resp.write(event if isinstance(event, bytes) else event.encode("utf-8"))  # event 为 ChunkEncoder 生成的完整 SSE 事件
+
 async def _sse_done(resp: web.StreamResponse):
     try:
         await _sse_send(resp, "[DONE]")
@@ -669,23 +766,30 @@ async def _sse_done(resp: web.StreamResponse):
 async def chat_completions(request: web.Request):
     global LAST_ACTIVITY_AT, LAST_PAYLOAD, LAST_RESPONSE, LAST_DEBUG
     LAST_ACTIVITY_AT = time.time()
-    load_config()
+    snap = CONFIG_STORE.snapshot  # 整个请求使用同一个配置快照
+    trace = TRACER.begin()  # 未抽中时为 NULL_TRACE，调用不做任何事
 
     path = request.rel_url.path or ""
     if path.endswith("/v1/chat/completions"): compat_mode = 'openai'
     elif path.endswith("/v1/completions") or path.endswith("/completions"): compat_mode = 'lmstudio'
     else: compat_mode = 'openai'
 
-    api_key = CONFIG.get("api_key")
+    api_key = snap.config.get("api_key")
     if api_key:
         auth = request.headers.get("Authorization", "")
         if not (auth.startswith("Bearer ") and auth.split(" ", 1)[1] == api_key):
             return web.json_response({"error": {"message": "未提供或提供了错误的 API Key"}}, status=401)
 
-    if not BROWSER_WS: return web.json_response({"error": "油猴脚本未连接，请打开 LMArena 页面。"}, status=503)
-
-    try: openai_req = await request.json()
+    # 流式读取请求体：超过上限立即返回 413，data URL 附件边读边存入附件存储
+    max_body, mem_budget = limits_from_config(snap.config); started = time.perf_counter()
+    try:
+        check_content_length(request.headers.get("Content-Length"), max_body)
+        openai_req, ingest_stats = await ingest_json(request.content.iter_chunked(65536), ATTACHMENT_STORE, max_body, mem_budget)
+    except BodyTooLarge as e: return web.json_response({"error": str(e)}, status=413)
     except Exception: return web.json_response({"error": "无效的 JSON 请求体"}, status=400)
+    if not isinstance(openai_req, dict): return web.json_response({"error": "无效的 JSON 请求体"}, status=400)
+    if ingest_stats["spilled"]: print(f"[INFO] 请求体 {ingest_stats['bytes']/1024/1024:.1f} MB，{ingest_stats['spilled']} 个附件已转存到临时文件。")
+    trace.span("parse", started, bytes=ingest_stats["bytes"], spilled=ingest_stats["spilled"])
 
     stream_param = bool(openai_req.get("stream", False))
 
@@ -694,26 +798,52 @@ async def chat_completions(request: web.Request):
         openai_req["messages"] = [{"role": "user", "content": prompt if isinstance(prompt, str) else " "}]
 
     model_name = openai_req.get("model")
-    info = MODEL_NAME_TO_ID_MAP.get(model_name, {})
+    info = snap.models.get(model_name, {}); trace.set(model=model_name, stream=stream_param)
     
     session_id, message_id, mode_override, battle_target_override, mapping_source = None, None, None, None, "default"
-    if model_name and model_name in MODEL_ENDPOINT_MAP:
-        ent = MODEL_ENDPOINT_MAP[model_name]
-        ch = random.choice(ent) if isinstance(ent, list) and ent else (ent if isinstance(ent, dict) else None)
+    ch = None
+    if model_name and model_name in snap.endpoint_map:
+        ent = snap.endpoint_map[model_name]
+        ch = SESSION_POOL.choose(model_name, ent)  # 按健康度与负载选择，跳过冷却中的会话
         if ch:
             session_id, message_id = ch.get("session_id"), ch.get("message_id")
             mode_override, battle_target_override = ch.get("mode"), ch.get("battle_target")
             mapping_source = "mapping"
     
     if not session_id:
-        if CONFIG.get("use_default_ids_if_mapping_not_found", True):
-            session_id, message_id, mapping_source = CONFIG.get("session_id"), CONFIG.get("message_id"), "default"
+        if snap.config.get("use_default_ids_if_mapping_not_found", True):
+            session_id, message_id, mapping_source, ch = snap.config.get("session_id"), snap.config.get("message_id"), "default", None
         else:
             return web.json_response({"error": f"模型 '{model_name}' 没有配置独立会话ID，且禁用了默认回退。"}, status=400)
     
     if not all([session_id, message_id]) or "YOUR_" in session_id or "YOUR_" in message_id:
         return web.json_response({"error": "最终会话ID或消息ID无效。请在 config.jsonc 或 model_endpoint_map.json 中正确配置，或运行ID捕获。"}, status=400)
 
+    # 先转换载荷（响应缓存以它为键），命中缓存时不占用标签页
+    started = time.perf_counter()
+    try: payload = convert_openai_to_lmarena_payload(openai_req, session_id, message_id, mode_override, battle_target_override, snap)
+    except Exception as e: return web.json_response({"error": f"转换请求失败: {e}"}, status=500)
+    trace.span("convert", started, messages=len(payload["message_templates"]))
+    key, cached, cache_result = None, None, None
+    if RESPONSE_CACHE.enabled:
+        if should_bypass(request.headers): RESPONSE_CACHE.record_bypass(); cache_result = "bypass"
+        else:
+            key = cache_key(payload, mode_override or snap.config.get("id_updater_last_mode", "direct_chat"))
+            cached, cache_result = await RESPONSE_CACHE.lookup(key)
+        METRICS.cache.labels(cache_result).inc()
+
+    request_id = str(uuid.uuid4()); worker = None
+    if not cached:
+        if not len(WORKER_POOL): return web.json_response({"error": "油猴脚本未连接，请打开 LMArena 页面。"}, status=503)
+        # 准入控制：获得已分配的空闲标签页，或排队等待，或快速拒绝
+        started = time.perf_counter()
+        try: worker = await ADMISSION.acquire(request_id, model_name or "unknown")
+        except AdmissionRejected as e:
+            print(f"[WARN] 请求被拒绝（{e.reason}）: {e}"); METRICS.rejections.labels(e.reason).inc()
+            trace.span("admission", started, rejected=e.reason); TRACER.end(trace, ended_with=f"rejected_{e.reason}")
+            return web.json_response({"error": {"message": str(e), "type": "rate_limit_error" if e.status_code == 429 else "overloaded_error"}}, status=e.status_code, headers={"Retry-After": str(e.retry_after)})
+        trace.span("admission", started, tab=worker.worker_id); TRACER.bind(trace, request_id)
+
     dbg = {
         "request_id": None, "ts": datetime.now().isoformat(timespec='seconds'),
         "server_version": SERVER_VERSION, "path": path, "compat_mode": compat_mode,
@@ -721,73 +851,77 @@ async def chat_completions(request: web.Request):
         "openai_req_summary": {"stream_param": stream_param, "message_count": len(openai_req.get("messages",[]))},
         "model": {"name": model_name, "type": info.get("type","text"), "target_model_id": info.get("id")},
         "session": {"source": mapping_source, "session_tail": (session_id or "")[-8:], "message_tail": (message_id or "")[-8:]},
+        "tab": worker.worker_id if worker else None, "cache": cache_result,
         "decide": {"format": compat_mode, "streaming": stream_param}, "stats": {}, "error": None
     }
-    request_id = str(uuid.uuid4()); dbg["request_id"] = request_id
-    
-    RESPONSE_CHANNELS[request_id] = asyncio.Queue()
-    try:
-        payload = convert_openai_to_lmarena_payload(openai_req, session_id, message_id, mode_override, battle_target_override)
-        LAST_PAYLOAD.clear(); LAST_PAYLOAD.update(payload)
-        await BROWSER_WS.send_json({"request_id": request_id, "payload": payload})
-    except Exception as e:
-        RESPONSE_CHANNELS.pop(request_id, None); dbg["error"] = f"send_to_browser_failed: {e}"; _record_debug(dbg)
-        return web.json_response({"error": f"发送到浏览器失败: {e}"}, status=500)
+    dbg["request_id"] = request_id
+    LAST_PAYLOAD.clear(); LAST_PAYLOAD.update(payload)
+
+    if cached:
+        print(f"[INFO] 请求 {request_id[:8]} 命中响应缓存（{cache_result}，键 {key[:12]}）。")
+        events = replay_cached_response(cached); trace.mark("cache_hit", result=cache_result)
+    else:
+        try: await send_to_tab(request_id, worker, payload, model_name, ch)
+        except Exception as e:
+            dbg["error"] = f"send_to_browser_failed: {e}"; _record_debug(dbg); TRACER.end(trace, ended_with="send_failed", error=str(e))
+            return web.json_response({"error": f"发送到浏览器失败: {e}"}, status=500)
+        report = {}; events = process_lmarena_stream(request_id, model=model_name or "unknown", cache_key=key, report=report)
+        # 开启对冲时，超过近期首字延迟的百分位仍没有内容就向另一个标签页/会话再发一次，先出内容的一方胜出
+        fo = {"model": model_name, "mapping": ch, "payload": payload, "entries": snap.endpoint_map.get(model_name) if ch else None,
+              "openai_req": openai_req, "snap": snap, "cache_key": key, "tabs": {worker.worker_id}, "sessions": {ch.get("session_id")} if ch else set(), "trace": trace,
+              "hedge_delay": HEDGES.delay(model_name if model_name in snap.models else "other", snap.config) if wants_hedge(request.headers, model_name, snap.config) else None}
+        if fo["hedge_delay"] is not None: events = with_hedge(events, report, lambda: dispatch_again(fo, 'hedge'), fo["hedge_delay"], HEDGES)
+        # 首个内容块之前的失败（标签页断开、Cloudflare、429 等）透明地换标签页/会话重试
+        events = with_failover(events, report, lambda outcome, remaining: dispatch_again(fo, outcome, remaining), *failover_settings(CONFIG))
 
     final_parts, finish_reason = [], "stop"
     
     try:
         if stream_param:
-            resp = await _sse_prepare(request)
-            rid = f"chatcmpl-{uuid.uuid4()}"
+            resp = await _sse_prepare(request, {BYPASS_HEADER: "hit"} if cached else None)
+            enc = ChunkEncoder(f"chatcmpl-{uuid.uuid4()}", model_name or "unknown", compat_mode)  # 每个流预先渲染块模板，每块只转义文本
+            window, max_bytes = coalesce_settings(CONFIG)
+            if window > 0 and not cached: events = coalesce_content(events, window, max_bytes)  # 时间窗口内的内容增量合并为一个 SSE 事件
             
-            async for etype, data in process_lmarena_stream(request_id):
+            async for etype, data in events:
                 if etype == 'content':
-                    s = str(data); final_parts.append(s)
-                    chunk = {"id": rid, "object": "chat.completion.chunk", "created": int(time.time()), "model": model_name or "unknown",
-                             "choices": [{"index": 0, "delta": {"content": s}, "finish_reason": None}]} if compat_mode == 'openai' else \
-                            {"id": rid, "object": "text_completion", "created": int(time.time()), "model": model_name or "unknown",
-                             "choices": [{"index": 0, "text": s, "finish_reason": None}]}
-                    await _sse_send(resp, chunk)
+                    s = str(data)
+                    if not final_parts: trace.mark("first_sse_write")
+                    final_parts.append(s)
+                    await _sse_write(resp, enc.content_bytes(s))
                 
                 elif etype == 'finish':
                     finish_reason = str(data or "stop")
-                    end_chunk = {"id": rid, "object": "chat.completion.chunk", "created": int(time.time()), "model": model_name or "unknown",
-                                 "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]} if compat_mode == 'openai' else \
-                                {"id": rid, "object": "text_completion", "created": int(time.time()), "model": model_name or "unknown",
-                                 "choices": [{"index": 0, "text": "", "finish_reason": finish_reason}]}
-                    await _sse_send(resp, end_chunk); await _sse_done(resp)
+                    await _sse_write(resp, enc.chunk(None, finish_reason)); await _sse_done(resp)
 
                 elif etype == 'error':
                     dbg["error"] = finish_reason = str(data); final_parts.append(f"\n[LMArena Bridge Error]: {data}")
-                    err_txt = f"[LMArena Bridge Error]: {data}"
-                    err_chunk = {"id": rid, "object": "chat.completion.chunk", "created": int(time.time()), "model": model_name or "unknown",
-                                 "choices": [{"index": 0, "delta": {"content": err_txt}, "finish_reason": "error"}]} if compat_mode == 'openai' else \
-                                {"id": rid, "object": "text_completion", "created": int(time.time()), "model": model_name or "unknown",
-                                 "choices": [{"index": 0, "text": err_txt, "finish_reason": "error"}]}
-                    await _sse_send(resp, err_chunk); await _sse_done(resp)
+                    await _sse_write(resp, enc.chunk(f"[LMArena Bridge Error]: {data}", "error")); await _sse_done(resp)
                     break
             
             dbg["stats"]["final_len"] = sum(len(p) for p in final_parts)
             return resp # SSE响应已发送，直接返回
         
         else: # 非流式
-            async for etype, data in process_lmarena_stream(request_id):
+            # 聚合期间不写出任何内容，需要定期检查客户端是否已断开，断开时立即通知标签页取消
+            events = until_disconnected(events, lambda: request.transport is None or request.transport.is_closing())
+            async for etype, data in events:
+                if etype == 'client_disconnected': raise ConnectionResetError()
                 if etype == 'content': final_parts.append(str(data))
                 elif etype == 'finish': finish_reason = data
                 elif etype == 'error':
                     dbg["error"] = str(data)
                     status = 413 if "附件大小超过" in str(data) else 500
                     err = {"error":{"message":f"[LMArena Bridge Error]: {data}"}}
-                    _record_debug(dbg); CHAT_LOGGER.save(model_name or "unknown", openai_req, f"[Error] {data}", "error")
-                    return web.json_response(err, status=status)
+                    await CHAT_LOGGER.save(model_name or "unknown", openai_req, f"[Error] {data}", "error")  # 调试记录在 finally 中写入
+                    return web.json_response(err, status=status, dumps=json_dumps)
             
             final_txt = "".join(final_parts); dbg["stats"]["final_len"] = len(final_txt)
             rid = f"chatcmpl-{uuid.uuid4()}"
             body = format_lmstudio_non_stream_response(final_txt, model_name or "unknown", rid, finish_reason) if compat_mode == 'lmstudio' else \
                    format_openai_non_stream_response(final_txt, model_name or "unknown", rid, finish_reason)
             LAST_RESPONSE.clear(); LAST_RESPONSE.update({"response": body})
-            return web.json_response(body)
+            return web.json_response(body, headers={BYPASS_HEADER: "hit"} if cached else None, dumps=json_dumps)
 
     except ConnectionResetError:
         dbg["error"] = "client_disconnected"; finish_reason = "client_disconnected"
@@ -796,11 +930,12 @@ async def chat_completions(request: web.Request):
         dbg["error"] = f"main_handler_failed: {e}"; finish_reason = "error"
         return web.json_response({"error": str(e)}, status=500)
     finally:
-        _record_debug(dbg)
+        await events.aclose()  # 客户端断开时生成器可能停在中途，立即结束它（发出取消指令、释放标签页）
+        _record_debug(dbg); TRACER.end(trace, ended_with=finish_reason, error=dbg["error"])
         # 无论流式还是非流式，成功还是失败，只要有内容就保存
         final_txt = "".join(final_parts)
         if final_txt:
-            CHAT_LOGGER.save(model_name or "unknown", openai_req, final_txt, finish_reason)
+            await CHAT_LOGGER.save(model_name or "unknown", openai_req, final_txt, finish_reason)
 
 
 # ID 更新服务（5103）
@@ -823,8 +958,18 @@ async def init_main_app():
         web.post("/completions", chat_completions),
         web.get("/ui", status_page),
         web.get("/status", status_json),
+        web.get("/status/sessions", status_sessions),
+        web.get("/status/admission", status_admission),
+        web.get("/status/cache", status_cache),
+        web.get("/status/chat_log", status_chat_log),
+        web.get("/status/cancellations", status_cancellations),
+        web.get("/status/hedging", status_hedging),
+        web.get("/status/capture", status_capture),
+        web.get("/status/context", status_context),
+        web.get("/metrics", metrics_text),
         web.get("/debug", debug_json),
         web.get("/debug/history", debug_history),
+        web.get("/debug/trace", debug_trace),
         web.post("/debug/reset", debug_reset),
         web.get("/debug/last_payload", debug_last_payload),
         web.get("/debug/last_response", debug_last_response),
@@ -832,6 +977,7 @@ async def init_main_app():
         web.post("/internal/update_available_models", internal_update_available_models),
         web.post("/internal/start_id_capture", internal_start_id_capture),
         web.post("/internal/reload", internal_reload),
+        web.get("/internal/attachments/{ref}", internal_attachment),
         web.post("/internal/generate_models", internal_generate_models),
     ])
     return app
@@ -873,7 +1019,13 @@ async def main():
     print(f"  - 日志目录: {SAVE_DIR}")
     print("========================================")
     
-    ensure_dir(SAVE_DIR); load_config(); load_model_map(); load_model_endpoint_map()
+    ensure_dir(SAVE_DIR); reload_configs()
+    asyncio.create_task(ADMISSION.monitor_loop_lag())
+    watch_interval = CONFIG.get("config_watch_interval_seconds", 2)
+    if watch_interval and watch_interval > 0: asyncio.create_task(CONFIG_STORE.watch(watch_interval, on_change=_on_config_files_changed))
+    probe_interval = CONFIG.get("session_probe_interval_seconds", 0)
+    if probe_interval and probe_interval > 0:
+        asyncio.create_task(SESSION_POOL.probe_loop(lambda: MODEL_ENDPOINT_MAP, probe_session, probe_interval)); print(f"[INFO] 会话探测已启用，间隔 {probe_interval} 秒。")
     
     app = await init_main_app(); runner = web.AppRunner(app); await runner.setup()
     site = web.TCPSite(runner,"0.0.0.0",5102); await site.start()
@@ -889,3 +1041,6 @@ if __name__=="__main__":
         asyncio.run(main())
     except KeyboardInterrupt:
         print("\n[INFO] 已停止。")
+    finally:
+        CHAT_LOGGER.close()  # 写完队列中剩余的对话记录
+        ATTACHMENT_STORE.close()  # 删除转存附件的临时文件
@@ -11,7 +11,6 @@ import time
 import uuid
 import re
 import threading
-import random
 import mimetypes
 from datetime import datetime
 from contextlib import asynccontextmanager
@@ -21,7 +20,32 @@ import requests
 from packaging.version import parse as parse_version
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse, Response
+from fastapi.responses import StreamingResponse, JSONResponse, Response, FileResponse
+
+from modules.worker_pool import WorkerPool, BrowserWorker, DEFAULT_MAX_CONCURRENCY
+from modules.stream_parser import LMArenaStreamParser, classify_browser_error
+from modules.config_store import ConfigStore, ConfigSnapshot, CONFIG_FILE, MODELS_FILE, ENDPOINT_MAP_FILE
+from modules.session_pool import SessionPool
+from modules.response_channel import ResponseChannel, CHANNEL_OVERFLOW_ERROR
+from modules.admission import AdmissionController, AdmissionRejected
+from modules.metrics import BridgeMetrics, metered_send, utf8_len, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from modules.response_cache import ResponseCache, CachedResponse, cache_key, should_bypass, BYPASS_HEADER
+from modules.ws_protocol import StreamCodec, negotiate, hello_message, PROTOCOL_V2, DEFAULT_COMPRESS_MIN_BYTES
+from modules.attachment_store import AttachmentStore, is_valid_ref, REF_URL_PREFIX
+from modules.model_extractor import extract_models, diff_models, load_models
+from modules.body_ingest import ingest_json, check_content_length, limits_from_config, BodyTooLarge
+from modules.cancellation import CancelTracker, until_disconnected, ack_request_id
+from modules.sse_encoder import ChunkEncoder
+from modules.json_codec import loads as json_loads, dumps_bytes as json_dumps_bytes
+from modules.coalesce import coalesce_content, settings_from_config as coalesce_settings
+from modules.failover import with_failover, settings_from_config as failover_settings
+from modules.hedging import HedgeTracker, with_hedge, wants_hedge
+from modules.traffic_capture import TrafficCapture
+from modules.context_budget import ContextBudget
+from modules.tracing import Tracer
+from modules.heartbeat import run_heartbeat, settings_from_config as heartbeat_settings, pong_seq
+from modules.hot_restart import (handoff_supported, listening_socket, notify_ready, spawn_successor,
+                                 wait_ready, wait_until, DrainMiddleware)
 
 
 # --- 基础配置 ---
@@ -29,17 +53,54 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 logger = logging.getLogger(__name__)
 
 # --- 全局状态与配置 ---
+# CONFIG_STORE 持有 config.jsonc / models.json / model_endpoint_map.json 的只读快照，
+# 只在文件发生变化时才重新解析。CONFIG、MODEL_NAME_TO_ID_MAP、MODEL_ENDPOINT_MAP 始终指向当前快照的内容；
+# 处理请求时应先取得 CONFIG_STORE.snapshot，在整个请求中使用同一个快照。
+CONFIG_STORE = ConfigStore()
 CONFIG = {} # 存储从 config.jsonc 加载的配置
-# browser_ws 用于存储与单个油猴脚本的 WebSocket 连接。
-# 注意：此架构假定只有一个浏览器标签页在工作。
-# 如果需要支持多个并发标签页，需要将此扩展为字典管理多个连接。
-browser_ws: WebSocket | None = None
+# WORKER_POOL 管理所有已连接的油猴脚本（每个浏览器标签页一个 WebSocket 连接）。
+# 每个请求会被分发到负载最低的健康标签页，并记录 request_id 的归属，
+# 某个标签页断开时只会影响它自己负责的请求。
+WORKER_POOL = WorkerPool()
+# SESSION_POOL 跟踪 model_endpoint_map.json 中每个会话的成功率、在途请求数和首字延迟，
+# 按加权最小负载选择会话，连续失败的会话会进入冷却期。
+SESSION_POOL = SessionPool()
+# ADMISSION 在请求发送给浏览器之前执行并发上限检查（全局 / 单标签页 / 单模型），
+# 超出上限的请求进入有界等待队列，无法及时处理时以 429/503 + Retry-After 快速拒绝。
+ADMISSION = AdmissionController(WORKER_POOL)
 # response_channels 用于存储每个 API 请求的响应队列。
-# 键是 request_id，值是 asyncio.Queue。
-response_channels: dict[str, asyncio.Queue] = {}
+# 键是 request_id，值是有界的 ResponseChannel：积压过多时通知标签页暂停读取上游响应（见 _new_response_channel）。
+response_channels: dict[str, ResponseChannel] = {}
+# METRICS 收集 /metrics 输出的指标：首字延迟、块间隔、按结果统计的请求数、在途/排队数量和 WebSocket 流量。
+METRICS = BridgeMetrics()
+METRICS.register_gauges(WORKER_POOL, ADMISSION, response_channels)
+# RESPONSE_CACHE 缓存完全相同请求的完整响应（config.jsonc 中 response_cache_enabled 开启后生效）。
+RESPONSE_CACHE = ResponseCache()
+METRICS.register_cache(RESPONSE_CACHE)
+# ATTACHMENT_STORE 按内容哈希保存附件的 data URL，载荷中只携带引用，标签页按需取回并缓存。
+ATTACHMENT_STORE = AttachmentStore()
+METRICS.register_attachments(ATTACHMENT_STORE)
+# CANCELS 在请求于标签页完成之前结束时（客户端断开、超时等）通知标签页中止 fetch，并统计取消延迟。
+CANCELS = CancelTracker()
+METRICS.register_cancellations(CANCELS)
+# HEDGES 记录各模型近期的首字延迟（决定对冲延迟）以及对冲的发出/胜出次数
+HEDGES = HedgeTracker()
+METRICS.register_hedging(HEDGES)
+# CAPTURE 按 traffic_capture_rate 抽样记录浏览器回传的原始数据块，供 benchmarks/replay_capture.py 离线重放
+CAPTURE = TrafficCapture()
+# CONTEXT_BUDGET 按 context_budget_kb 在发送前裁剪超出模型预算的对话历史
+CONTEXT_BUDGET = ContextBudget()
+# TRACER 按 trace_sample_rate 记录请求各阶段的时间（解析、转换、发送、首字节、首次写出、结束），GET /debug/trace 导出
+TRACER = Tracer()
 last_activity_time = None # 记录最后一次活动的时间
 idle_monitor_thread = None # 空闲监控线程
 main_event_loop = None # 主事件循环
+# 不中断服务的重启（见 modules/hot_restart.py）。UVICORN_SERVER 与 LISTEN_SOCKET 在 __main__ 中设置；
+# HANDOFF_STARTED_AT 不为 None 表示本进程由重启启动，标签页尚未重连时请求会短暂等待而不是直接返回 503。
+UVICORN_SERVER = None
+LISTEN_SOCKET = None
+HANDOFF_STARTED_AT = None
+RESTART_STATE = {"phase": "idle", "reason": None, "successor_pid": None, "started_at": None, "pending_reason": None}
 
 # --- 模型映射 ---
 # MODEL_NAME_TO_ID_MAP 现在将存储更丰富的对象： { "model_name": {"id": "...", "type": "..."} }
@@ -47,67 +108,55 @@ MODEL_NAME_TO_ID_MAP = {}
 MODEL_ENDPOINT_MAP = {} # 新增：用于存储模型到 session/message ID 的映射
 DEFAULT_MODEL_ID = None # 默认模型id: None
 
-def load_model_endpoint_map():
-    """从 model_endpoint_map.json 加载模型到端点的映射。"""
-    global MODEL_ENDPOINT_MAP
-    try:
-        with open('model_endpoint_map.json', 'r', encoding='utf-8') as f:
-            content = f.read()
-            # 允许空文件
-            if not content.strip():
-                MODEL_ENDPOINT_MAP = {}
-            else:
-                MODEL_ENDPOINT_MAP = json.loads(content)
-        logger.info(f"成功从 'model_endpoint_map.json' 加载了 {len(MODEL_ENDPOINT_MAP)} 个模型端点映射。")
-    except FileNotFoundError:
-        logger.warning("'model_endpoint_map.json' 文件未找到。将使用空映射。")
-        MODEL_ENDPOINT_MAP = {}
-    except json.JSONDecodeError as e:
-        logger.error(f"加载或解析 'model_endpoint_map.json' 失败: {e}。将使用空映射。")
-        MODEL_ENDPOINT_MAP = {}
-
-def load_config():
-    """从 config.jsonc 加载配置，并处理 JSONC 注释。"""
-    global CONFIG
-    try:
-        with open('config.jsonc', 'r', encoding='utf-8') as f:
-            content = f.read()
-            # 移除 // 行注释和 /* */ 块注释
-            json_content = re.sub(r'//.*', '', content)
-            json_content = re.sub(r'/\*.*?\*/', '', json_content, flags=re.DOTALL)
-            CONFIG = json.loads(json_content)
-        logger.info("成功从 'config.jsonc' 加载配置。")
+def apply_config_snapshot(snapshot: ConfigSnapshot):
+    """将快照设为当前的全局配置视图（在同一次同步调用中替换，不会出现新旧混合）。"""
+    global CONFIG, MODEL_NAME_TO_ID_MAP, MODEL_ENDPOINT_MAP
+    CONFIG = snapshot.config
+    MODEL_NAME_TO_ID_MAP = snapshot.models
+    MODEL_ENDPOINT_MAP = snapshot.endpoint_map
+    SESSION_POOL.configure(snapshot.config)
+    ADMISSION.configure(snapshot.config)
+    RESPONSE_CACHE.configure(snapshot.config)
+    ATTACHMENT_STORE.configure(snapshot.config)
+    CAPTURE.configure(snapshot.config)
+    CONTEXT_BUDGET.configure(snapshot.config)
+    TRACER.configure(snapshot.config)
+    SESSION_POOL.prune(snapshot.endpoint_map)
+
+def log_config_changes(changes: dict):
+    """打印配置重新加载的结果。"""
+    for filename, error in changes.get("errors", {}).items():
+        logger.error(f"加载或解析 '{filename}' 失败: {error}。将保留上一次成功加载的内容（首次加载则为空）。")
+    for filename, diff in changes.items():
+        if filename == "errors":
+            continue
+        summary = f"新增 {len(diff['added'])} 项, 移除 {len(diff['removed'])} 项, 变更 {len(diff['changed'])} 项"
+        if diff["changed"]:
+            summary += f": {', '.join(diff['changed'][:10])}"
+        logger.info(f"已加载 '{filename}' ({summary})。")
+    if CONFIG_FILE in changes:
         # 打印关键配置状态
         logger.info(f"  - 酒馆模式 (Tavern Mode): {'✅ 启用' if CONFIG.get('tavern_mode_enabled') else '❌ 禁用'}")
         logger.info(f"  - 绕过模式 (Bypass Mode): {'✅ 启用' if CONFIG.get('bypass_enabled') else '❌ 禁用'}")
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        logger.error(f"加载或解析 'config.jsonc' 失败: {e}。将使用默认配置。")
-        CONFIG = {}
+    if MODELS_FILE in changes:
+        logger.info(f"  - 当前共有 {len(MODEL_NAME_TO_ID_MAP)} 个模型。")
+    if ENDPOINT_MAP_FILE in changes:
+        logger.info(f"  - 当前共有 {len(MODEL_ENDPOINT_MAP)} 个模型端点映射。")
 
-def load_model_map():
-    """从 models.json 加载模型映射，支持 'id:type' 格式。"""
-    global MODEL_NAME_TO_ID_MAP
-    try:
-        with open('models.json', 'r', encoding='utf-8') as f:
-            raw_map = json.load(f)
-            
-        processed_map = {}
-        for name, value in raw_map.items():
-            if isinstance(value, str) and ':' in value:
-                parts = value.split(':', 1)
-                model_id = parts[0] if parts[0].lower() != 'null' else None
-                model_type = parts[1]
-                processed_map[name] = {"id": model_id, "type": model_type}
-            else:
-                # 默认或旧格式处理
-                processed_map[name] = {"id": value, "type": "text"}
-
-        MODEL_NAME_TO_ID_MAP = processed_map
-        logger.info(f"成功从 'models.json' 加载并解析了 {len(MODEL_NAME_TO_ID_MAP)} 个模型。")
+def load_config(force: bool = False) -> dict:
+    """
+    检查 config.jsonc、models.json 和 model_endpoint_map.json，
+    只重新解析发生变化的文件，并切换到新的配置快照。返回变化摘要。
+    """
+    changes = CONFIG_STORE.reload(force=force)
+    apply_config_snapshot(CONFIG_STORE.snapshot)
+    log_config_changes(changes)
+    return changes
 
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        logger.error(f"加载 'models.json' 失败: {e}。将使用空模型列表。")
-        MODEL_NAME_TO_ID_MAP = {}
+def _on_config_files_changed(changes: dict):
+    """后台文件监视任务发现变化时的回调（在事件循环线程中执行）。"""
+    apply_config_snapshot(CONFIG_STORE.snapshot)
+    log_config_changes(changes)
 
 # --- 更新检查 ---
 GITHUB_REPO = "Lianues/LMArenaBridge"
@@ -171,9 +220,18 @@ def check_for_updates():
             logger.info(f"  - 当前版本: {current_version}")
             logger.info(f"  - 最新版本: {remote_version_str}")
             if download_and_extract_update(remote_version_str):
+                update_script_path = os.path.join("modules", "update_script.py")
+                if handoff_supported():
+                    # 先应用文件更新，服务器启动后再以不中断服务的方式切换到新版本进程
+                    logger.info("正在应用更新，服务器启动后将切换到新版本...")
+                    if subprocess.run([sys.executable, update_script_path, "--apply-only"]).returncode == 0:
+                        RESTART_STATE["pending_reason"] = f"更新到 v{remote_version_str}"
+                    else:
+                        logger.error("应用更新失败，继续运行当前版本。")
+                    logger.info("="*60)
+                    return
                 logger.info("准备应用更新。服务器将在5秒后关闭并启动更新脚本。")
                 time.sleep(5)
-                update_script_path = os.path.join("modules", "update_script.py")
                 # 使用 Popen 启动独立进程
                 subprocess.Popen([sys.executable, update_script_path])
                 # 优雅地退出当前服务器进程
@@ -194,50 +252,9 @@ def check_for_updates():
 # --- 模型更新 ---
 def extract_models_from_html(html_content):
     """
-    从 HTML 内容中提取完整的模型JSON对象，使用括号匹配确保完整性。
+    从 HTML 内容中提取完整的模型JSON对象（单次线性扫描，识别转义 JSON 中的字符串，见 modules/model_extractor.py）。
     """
-    models = []
-    model_names = set()
-    
-    # 查找所有可能的模型JSON对象的起始位置
-    for start_match in re.finditer(r'\{\\"id\\":\\"[a-f0-9-]+\\"', html_content):
-        start_index = start_match.start()
-        
-        # 从起始位置开始，进行花括号匹配
-        open_braces = 0
-        end_index = -1
-        
-        # 优化：设置一个合理的搜索上限，避免无限循环
-        search_limit = start_index + 10000 # 假设一个模型定义不会超过10000个字符
-        
-        for i in range(start_index, min(len(html_content), search_limit)):
-            if html_content[i] == '{':
-                open_braces += 1
-            elif html_content[i] == '}':
-                open_braces -= 1
-                if open_braces == 0:
-                    end_index = i + 1
-                    break
-        
-        if end_index != -1:
-            # 提取完整的、转义的JSON字符串
-            json_string_escaped = html_content[start_index:end_index]
-            
-            # 反转义
-            json_string = json_string_escaped.replace('\\"', '"').replace('\\\\', '\\')
-            
-            try:
-                model_data = json.loads(json_string)
-                model_name = model_data.get('publicName')
-                
-                # 使用publicName去重
-                if model_name and model_name not in model_names:
-                    models.append(model_data)
-                    model_names.add(model_name)
-            except json.JSONDecodeError as e:
-                logger.warning(f"解析提取的JSON对象时出错: {e} - 内容: {json_string[:150]}...")
-                continue
-
+    models = extract_models(html_content)
     if models:
         logger.info(f"成功提取并解析了 {len(models)} 个独立模型。")
         return models
@@ -245,6 +262,18 @@ def extract_models_from_html(html_content):
         logger.error("错误：在HTML响应中找不到任何匹配的完整模型JSON对象。")
         return None
 
+def update_available_models(html_bytes, models_path="available_models.json"):
+    """
+    在工作线程中运行：提取模型，与现有的模型文件比较后保存。
+    返回 (模型列表, 差异)，提取失败时返回 (None, None)。
+    """
+    new_models_list = extract_models_from_html(html_bytes.decode('utf-8', 'replace'))
+    if not new_models_list:
+        return None, None
+    diff = diff_models(load_models(models_path), new_models_list)
+    save_available_models(new_models_list, models_path)
+    return new_models_list, diff
+
 def save_available_models(new_models_list, models_path="available_models.json"):
     """
     将提取到的完整模型对象列表保存到指定的JSON文件中。
@@ -260,25 +289,75 @@ def save_available_models(new_models_list, models_path="available_models.json"):
         logger.error(f"❌ 写入 '{models_path}' 文件时出错: {e}")
 
 # --- 自动重启逻辑 ---
+async def managed_restart(reason: str) -> bool:
+    """
+    不中断服务的重启：启动继承监听套接字的新进程，等它就绪后停止接受新连接，
+    排空在途请求（最多 restart_drain_timeout_seconds），再让标签页连接新进程，最后退出。
+    无法进行（已有重启在进行、系统不支持、新进程未能就绪）时返回 False，当前进程继续服务。
+    """
+    if RESTART_STATE["phase"] != "idle" or not handoff_supported() or UVICORN_SERVER is None or LISTEN_SOCKET is None:
+        return False
+    RESTART_STATE.update(phase="starting", reason=reason, started_at=time.time(), successor_pid=None)
+    logger.warning(f"开始重启（原因: {reason}），正在启动新进程...")
+    try:
+        proc, ready_fd = spawn_successor(LISTEN_SOCKET, [sys.executable] + sys.argv)
+    except OSError as e:
+        logger.error(f"启动新进程失败: {e}")
+        RESTART_STATE["phase"] = "idle"
+        return False
+    RESTART_STATE["successor_pid"] = proc.pid
+    if not await wait_ready(ready_fd, CONFIG.get("restart_ready_timeout_seconds", 60)):
+        logger.error(f"新进程 (PID {proc.pid}) 未能就绪，取消重启，继续由当前进程服务。")
+        proc.terminate()
+        RESTART_STATE.update(phase="idle", successor_pid=None)
+        return False
+
+    # 1. 新进程已在同一个监听套接字上接受连接，当前进程不再接受新连接
+    RESTART_STATE["phase"] = "draining"
+    for server in UVICORN_SERVER.servers:
+        server.close()
+    # 2. 支持排空的脚本立即连接新进程，旧连接继续回传已收到的请求
+    sent = await WORKER_POOL.broadcast({"command": "reconnect"}, lambda w: w.drain_reconnect)
+    logger.info(f"新进程 (PID {proc.pid}) 已就绪，已停止接受新连接，{sent} 个标签页正在连接新进程。")
+    # 3. 等待在途与排队中的请求结束
+    drain_timeout = CONFIG.get("restart_drain_timeout_seconds", 120)
+    if not await wait_until(lambda: not ADMISSION.in_flight and not ADMISSION.waiters and not response_channels, drain_timeout):
+        logger.warning(f"排空超时 ({drain_timeout}s)，仍有 {len(ADMISSION.in_flight)} 个请求未完成，将被中断。")
+    # 4. 旧版脚本没有请求可中断了，此时才让它刷新页面；其余标签页的旧连接直接关闭
+    RESTART_STATE["phase"] = "handoff"
+    await WORKER_POOL.broadcast({"command": "reconnect"}, lambda w: not w.drain_reconnect)
+    for worker in list(WORKER_POOL.workers.values()):
+        if worker.drain_reconnect:
+            await worker.close()
+    await wait_until(lambda: not len(WORKER_POOL), 10)
+    logger.info("旧进程排空完成，正在退出。")
+    UVICORN_SERVER.should_exit = True
+    return True
+
 def restart_server():
-    """优雅地通知客户端刷新，然后重启服务器。"""
+    """
+    优雅地重启服务器。支持时以不中断服务的方式交接给新进程（交接完成后返回 True，进程随即退出；
+    已有重启在进行时返回 False）；否则通知客户端刷新，然后用 execv 替换当前进程。
+    """
     logger.warning("="*60)
     logger.warning("检测到服务器空闲超时，准备自动重启...")
     logger.warning("="*60)
+    if handoff_supported() and main_event_loop:
+        if RESTART_STATE["phase"] != "idle":
+            return False # 已有重启在进行
+        if asyncio.run_coroutine_threadsafe(managed_restart("空闲超时"), main_event_loop).result():
+            return True
+        logger.warning("不中断服务的重启未能完成，改用普通重启。")
     
-    # 1. (异步) 通知浏览器刷新
+    # 1. (异步) 通知所有浏览器标签页刷新
     async def notify_browser_refresh():
-        if browser_ws:
-            try:
-                # 优先发送 'reconnect' 指令，让前端知道这是一个计划内的重启
-                await browser_ws.send_text(json.dumps({"command": "reconnect"}, ensure_ascii=False))
-                logger.info("已向浏览器发送 'reconnect' 指令。")
-            except Exception as e:
-                logger.error(f"发送 'reconnect' 指令失败: {e}")
+        # 优先发送 'reconnect' 指令，让前端知道这是一个计划内的重启
+        sent = await WORKER_POOL.broadcast({"command": "reconnect"})
+        logger.info(f"已向 {sent} 个浏览器标签页发送 'reconnect' 指令。")
     
     # 在主事件循环中运行异步通知函数
     # 使用`asyncio.run_coroutine_threadsafe`确保线程安全
-    if browser_ws and browser_ws.client_state.name == 'CONNECTED' and main_event_loop:
+    if len(WORKER_POOL) and main_event_loop:
         asyncio.run_coroutine_threadsafe(notify_browser_refresh(), main_event_loop)
     
     # 2. 延迟几秒以确保消息发送
@@ -311,8 +390,8 @@ def idle_monitor():
             
             if idle_time > timeout:
                 logger.info(f"服务器空闲时间 ({idle_time:.0f}s) 已超过阈值 ({timeout}s)。")
-                restart_server()
-                break # 退出循环，因为进程即将被替换
+                if restart_server():
+                    break # 退出循环，因为进程即将被替换
                 
         # 每 10 秒检查一次
         time.sleep(10)
@@ -323,7 +402,7 @@ async def lifespan(app: FastAPI):
     """在服务器启动时运行的生命周期函数。"""
     global idle_monitor_thread, last_activity_time, main_event_loop
     main_event_loop = asyncio.get_running_loop() # 获取主事件循环
-    load_config() # 首先加载配置
+    load_config() # 首先加载配置（同时加载 models.json 与 model_endpoint_map.json）
     
     # --- 打印当前的操作模式 ---
     mode = CONFIG.get("id_updater_last_mode", "direct_chat")
@@ -336,8 +415,23 @@ async def lifespan(app: FastAPI):
     logger.info("="*60)
 
     check_for_updates() # 检查程序更新
-    load_model_map() # 重新启用模型加载
-    load_model_endpoint_map() # 加载模型端点映射
+
+    # 后台监视配置文件：只在文件变化时重新解析，请求处理路径上不再读取磁盘
+    config_watch_task = None
+    watch_interval = CONFIG.get("config_watch_interval_seconds", 2)
+    if watch_interval and watch_interval > 0:
+        config_watch_task = asyncio.create_task(CONFIG_STORE.watch(watch_interval, on_change=_on_config_files_changed))
+
+    # 测量事件循环延迟，过载时准入控制会直接拒绝新请求
+    loop_lag_task = asyncio.create_task(ADMISSION.monitor_loop_lag())
+
+    # 可选：后台探测空闲会话，在真实请求到来之前发现失效的会话ID
+    session_probe_task = None
+    probe_interval = CONFIG.get("session_probe_interval_seconds", 0)
+    if probe_interval and probe_interval > 0:
+        session_probe_task = asyncio.create_task(SESSION_POOL.probe_loop(lambda: MODEL_ENDPOINT_MAP, _probe_session, probe_interval))
+        logger.info(f"会话探测已启用，间隔 {probe_interval} 秒。")
+    after_startup_task = asyncio.create_task(_after_startup())
     logger.info("服务器启动完成。等待油猴脚本连接...")
 
     # 在模型更新后，标记活动时间的起点
@@ -350,8 +444,23 @@ async def lifespan(app: FastAPI):
         
 
     yield
+    for task in (config_watch_task, session_probe_task, loop_lag_task, after_startup_task):
+        if task:
+            task.cancel()
+    ATTACHMENT_STORE.close()
     logger.info("服务器正在关闭。")
 
+async def _after_startup():
+    """开始监听后：通知等待交接的旧进程；启动时应用了更新则切换到新版本进程。"""
+    if UVICORN_SERVER is None:
+        return
+    while not UVICORN_SERVER.started:
+        await asyncio.sleep(0.05)
+    notify_ready()
+    reason, RESTART_STATE["pending_reason"] = RESTART_STATE["pending_reason"], None
+    if reason and not await managed_restart(reason):
+        logger.error(f"未能切换到新进程（{reason}），继续运行当前版本。")
+
 app = FastAPI(lifespan=lifespan)
 
 # --- CORS 中间件配置 ---
@@ -363,6 +472,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# 重启排空期间的响应带 Connection: close，客户端的下一个请求会连到新进程
+app.add_middleware(DrainMiddleware, is_draining=lambda: RESTART_STATE["phase"] in ("draining", "handoff"))
 
 # --- 辅助函数 ---
 def save_config():
@@ -399,7 +510,7 @@ def _process_openai_message(message: dict) -> dict:
     处理OpenAI消息，分离文本和附件。
     - 将多模态内容列表分解为纯文本和附件列表。
     - 确保 user 角色的空内容被替换为空格，以避免 LMArena 出错。
-    - 为附件生成基础结构。
+    - 为附件生成基础结构：data URL 保存到 ATTACHMENT_STORE，附件中只携带内容哈希引用 (ref)。
     """
     content = message.get("content")
     role = message.get("role")
@@ -420,16 +531,26 @@ def _process_openai_message(message: dict) -> dict:
                 # detail 字段是 OpenAI Vision API 的一部分，这里我们复用它
                 original_filename = image_url_data.get("detail")
 
-                if url and url.startswith("data:"):
+                if url and (url.startswith("data:") or url.startswith(REF_URL_PREFIX)):
                     try:
-                        content_type = url.split(';')[0].split(':')[1]
+                        if url.startswith(REF_URL_PREFIX):
+                            # 读取请求体时已经存入附件存储（见 modules/body_ingest.py）
+                            ref = url[len(REF_URL_PREFIX):]
+                            described = ATTACHMENT_STORE.describe(ref)
+                            if described is None:
+                                raise ValueError("附件已被淘汰")
+                            content_type, size = described
+                        else:
+                            content_type = url.split(';')[0].split(':')[1]
+                            ref = ATTACHMENT_STORE.put(url)
+                            size = len(url)
                         
                         # 如果客户端提供了原始文件名，直接使用它
                         if original_filename and isinstance(original_filename, str):
                             file_name = original_filename
                             logger.info(f"成功处理一个附件 (使用原始文件名): {file_name}")
                         else:
-                            # 否则，回退到旧的、基于UUID的命名逻辑
+                            # 否则，按内容哈希生成文件名（同一附件每轮的载荷保持一致）
                             main_type, sub_type = content_type.split('/') if '/' in content_type else ('application', 'octet-stream')
                             
                             if main_type == "image": prefix = "image"
@@ -442,13 +563,14 @@ def _process_openai_message(message: dict) -> dict:
                             else:
                                 file_extension = sub_type if len(sub_type) < 20 else 'bin'
                             
-                            file_name = f"{prefix}_{uuid.uuid4()}.{file_extension}"
+                            file_name = f"{prefix}_{ref[:16]}.{file_extension}"
                             logger.info(f"成功处理一个附件 (生成文件名): {file_name}")
 
                         attachments.append({
                             "name": file_name,
                             "contentType": content_type,
-                            "url": url
+                            "ref": ref,
+                            "size": size
                         })
                     except (IndexError, ValueError) as e:
                         logger.warning(f"无法解析的 base64 data URI: {url[:60]}... 错误: {e}")
@@ -467,11 +589,14 @@ def _process_openai_message(message: dict) -> dict:
         "attachments": attachments
     }
 
-def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str, message_id: str, mode_override: str = None, battle_target_override: str = None) -> dict:
+def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str, message_id: str, mode_override: str = None, battle_target_override: str = None, snapshot: ConfigSnapshot = None) -> dict:
     """
     将 OpenAI 请求体转换为油猴脚本所需的简化载荷，并应用酒馆模式、绕过模式以及对战模式。
     新增了模式覆盖参数，以支持模型特定的会话模式。
+    snapshot: 请求开始时取得的配置快照；未提供时使用当前全局配置。
     """
+    config = snapshot.config if snapshot else CONFIG
+    model_map = snapshot.models if snapshot else MODEL_NAME_TO_ID_MAP
     # 1. 规范化角色并处理消息
     #    - 将非标准的 'developer' 角色转换为 'system' 以提高兼容性。
     #    - 分离文本和附件。
@@ -482,9 +607,12 @@ def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str, messag
             logger.info("消息角色规范化：将 'developer' 转换为 'system'。")
             
     processed_messages = [_process_openai_message(msg.copy()) for msg in messages]
+    for processed, msg in zip(processed_messages, messages):
+        if msg.get("pinned"):
+            processed["pinned"] = True  # 客户端标记的消息不会被上下文预算裁剪
 
     # 2. 应用酒馆模式 (Tavern Mode)
-    if CONFIG.get("tavern_mode_enabled"):
+    if config.get("tavern_mode_enabled"):
         system_prompts = [msg['content'] for msg in processed_messages if msg['role'] == 'system']
         other_messages = [msg for msg in processed_messages if msg['role'] != 'system']
         
@@ -500,7 +628,7 @@ def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str, messag
 
     # 3. 确定目标模型 ID
     model_name = openai_data.get("model", "claude-3-5-sonnet-20241022")
-    model_info = MODEL_NAME_TO_ID_MAP.get(model_name, {}) # 关键修复：确保 model_info 总是一个字典
+    model_info = model_map.get(model_name, {}) # 关键修复：确保 model_info 总是一个字典
     
     target_model_id = None
     if model_info:
@@ -511,7 +639,13 @@ def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str, messag
     if not target_model_id:
         logger.warning(f"模型 '{model_name}' 在 'models.json' 中未找到对应的ID。请求将不带特定模型ID发送。")
 
-    # 4. 构建消息模板
+    # 4. 按模型的上下文预算裁剪较早的历史（见 modules/context_budget.py）
+    processed_messages, trim = CONTEXT_BUDGET.trim(processed_messages, model_name)
+    if trim:
+        logger.info(f"上下文预算 ({trim['budget'] // 1024}KB): 载荷 {trim['before'] // 1024}KB → {trim['after'] // 1024}KB，"
+                    f"丢弃 {trim['dropped']} 条消息，去掉 {trim['stripped']} 个附件。")
+
+    # 5. 构建消息模板
     message_templates = []
     for msg in processed_messages:
         message_templates.append({
@@ -520,17 +654,17 @@ def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str, messag
             "attachments": msg.get("attachments", [])
         })
 
-    # 5. 应用绕过模式 (Bypass Mode) - 仅对文本模型生效
+    # 6. 应用绕过模式 (Bypass Mode) - 仅对文本模型生效
     model_type = model_info.get("type", "text")
-    if CONFIG.get("bypass_enabled") and model_type == "text":
+    if config.get("bypass_enabled") and model_type == "text":
         # 绕过模式总是添加一个 position 'a' 的用户消息
         logger.info("绕过模式已启用，正在注入一个空的用户消息。")
         message_templates.append({"role": "user", "content": " ", "participantPosition": "a", "attachments": []})
 
-    # 6. 应用参与者位置 (Participant Position)
+    # 7. 应用参与者位置 (Participant Position)
     # 优先使用覆盖的模式，否则回退到全局配置
-    mode = mode_override or CONFIG.get("id_updater_last_mode", "direct_chat")
-    target_participant = battle_target_override or CONFIG.get("id_updater_battle_target", "A")
+    mode = mode_override or config.get("id_updater_last_mode", "direct_chat")
+    target_participant = battle_target_override or config.get("id_updater_battle_target", "A")
     target_participant = target_participant.lower() # 确保是小写
 
     logger.info(f"正在根据模式 '{mode}' (目标: {target_participant if mode == 'battle' else 'N/A'}) 设置 Participant Positions...")
@@ -558,28 +692,14 @@ def convert_openai_to_lmarena_payload(openai_data: dict, session_id: str, messag
     }
 
 # --- OpenAI 格式化辅助函数 (确保JSON序列化稳健) ---
-def format_openai_chunk(content: str, model: str, request_id: str) -> str:
-    """格式化为 OpenAI 流式块。"""
-    chunk = {
-        "id": request_id, "object": "chat.completion.chunk",
-        "created": int(time.time()), "model": model,
-        "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
-    }
-    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
-
-def format_openai_finish_chunk(model: str, request_id: str, reason: str = 'stop') -> str:
+# 流式内容块由 ChunkEncoder.content() 生成（modules/sse_encoder.py：每个流预先渲染模板，每块只转义文本）
+def format_openai_finish_chunk(encoder: ChunkEncoder, reason: str = 'stop') -> str:
     """格式化为 OpenAI 结束块。"""
-    chunk = {
-        "id": request_id, "object": "chat.completion.chunk",
-        "created": int(time.time()), "model": model,
-        "choices": [{"index": 0, "delta": {}, "finish_reason": reason}]
-    }
-    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\ndata: [DONE]\n\n"
+    return encoder.chunk(None, reason) + "data: [DONE]\n\n"
 
-def format_openai_error_chunk(error_message: str, model: str, request_id: str) -> str:
+def format_openai_error_chunk(error_message: str, encoder: ChunkEncoder) -> str:
     """格式化为 OpenAI 错误块。"""
-    content = f"\n\n[LMArena Bridge Error]: {error_message}"
-    return format_openai_chunk(content, model, request_id)
+    return encoder.content(f"\n\n[LMArena Bridge Error]: {error_message}")
 
 def format_openai_non_stream_response(content: str, model: str, request_id: str, reason: str = 'stop') -> dict:
     """构建符合 OpenAI 规范的非流式响应体。"""
@@ -600,10 +720,37 @@ def format_openai_non_stream_response(content: str, model: str, request_id: str,
         },
     }
 
-async def _process_lmarena_stream(request_id: str):
+BROWSER_DISCONNECTED_ERROR = "Browser disconnected during operation"
+
+def _new_response_channel(request_id: str) -> ResponseChannel:
+    """创建有界的响应通道；pause/resume 流控指令发送给当前负责该请求的标签页。"""
+    async def send_control(command: dict):
+        worker = WORKER_POOL.owner(request_id)
+        if worker:
+            await worker.send_json(command)
+    return ResponseChannel.from_config(request_id, CONFIG, send_control)
+
+async def _refresh_owner_tab(request_id: str):
+    """向负责该请求的标签页发送刷新指令，并在其重新连接前不再向它分发新请求。"""
+    worker = WORKER_POOL.owner(request_id)
+    if not worker:
+        return
+    try:
+        await worker.send_json({"command": "refresh"})
+        worker.healthy = False
+        logger.info(f"PROCESSOR [ID: {request_id[:8]}]: 已向标签页 {worker.worker_id} 发送页面刷新指令。")
+    except Exception as e:
+        logger.error(f"PROCESSOR [ID: {request_id[:8]}]: 发送刷新指令失败: {e}")
+
+async def _process_lmarena_stream(request_id: str, timeout: float = None, model: str = "unknown", cache_key: str = None,
+                                  report: dict = None):
     """
     核心内部生成器：处理来自浏览器的原始数据流，并产生结构化事件。
     事件类型: ('content', str), ('finish', str), ('error', str)
+    请求结束时会把结果（成功/会话失败/与会话无关）记录到 SESSION_POOL，并更新 /metrics 指标。
+    提供 cache_key 时，正常结束的完整响应会写入 RESPONSE_CACHE。
+    提供 report 字典时，结束时把请求结果写入 report['outcome']（供 with_failover 判断能否重试）；
+    对冲落败被提前关闭时，with_hedge 会先设置 report['closed_as']，请求结果记为该值而不是 client_disconnect。
     """
     queue = response_channels.get(request_id)
     if not queue:
@@ -611,14 +758,20 @@ async def _process_lmarena_stream(request_id: str):
         yield 'error', 'Internal server error: response channel not found.'
         return
 
-    buffer = ""
-    timeout = CONFIG.get("stream_response_timeout_seconds",360)
-    text_pattern = re.compile(r'[ab]0:"((?:\\.|[^"\\])*)"')
-    # 新增：用于匹配和提取图片URL的正则表达式
-    image_pattern = re.compile(r'[ab]2:(\[.*?\])')
-    finish_pattern = re.compile(r'[ab]d:(\{.*?"finishReason".*?\})')
-    error_pattern = re.compile(r'(\{\s*"error".*?\})', re.DOTALL)
-    cloudflare_patterns = [r'<title>Just a moment...</title>', r'Enable JavaScript and cookies to continue']
+    parser = LMArenaStreamParser()
+    timeout = timeout or CONFIG.get("stream_response_timeout_seconds",360)
+    # 会话结果：True 成功，False 计为会话失败，None 表示与会话无关（如客户端断开）
+    session_ok, session_error = None, None
+    first_content = True
+    # 指标中的请求结果；生成器被提前关闭（客户端断开）时保持默认值
+    outcome = 'client_disconnect'
+    # 模型名来自客户端，未知模型归为 other，避免指标标签无限增长
+    model = model if model in MODEL_NAME_TO_ID_MAP else "other"
+    content_parts = [] if cache_key else None
+    finish_reason = 'stop'
+    # 标签页已发来 [DONE] 或错误（它自己结束了请求）；否则结束时需要通知它取消
+    tab_finished = False
+    first_chunk = True
 
     try:
         while True:
@@ -626,131 +779,267 @@ async def _process_lmarena_stream(request_id: str):
                 raw_data = await asyncio.wait_for(queue.get(), timeout=timeout)
             except asyncio.TimeoutError:
                 logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: 等待浏览器数据超时（{timeout}秒）。")
+                session_ok, session_error = False, f'timeout after {timeout}s'
+                outcome = 'timeout'
                 yield 'error', f'Response timed out after {timeout} seconds.'
                 return
 
             # 1. 检查来自 WebSocket 端的直接错误或终止信号
             if isinstance(raw_data, dict) and 'error' in raw_data:
+                tab_finished = True
                 error_msg = raw_data.get('error', 'Unknown browser error')
                 
                 # 增强错误处理
-                if isinstance(error_msg, str):
-                    # 1. 检查 413 附件过大错误
-                    if '413' in error_msg or 'too large' in error_msg.lower():
-                        friendly_error_msg = "上传失败：附件大小超过了 LMArena 服务器的限制 (通常是 5MB左右)。请尝试压缩文件或上传更小的文件。"
-                        logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: 检测到附件过大错误 (413)。")
-                        yield 'error', friendly_error_msg
-                        return
-
-                    # 2. 检查 Cloudflare 验证页面
-                    if any(re.search(p, error_msg, re.IGNORECASE) for p in cloudflare_patterns):
-                        friendly_error_msg = "检测到 Cloudflare 人机验证页面。请在浏览器中刷新 LMArena 页面并手动完成验证，然后重试请求。"
-                        if browser_ws:
-                            try:
-                                await browser_ws.send_text(json.dumps({"command": "refresh"}, ensure_ascii=False))
-                                logger.info(f"PROCESSOR [ID: {request_id[:8]}]: 在错误消息中检测到CF并已发送刷新指令。")
-                            except Exception as e:
-                                logger.error(f"PROCESSOR [ID: {request_id[:8]}]: 发送刷新指令失败: {e}")
-                        yield 'error', friendly_error_msg
-                        return
-
-                # 3. 其他未知错误
-                yield 'error', error_msg
-                return
-            if raw_data == "[DONE]":
-                break
+                error_kind = classify_browser_error(error_msg)
+                # 1. 检查 413 附件过大错误
+                if error_kind == 'attachment_too_large':
+                    friendly_error_msg = "上传失败：附件大小超过了 LMArena 服务器的限制 (通常是 5MB左右)。请尝试压缩文件或上传更小的文件。"
+                    logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: 检测到附件过大错误 (413)。")
+                    outcome = 'attachment_too_large'
+                    yield 'error', friendly_error_msg
+                    return
 
-            buffer += "".join(str(item) for item in raw_data) if isinstance(raw_data, list) else raw_data
+                # 2. 检查 Cloudflare 验证页面
+                if error_kind == 'cloudflare':
+                    friendly_error_msg = "检测到 Cloudflare 人机验证页面。请在浏览器中刷新 LMArena 页面并手动完成验证，然后重试请求。"
+                    outcome = 'cloudflare'
+                    await _refresh_owner_tab(request_id)
+                    yield 'error', friendly_error_msg
+                    return
 
-            if any(re.search(p, buffer, re.IGNORECASE) for p in cloudflare_patterns):
-                error_msg = "检测到 Cloudflare 人机验证页面。请在浏览器中刷新 LMArena 页面并手动完成验证，然后重试请求。"
-                if browser_ws:
-                    try:
-                        await browser_ws.send_text(json.dumps({"command": "refresh"}, ensure_ascii=False))
-                        logger.info(f"PROCESSOR [ID: {request_id[:8]}]: 已向浏览器发送页面刷新指令。")
-                    except Exception as e:
-                        logger.error(f"PROCESSOR [ID: {request_id[:8]}]: 发送刷新指令失败: {e}")
+                # 3. 其他未知错误（标签页断开、客户端读取过慢与会话本身无关，不计入会话失败）
+                if error_msg == CHANNEL_OVERFLOW_ERROR:
+                    outcome = 'buffer_overflow'
+                    logger.warning(f"PROCESSOR [ID: {request_id[:8]}]: 响应缓冲区超过上限（{queue.max_bytes // 1024}KB），标签页未响应暂停指令，请求已中止。")
+                elif error_msg == BROWSER_DISCONNECTED_ERROR:
+                    outcome = 'browser_disconnect'
+                elif error_kind == 'rate_limited':
+                    outcome = 'rate_limited'
+                    session_ok, session_error = False, error_msg
+                else:
+                    outcome = 'browser_error'
+                    session_ok, session_error = False, error_msg
                 yield 'error', error_msg
                 return
-            
-            if (error_match := error_pattern.search(buffer)):
-                try:
-                    error_json = json.loads(error_match.group(1))
-                    yield 'error', error_json.get("error", "来自 LMArena 的未知错误")
-                    return
-                except json.JSONDecodeError: pass
-
-            # 优先处理文本内容
-            while (match := text_pattern.search(buffer)):
-                try:
-                    text_content = json.loads(f'"{match.group(1)}"')
-                    if text_content: yield 'content', text_content
-                except (ValueError, json.JSONDecodeError): pass
-                buffer = buffer[match.end():]
 
-            # 新增：处理图片内容
-            while (match := image_pattern.search(buffer)):
-                try:
-                    image_data_list = json.loads(match.group(1))
-                    if isinstance(image_data_list, list) and image_data_list:
-                        image_info = image_data_list[0]
-                        if image_info.get("type") == "image" and "image" in image_info:
-                            # 将URL包装成Markdown格式并作为内容块yield
-                            markdown_image = f"![Image]({image_info['image']})"
-                            yield 'content', markdown_image
-                except (json.JSONDecodeError, IndexError) as e:
-                    logger.warning(f"解析图片URL时出错: {e}, buffer: {buffer[:150]}")
-                buffer = buffer[match.end():]
-
-            if (finish_match := finish_pattern.search(buffer)):
-                try:
-                    finish_data = json.loads(finish_match.group(1))
-                    yield 'finish', finish_data.get("finishReason", "stop")
-                except (json.JSONDecodeError, IndexError): pass
-                buffer = buffer[finish_match.end():]
+            # 2. 增量解析：只处理新到达的数据，[DONE] 时处理残留的半条记录
+            is_done = raw_data == "[DONE]"
+            if is_done:
+                tab_finished = True
+                events = parser.close()
+            else:
+                if first_chunk:
+                    first_chunk = False
+                    TRACER.get(request_id).mark("first_browser_byte", request_id=request_id[:8])
+                if queue.last_gap is not None:
+                    METRICS.inter_chunk.labels(model).observe(queue.last_gap)
+                events = parser.feed("".join(str(item) for item in raw_data) if isinstance(raw_data, list) else raw_data)
+
+            for event_type, value in events:
+                if event_type == 'cloudflare':
+                    error_msg = "检测到 Cloudflare 人机验证页面。请在浏览器中刷新 LMArena 页面并手动完成验证，然后重试请求。"
+                    outcome = 'cloudflare'
+                    await _refresh_owner_tab(request_id)
+                    yield 'error', error_msg
+                    return
+                if event_type == 'error':
+                    session_ok, session_error = False, value or "来自 LMArena 的未知错误"
+                    outcome = 'lmarena_error'
+                    yield 'error', value or "来自 LMArena 的未知错误"
+                    return
+                if event_type == 'content':
+                    if first_content:
+                        first_content = False
+                        SESSION_POOL.first_token(request_id)
+                        ttft = time.monotonic() - queue.created_at
+                        METRICS.ttft.labels(model).observe(ttft)
+                        HEDGES.record_ttft(model, ttft)
+                    if content_parts is not None:
+                        content_parts.append(value)
+                elif event_type == 'finish':
+                    finish_reason = value
+                    if value == 'content-filter':
+                        outcome = 'content_filter'
+                yield event_type, value
+
+            if is_done:
+                session_ok = True
+                if outcome != 'content_filter':
+                    outcome = 'success'
+                    if content_parts:
+                        RESPONSE_CACHE.put(cache_key, content_parts, finish_reason)
+                break
 
     except asyncio.CancelledError:
         logger.info(f"PROCESSOR [ID: {request_id[:8]}]: 任务被取消。")
     finally:
+        if outcome == 'client_disconnect' and report and report.get('closed_as'):
+            outcome = report['closed_as']
+        if not tab_finished:
+            worker = WORKER_POOL.owner(request_id)
+            if worker is not None:
+                CANCELS.cancel(worker, request_id, outcome)
+                logger.info(f"PROCESSOR [ID: {request_id[:8]}]: 请求已结束（{outcome}），通知标签页 {worker.worker_id} 取消。")
+        WORKER_POOL.release(request_id)
+        ADMISSION.release(request_id)
+        SESSION_POOL.end(request_id, session_ok, session_error)
+        METRICS.requests.labels(model, outcome).inc()
+        METRICS.duration.labels(model).observe(time.monotonic() - queue.created_at)
+        CAPTURE.end(request_id, outcome)
+        TRACER.get(request_id).mark("stream_end", request_id=request_id[:8], outcome=outcome)
+        if report is not None:
+            report['outcome'] = outcome
         if request_id in response_channels:
             del response_channels[request_id]
             logger.info(f"PROCESSOR [ID: {request_id[:8]}]: 响应通道已清理。")
 
-async def stream_generator(request_id: str, model: str):
+def _response_events(request_id: str, model: str, cache_key: str = None, dispatch: dict = None):
+    """
+    请求的事件流。提供 dispatch（重新分发所需的信息，见 _dispatch_again）时：
+    首个内容块之前的失败会透明地换标签页/会话重试；dispatch["hedge_delay"] 不为 None 时开启对冲。
+    """
+    report = {}
+    events = _process_lmarena_stream(request_id, model=model, cache_key=cache_key, report=report)
+    if dispatch is None:
+        return events
+    if dispatch["hedge_delay"] is not None:
+        events = with_hedge(events, report, lambda: _dispatch_again(dispatch, 'hedge'), dispatch["hedge_delay"], HEDGES)
+    return with_failover(events, report, lambda outcome, remaining: _dispatch_again(dispatch, outcome, remaining),
+                         *failover_settings(CONFIG))
+
+async def _send_to_tab(request_id: str, worker: BrowserWorker, payload: dict, model_name: str, mapping: dict = None):
+    """为已准入的请求创建响应通道并把载荷发送给标签页；发送失败时清理后重新抛出异常。"""
+    response_channels[request_id] = _new_response_channel(request_id)
+    if mapping:
+        SESSION_POOL.begin(request_id, model_name, mapping)
+    logger.info(f"API CALL [ID: {request_id[:8]}]: 已创建响应通道，分配给标签页 {worker.worker_id} (负载: {worker.in_flight}/{worker.max_concurrency})。")
+    try:
+        # 通过 WebSocket 发送（协议 v2 为二进制帧，否则为 JSON 文本帧）
+        logger.info(f"API CALL [ID: {request_id[:8]}]: 正在通过 WebSocket 发送载荷到油猴脚本。")
+        CAPTURE.begin(request_id, model_name, payload, worker.worker_id, worker.protocol)
+        started = time.perf_counter()
+        await worker.send_request(request_id, payload)
+        TRACER.get(request_id).span("ws_send", started, request_id=request_id[:8], tab=worker.worker_id, protocol=worker.protocol)
+    except Exception:
+        CAPTURE.discard(request_id)
+        WORKER_POOL.release(request_id)
+        ADMISSION.release(request_id)
+        SESSION_POOL.end(request_id, None)
+        response_channels.pop(request_id, None)
+        raise
+
+async def _dispatch_again(dispatch: dict, reason: str, remaining: float = None):
+    """
+    把同一个请求再发一次：首个内容块之前失败后的重试（modules/failover.py，reason 为上一次的结果），
+    或对冲（modules/hedging.py，reason 为 'hedge'，remaining 为 None，只使用空闲容量、不排队）。
+    尽量换一个标签页；模型映射中有未用过的会话时也换一个会话（重新转换载荷），否则沿用原来转换好的载荷。
+    无法准入或发送失败时返回 None，否则返回新请求的 (events, report)。
+    """
+    model_name = dispatch["model"]
+    mapping, payload = dispatch["mapping"], dispatch["payload"]
+    if mapping and dispatch["entries"]:
+        candidate = SESSION_POOL.choose(model_name, dispatch["entries"], avoid=dispatch["sessions"])
+        if (candidate and candidate.get("session_id") not in dispatch["sessions"]
+                and candidate.get("session_id") and candidate.get("message_id")):
+            mapping = candidate
+            payload = convert_openai_to_lmarena_payload(
+                dispatch["openai_req"], mapping["session_id"], mapping["message_id"],
+                mode_override=mapping.get("mode"), battle_target_override=mapping.get("battle_target"),
+                snapshot=dispatch["snapshot"])
+
+    request_id = str(uuid.uuid4())
+    model_key = model_name or "default_model"
+    if remaining is None:
+        worker = ADMISSION.try_acquire(request_id, model_key, avoid=dispatch["tabs"])
+        if worker is None:
+            logger.info(f"HEDGE [ID: {request_id[:8]}]: 没有空闲容量，跳过对冲。")
+            return None
+    else:
+        try:
+            worker = await asyncio.wait_for(ADMISSION.acquire(request_id, model_key, avoid=dispatch["tabs"]), timeout=remaining)
+        except (AdmissionRejected, asyncio.TimeoutError) as e:
+            logger.warning(f"FAILOVER [ID: {request_id[:8]}]: 预算内无法重新分发（{reason}）: {str(e) or '等待超时'}")
+            return None
+    TRACER.bind(dispatch["trace"], request_id)
+    dispatch["trace"].mark("hedge" if reason == 'hedge' else "failover", request_id=request_id[:8], reason=reason, tab=worker.worker_id)
+    try:
+        await _send_to_tab(request_id, worker, payload, model_name, mapping)
+    except Exception as e:
+        logger.error(f"FAILOVER [ID: {request_id[:8]}]: 重新分发失败: {e}")
+        return None
+    session_tail = str(mapping.get('session_id'))[-6:] if mapping else '默认'
+    if reason == 'hedge':
+        logger.info(f"HEDGE [ID: {request_id[:8]}]: {dispatch['hedge_delay']:.1f} 秒内没有收到内容，"
+                    f"已向标签页 {worker.worker_id}（会话 ...{session_tail}）发出对冲请求。")
+    else:
+        METRICS.failovers.labels(reason).inc()
+        logger.info(f"FAILOVER [ID: {request_id[:8]}]: 上一次尝试在首个内容块之前失败（{reason}），"
+                    f"已重新分发给标签页 {worker.worker_id}（会话 ...{session_tail}）。")
+    dispatch["tabs"].add(worker.worker_id)
+    if mapping:
+        dispatch["sessions"].add(mapping.get("session_id"))
+    dispatch["mapping"], dispatch["payload"] = mapping, payload
+    report = {}
+    events = _process_lmarena_stream(request_id, model=dispatch["response_model"], cache_key=dispatch["cache_key"], report=report)
+    return events, report
+
+async def stream_generator(request_id: str, model: str, cache_key: str = None, dispatch: dict = None):
     """将内部事件流格式化为 OpenAI SSE 响应。"""
-    response_id = f"chatcmpl-{uuid.uuid4()}"
+    encoder = ChunkEncoder(f"chatcmpl-{uuid.uuid4()}", model)
     logger.info(f"STREAMER [ID: {request_id[:8]}]: 流式生成器启动。")
     
     finish_reason_to_send = 'stop'  # 默认的结束原因
+    trace = TRACER.get(request_id)
+    first_write = True
+    ended_with = 'client_disconnect'  # 记录到 trace 的结束方式；生成器被提前关闭时保持默认值
+
+    events = _response_events(request_id, model, cache_key, dispatch)
+    window, max_bytes = coalesce_settings(CONFIG)
+    if window > 0:
+        # 把时间窗口内到达的内容增量合并为一个 SSE 事件，减少 json.dumps 与写出次数
+        events = coalesce_content(events, window, max_bytes)
+    try:
+        async for event_type, data in events:
+            if event_type == 'content':
+                if first_write:
+                    first_write = False
+                    trace.mark("first_sse_write")
+                yield encoder.content_bytes(data)
+            elif event_type == 'finish':
+                # 记录结束原因，但不要立即返回，等待浏览器发送 [DONE]
+                finish_reason_to_send = data
+                if data == 'content-filter':
+                    warning_msg = "\n\n响应被终止，可能是上下文超限或者模型内部审查（大概率）的原因"
+                    yield encoder.content(warning_msg)
+            elif event_type == 'error':
+                logger.error(f"STREAMER [ID: {request_id[:8]}]: 流中发生错误: {data}")
+                ended_with = 'error'
+                yield format_openai_error_chunk(str(data), encoder)
+                yield format_openai_finish_chunk(encoder, reason='stop')
+                return # 发生错误时，可以立即终止
+
+        # 只有在 _process_lmarena_stream 自然结束后 (即收到 [DONE]) 才执行
+        ended_with = finish_reason_to_send
+        yield format_openai_finish_chunk(encoder, reason=finish_reason_to_send)
+        logger.info(f"STREAMER [ID: {request_id[:8]}]: 流式生成器正常结束。")
+    finally:
+        TRACER.end(trace, ended_with=ended_with)
 
-    async for event_type, data in _process_lmarena_stream(request_id):
-        if event_type == 'content':
-            yield format_openai_chunk(data, model, response_id)
-        elif event_type == 'finish':
-            # 记录结束原因，但不要立即返回，等待浏览器发送 [DONE]
-            finish_reason_to_send = data
-            if data == 'content-filter':
-                warning_msg = "\n\n响应被终止，可能是上下文超限或者模型内部审查（大概率）的原因"
-                yield format_openai_chunk(warning_msg, model, response_id)
-        elif event_type == 'error':
-            logger.error(f"STREAMER [ID: {request_id[:8]}]: 流中发生错误: {data}")
-            yield format_openai_error_chunk(str(data), model, response_id)
-            yield format_openai_finish_chunk(model, response_id, reason='stop')
-            return # 发生错误时，可以立即终止
-
-    # 只有在 _process_lmarena_stream 自然结束后 (即收到 [DONE]) 才执行
-    yield format_openai_finish_chunk(model, response_id, reason=finish_reason_to_send)
-    logger.info(f"STREAMER [ID: {request_id[:8]}]: 流式生成器正常结束。")
-
-async def non_stream_response(request_id: str, model: str):
-    """聚合内部事件流并返回单个 OpenAI JSON 响应。"""
+async def non_stream_response(request_id: str, model: str, cache_key: str = None, is_disconnected=None, dispatch: dict = None):
+    """
+    聚合内部事件流并返回单个 OpenAI JSON 响应。
+    提供 is_disconnected（如 request.is_disconnected）时，客户端在聚合期间断开会立即结束请求并通知标签页取消。
+    """
     response_id = f"chatcmpl-{uuid.uuid4()}"
     logger.info(f"NON-STREAM [ID: {request_id[:8]}]: 开始处理非流式响应。")
     
     full_content = []
     finish_reason = "stop"
+    events = _response_events(request_id, model, cache_key, dispatch)
+    if is_disconnected is not None:
+        events = until_disconnected(events, is_disconnected)
     
-    async for event_type, data in _process_lmarena_stream(request_id):
+    async for event_type, data in events:
         if event_type == 'content':
             full_content.append(data)
         elif event_type == 'finish':
@@ -771,54 +1060,155 @@ async def non_stream_response(request_id: str, model: str):
                     "code": "attachment_too_large" if status_code == 413 else "processing_error"
                 }
             }
-            return Response(content=json.dumps(error_response, ensure_ascii=False), status_code=status_code, media_type="application/json")
+            return Response(content=json_dumps_bytes(error_response), status_code=status_code, media_type="application/json")
+        elif event_type == 'client_disconnected':
+            logger.info(f"NON-STREAM [ID: {request_id[:8]}]: 客户端已断开，停止等待响应。")
+            return Response(status_code=499)
 
     final_content = "".join(full_content)
     response_data = format_openai_non_stream_response(final_content, model, response_id, reason=finish_reason)
     
     logger.info(f"NON-STREAM [ID: {request_id[:8]}]: 响应聚合完成。")
-    return Response(content=json.dumps(response_data, ensure_ascii=False), media_type="application/json")
+    return Response(content=json_dumps_bytes(response_data), media_type="application/json")
+
+async def cached_stream_generator(cached: CachedResponse, model: str):
+    """把缓存的响应按原来的内容块重放为 OpenAI SSE 响应。"""
+    encoder = ChunkEncoder(f"chatcmpl-{uuid.uuid4()}", model)
+    for part in cached.parts:
+        yield encoder.content_bytes(part)
+    yield format_openai_finish_chunk(encoder, reason=cached.finish_reason)
+
+def cached_non_stream_response(cached: CachedResponse, model: str) -> Response:
+    """用缓存的响应构建非流式 OpenAI JSON 响应。"""
+    response_data = format_openai_non_stream_response(cached.content, model, f"chatcmpl-{uuid.uuid4()}", reason=cached.finish_reason)
+    return Response(content=json_dumps_bytes(response_data), media_type="application/json",
+                    headers={BYPASS_HEADER: "hit"})
 
 # --- WebSocket 端点 ---
+async def _evict_unresponsive_tab(worker: BrowserWorker):
+    """连续心跳无应答：立即注销该标签页并让它负责的请求失败，不必等待请求超时，然后关闭连接。"""
+    METRICS.tab_evictions.inc()
+    orphaned = WORKER_POOL.unregister(worker)
+    logger.warning(f"💤 标签页 {worker.worker_id} 连续 {worker.missed_heartbeats} 次心跳无应答"
+                   f"（最后活动于 {time.time() - worker.last_seen:.0f} 秒前），判定为失效，受影响的请求: {len(orphaned)}。")
+    for request_id in orphaned:
+        if request_id in response_channels:
+            CAPTURE.chunk(request_id, {"error": BROWSER_DISCONNECTED_ERROR})
+            await response_channels[request_id].put({"error": BROWSER_DISCONNECTED_ERROR})
+    await worker.close()
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    """处理来自油猴脚本的 WebSocket 连接。"""
-    global browser_ws
+    """
+    处理来自油猴脚本的 WebSocket 连接。
+    每个标签页通过查询参数声明自己的 ID 与并发上限：/ws?tab_id=...&max_concurrency=...
+    旧版脚本未提供这些参数时，将自动分配 ID 并使用配置中的默认并发上限。
+    脚本带有 protocol=2 时使用二进制帧协议（见 modules/ws_protocol.py），否则使用 v1 的 JSON 文本帧。
+    """
     await websocket.accept()
-    if browser_ws is not None:
-        logger.warning("检测到新的油猴脚本连接，旧的连接将被替换。")
-    logger.info("✅ 油猴脚本已成功连接 WebSocket。")
-    browser_ws = websocket
+    params = websocket.query_params
+    try:
+        max_concurrency = int(params.get("max_concurrency") or CONFIG.get("tab_max_concurrency", DEFAULT_MAX_CONCURRENCY))
+    except ValueError:
+        max_concurrency = CONFIG.get("tab_max_concurrency", DEFAULT_MAX_CONCURRENCY)
+    ws_bytes_out = METRICS.ws_bytes.labels("out")
+    protocol, compress = negotiate(params, CONFIG.get("ws_protocol_v2_enabled", True))
+    codec = None
+    if protocol == PROTOCOL_V2:
+        codec = StreamCodec(compress, int(CONFIG.get("ws_compress_min_kb", DEFAULT_COMPRESS_MIN_BYTES // 1024)) * 1024)
+        await websocket.send_text(json.dumps(hello_message()))
+    worker = BrowserWorker(
+        params.get("tab_id") or WorkerPool.new_worker_id(),
+        metered_send(websocket.send_text, ws_bytes_out),
+        max_concurrency=max_concurrency,
+        close=websocket.close,
+        send_bytes=metered_send(websocket.send_bytes, ws_bytes_out),
+        codec=codec,
+        # 声明 attachments=ref 的脚本会自行取回附件，否则发送前还原为 data URL
+        attachment_store=None if params.get("attachments") == "ref" else ATTACHMENT_STORE,
+        # 声明 reconnect=drain 的脚本收到 reconnect 后保留旧连接完成已有请求，重启时可以立即连接新进程
+        drain_reconnect=params.get("reconnect") == "drain",
+        # 声明 heartbeat=1 的脚本应答应用层心跳，连续无应答时会被判定为失效（见 modules/heartbeat.py）
+        heartbeat=params.get("heartbeat") == "1",
+    )
+    replaced = WORKER_POOL.register(worker)
+    if replaced is not None:
+        logger.warning(f"标签页 {worker.worker_id} 重复连接，旧的连接将被替换。")
+        await replaced.close()
+    ADMISSION.dispatch() # 新的容量：放行排队中的请求
+    ws_bytes_in = METRICS.ws_bytes.labels("in")
+    logger.info(f"✅ 油猴脚本已成功连接 WebSocket (标签页: {worker.worker_id}, 协议: v{worker.protocol}, 并发上限: {worker.max_concurrency}, 当前标签页数: {len(WORKER_POOL)})。")
+    heartbeat_task = None
+    if worker.heartbeat:
+        heartbeat_task = asyncio.create_task(run_heartbeat(worker, lambda: heartbeat_settings(CONFIG), _evict_unresponsive_tab))
     try:
         while True:
             # 等待并接收来自油猴脚本的消息
-            message_str = await websocket.receive_text()
-            message = json.loads(message_str)
-            
-            request_id = message.get("request_id")
-            data = message.get("data")
-
-            if not request_id or data is None:
-                logger.warning(f"收到来自浏览器的无效消息: {message}")
-                continue
-
-            # 将收到的数据放入对应的响应通道
-            if request_id in response_channels:
-                await response_channels[request_id].put(data)
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            worker.touch()
+            frame = message.get("bytes")
+            if frame is not None:
+                # 协议 v2：一个二进制帧可能携带多个请求的数据块
+                ws_bytes_in.inc(len(frame))
+                if codec is None:
+                    logger.warning(f"标签页 {worker.worker_id} 未协商协议 v2，忽略二进制帧。")
+                    continue
+                try:
+                    items = codec.decode(frame)
+                except ValueError as e:
+                    logger.warning(f"标签页 {worker.worker_id} 发来无法解析的二进制帧: {e}")
+                    continue
             else:
-                logger.warning(f"⚠️ 收到未知或已关闭请求的响应: {request_id}")
+                message_str = message.get("text") or ""
+                ws_bytes_in.inc(utf8_len(message_str))
+                message = json_loads(message_str)
+                seq = pong_seq(message)
+                if seq is not None:
+                    recovered = worker.missed_heartbeats > 0
+                    worker.record_pong(seq)
+                    if recovered and not worker.missed_heartbeats:
+                        logger.info(f"标签页 {worker.worker_id} 恢复响应。")
+                        ADMISSION.dispatch()
+                    continue
+                cancelled_id = ack_request_id(message)
+                if cancelled_id is not None:
+                    latency = CANCELS.ack(cancelled_id)
+                    if latency is not None:
+                        METRICS.cancel_latency.observe(latency)
+                        logger.info(f"标签页 {worker.worker_id} 已取消请求 {cancelled_id[:8]}（延迟 {latency * 1000:.0f}ms）。")
+                    continue
+                items = [(message.get("request_id"), message.get("data"))]
+
+            for request_id, data in items:
+                if not request_id or data is None:
+                    logger.warning(f"收到来自浏览器的无效消息 (request_id: {request_id})。")
+                    continue
+
+                # 将收到的数据放入对应的响应通道
+                if request_id in response_channels:
+                    CAPTURE.chunk(request_id, data)
+                    await response_channels[request_id].put(data)
+                elif CANCELS.is_cancelled(request_id):
+                    CANCELS.late_chunk() # 取消指令到达标签页之前已发出的数据
+                else:
+                    logger.warning(f"⚠️ 收到未知或已关闭请求的响应: {request_id}")
 
     except WebSocketDisconnect:
-        logger.warning("❌ 油猴脚本客户端已断开连接。")
+        logger.warning(f"❌ 油猴脚本客户端已断开连接 (标签页: {worker.worker_id})。")
     except Exception as e:
         logger.error(f"WebSocket 处理时发生未知错误: {e}", exc_info=True)
     finally:
-        browser_ws = None
-        # 清理所有等待的响应通道，以防请求被挂起
-        for queue in response_channels.values():
-            await queue.put({"error": "Browser disconnected during operation"})
-        response_channels.clear()
-        logger.info("WebSocket 连接已清理。")
+        if heartbeat_task:
+            heartbeat_task.cancel()
+        # 只清理由该标签页负责的响应通道，其他标签页上的请求不受影响
+        orphaned = WORKER_POOL.unregister(worker)
+        for request_id in orphaned:
+            if request_id in response_channels:
+                CAPTURE.chunk(request_id, {"error": BROWSER_DISCONNECTED_ERROR})
+                await response_channels[request_id].put({"error": BROWSER_DISCONNECTED_ERROR})
+        logger.info(f"WebSocket 连接已清理 (标签页: {worker.worker_id}, 受影响的请求: {len(orphaned)}, 剩余标签页: {len(WORKER_POOL)})。")
 
 # --- OpenAI 兼容 API 端点 ---
 @app.get("/v1/models")
@@ -849,13 +1239,14 @@ async def request_model_update():
     接收来自 model_updater.py 的请求，并通过 WebSocket 指令
     让油猴脚本发送页面源码。
     """
-    if not browser_ws:
+    worker = WORKER_POOL.any()
+    if not worker:
         logger.warning("MODEL UPDATE: 收到更新请求，但没有浏览器连接。")
         raise HTTPException(status_code=503, detail="Browser client not connected.")
     
     try:
-        logger.info("MODEL UPDATE: 收到更新请求，正在通过 WebSocket 发送指令...")
-        await browser_ws.send_text(json.dumps({"command": "send_page_source"}))
+        logger.info(f"MODEL UPDATE: 收到更新请求，正在通过 WebSocket 向标签页 {worker.worker_id} 发送指令...")
+        await worker.send_json({"command": "send_page_source"})
         logger.info("MODEL UPDATE: 'send_page_source' 指令已成功发送。")
         return JSONResponse({"status": "success", "message": "Request to send page source sent."})
     except Exception as e:
@@ -876,11 +1267,16 @@ async def update_available_models_endpoint(request: Request):
         )
     
     logger.info("收到来自油猴脚本的页面内容，开始提取可用模型...")
-    new_models_list = extract_models_from_html(html_content.decode('utf-8'))
+    # 页面有几 MB，提取与写文件放到工作线程中，不阻塞事件循环
+    new_models_list, diff = await asyncio.to_thread(update_available_models, html_content)
     
     if new_models_list:
-        save_available_models(new_models_list)
-        return JSONResponse({"status": "success", "message": "Available models file updated."})
+        logger.info(f"模型变化: 新增 {len(diff['added'])} 个，移除 {len(diff['removed'])} 个，内容变化 {len(diff['changed'])} 个。")
+        if diff["added"]:
+            logger.info(f"  新增: {', '.join(diff['added'])}")
+        if diff["removed"]:
+            logger.info(f"  移除: {', '.join(diff['removed'])}")
+        return JSONResponse({"status": "success", "message": "Available models file updated.", "count": len(new_models_list), "diff": diff})
     else:
         logger.error("未能从油猴脚本提供的 HTML 中提取模型数据。")
         return JSONResponse(
@@ -900,13 +1296,30 @@ async def chat_completions(request: Request):
     last_activity_time = datetime.now() # 更新活动时间
     logger.info(f"API请求已收到，活动时间已更新为: {last_activity_time.strftime('%Y-%m-%d %H:%M:%S')}")
 
+    # 整个请求使用同一个配置快照（配置文件由后台任务监视，变化时才重新解析）
+    snapshot = CONFIG_STORE.snapshot
+    config = snapshot.config
+    trace = TRACER.begin()
+
+    # 流式读取请求体：超过上限立即返回 413，data URL 附件边读边存入附件存储
+    max_body_bytes, memory_budget = limits_from_config(config)
+    started = time.perf_counter()
     try:
-        openai_req = await request.json()
-    except json.JSONDecodeError:
+        check_content_length(request.headers.get("content-length"), max_body_bytes)
+        openai_req, ingest_stats = await ingest_json(request.stream(), ATTACHMENT_STORE, max_body_bytes, memory_budget)
+    except BodyTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError:
         raise HTTPException(status_code=400, detail="无效的 JSON 请求体")
+    if not isinstance(openai_req, dict):
+        raise HTTPException(status_code=400, detail="无效的 JSON 请求体")
+    if ingest_stats["spilled"]:
+        logger.info(f"请求体 {ingest_stats['bytes'] / 1024 / 1024:.1f} MB，{ingest_stats['spilled']} 个附件已转存到临时文件。")
+    trace.span("parse", started, bytes=ingest_stats["bytes"], spilled=ingest_stats["spilled"])
 
     model_name = openai_req.get("model")
-    model_info = MODEL_NAME_TO_ID_MAP.get(model_name, {}) # 关键修复：如果模型未找到，返回一个空字典而不是None
+    trace.set(model=model_name, stream=bool(openai_req.get("stream", False)))
+    model_info = snapshot.models.get(model_name, {}) # 关键修复：如果模型未找到，返回一个空字典而不是None
     model_type = model_info.get("type", "text") # 默认为 text
 
     # --- 新增：基于模型类型的判断逻辑 ---
@@ -919,9 +1332,8 @@ async def chat_completions(request: Request):
     # --- 文生图逻辑结束 ---
 
     # 如果不是图像模型，则执行正常的文本生成逻辑
-    load_config()  # 实时加载最新配置，确保会话ID等信息是最新的
     # --- API Key 验证 ---
-    api_key = CONFIG.get("api_key")
+    api_key = config.get("api_key")
     if api_key:
         auth_header = request.headers.get('Authorization')
         if not auth_header or not auth_header.startswith('Bearer '):
@@ -937,22 +1349,19 @@ async def chat_completions(request: Request):
                 detail="提供的 API Key 不正确。"
             )
 
-    if not browser_ws:
-        raise HTTPException(status_code=503, detail="油猴脚本客户端未连接。请确保 LMArena 页面已打开并激活脚本。")
-
     # --- 模型与会话ID映射逻辑 ---
     session_id, message_id = None, None
     mode_override, battle_target_override = None, None
+    selected_mapping = None
 
-    if model_name and model_name in MODEL_ENDPOINT_MAP:
-        mapping_entry = MODEL_ENDPOINT_MAP[model_name]
-        selected_mapping = None
+    if model_name and model_name in snapshot.endpoint_map:
+        mapping_entry = snapshot.endpoint_map[model_name]
 
-        if isinstance(mapping_entry, list) and mapping_entry:
-            selected_mapping = random.choice(mapping_entry)
-            logger.info(f"为模型 '{model_name}' 从ID列表中随机选择了一个映射。")
-        elif isinstance(mapping_entry, dict):
-            selected_mapping = mapping_entry
+        # 由会话池按健康度与负载选择（跳过冷却中的会话）
+        selected_mapping = SESSION_POOL.choose(model_name, mapping_entry)
+        if isinstance(mapping_entry, list) and selected_mapping:
+            logger.info(f"为模型 '{model_name}' 从 {len(mapping_entry)} 个映射中按健康度与负载选择了一个会话。")
+        elif selected_mapping:
             logger.info(f"为模型 '{model_name}' 找到了单个端点映射（旧格式）。")
         
         if selected_mapping:
@@ -971,9 +1380,10 @@ async def chat_completions(request: Request):
 
     # 如果经过以上处理，session_id 仍然是 None，则进入全局回退逻辑
     if not session_id:
-        if CONFIG.get("use_default_ids_if_mapping_not_found", True):
-            session_id = CONFIG.get("session_id")
-            message_id = CONFIG.get("message_id")
+        selected_mapping = None
+        if config.get("use_default_ids_if_mapping_not_found", True):
+            session_id = config.get("session_id")
+            message_id = config.get("message_id")
             # 当使用全局ID时，不设置模式覆盖，让其使用全局配置
             mode_override, battle_target_override = None, None
             logger.info(f"模型 '{model_name}' 未找到有效映射，根据配置使用全局默认 Session ID: ...{session_id[-6:] if session_id else 'N/A'}")
@@ -991,67 +1401,249 @@ async def chat_completions(request: Request):
             detail="最终确定的会话ID或消息ID无效。请检查 'model_endpoint_map.json' 和 'config.jsonc' 中的配置，或运行 `id_updater.py` 来更新默认值。"
         )
 
-    if not model_name or model_name not in MODEL_NAME_TO_ID_MAP:
+    if not model_name or model_name not in snapshot.models:
         logger.warning(f"请求的模型 '{model_name}' 不在 models.json 中，将使用默认模型ID。")
 
-    request_id = str(uuid.uuid4())
-    response_channels[request_id] = asyncio.Queue()
-    logger.info(f"API CALL [ID: {request_id[:8]}]: 已创建响应通道。")
-
+    # 转换请求，传入可能存在的模式覆盖信息（在准入之前完成，以便用载荷查询响应缓存）
+    started = time.perf_counter()
     try:
-        # 1. 转换请求，传入可能存在的模式覆盖信息
         lmarena_payload = convert_openai_to_lmarena_payload(
             openai_req,
             session_id,
             message_id,
             mode_override=mode_override,
-            battle_target_override=battle_target_override
+            battle_target_override=battle_target_override,
+            snapshot=snapshot
         )
-        
-        # 2. 包装成发送给浏览器的消息
-        message_to_browser = {
-            "request_id": request_id,
-            "payload": lmarena_payload
-        }
-        
-        # 3. 通过 WebSocket 发送
-        logger.info(f"API CALL [ID: {request_id[:8]}]: 正在通过 WebSocket 发送载荷到油猴脚本。")
-        await browser_ws.send_text(json.dumps(message_to_browser))
+    except Exception as e:
+        logger.error(f"转换请求时发生错误: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+    trace.span("convert", started, messages=len(lmarena_payload["message_templates"]))
 
-        # 4. 根据 stream 参数决定返回类型
-        is_stream = openai_req.get("stream", False)
+    is_stream = openai_req.get("stream", False)
+    response_model = model_name or "default_model"
 
-        if is_stream:
-            # 返回流式响应
-            return StreamingResponse(
-                stream_generator(request_id, model_name or "default_model"),
-                media_type="text/event-stream"
-            )
+    # --- 响应缓存 ---
+    request_cache_key = None
+    if RESPONSE_CACHE.enabled:
+        if should_bypass(request.headers):
+            RESPONSE_CACHE.record_bypass()
+            METRICS.cache.labels("bypass").inc()
         else:
-            # 返回非流式响应
-            return await non_stream_response(request_id, model_name or "default_model")
+            request_cache_key = cache_key(lmarena_payload, mode_override or config.get("id_updater_last_mode", "direct_chat"))
+            cached, result = await RESPONSE_CACHE.lookup(request_cache_key)
+            METRICS.cache.labels(result).inc()
+            if cached:
+                logger.info(f"模型 '{model_name}' 的请求命中响应缓存 ({result}, 键: {request_cache_key[:12]})。")
+                TRACER.end(trace, ended_with=f"cache_{result}")
+                if is_stream:
+                    return StreamingResponse(cached_stream_generator(cached, response_model), media_type="text/event-stream",
+                                             headers={BYPASS_HEADER: "hit"})
+                return cached_non_stream_response(cached, response_model)
+
+    if not len(WORKER_POOL) and HANDOFF_STARTED_AT is not None:
+        # 刚由重启接管：标签页正在从旧进程重连，稍等片刻而不是立即返回 503
+        remaining = HANDOFF_STARTED_AT + CONFIG.get("restart_tab_wait_seconds", 10) - time.monotonic()
+        if remaining > 0:
+            await wait_until(lambda: len(WORKER_POOL), remaining, 0.05)
+    if not len(WORKER_POOL):
+        raise HTTPException(status_code=503, detail="油猴脚本客户端未连接。请确保 LMArena 页面已打开并激活脚本。")
+
+    request_id = str(uuid.uuid4())
+    # 准入控制：获得一个有空闲容量的标签页（已完成分配），或排队等待，或被快速拒绝
+    started = time.perf_counter()
+    try:
+        worker = await ADMISSION.acquire(request_id, model_name or "default_model")
+    except AdmissionRejected as e:
+        logger.warning(f"API CALL [ID: {request_id[:8]}]: 请求被拒绝 ({e.reason}): {e}")
+        METRICS.rejections.labels(e.reason).inc()
+        trace.span("admission", started, rejected=e.reason)
+        TRACER.end(trace, ended_with=f"rejected_{e.reason}")
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    trace.span("admission", started, tab=worker.worker_id)
+    TRACER.bind(trace, request_id)
+
+    try:
+        # 1. 通过 WebSocket 发送（发送失败时已清理通道）
+        await _send_to_tab(request_id, worker, lmarena_payload, model_name, selected_mapping)
     except Exception as e:
-        # 如果在设置过程中出错，清理通道
-        if request_id in response_channels:
-            del response_channels[request_id]
         logger.error(f"API CALL [ID: {request_id[:8]}]: 处理请求时发生致命错误: {e}", exc_info=True)
+        TRACER.end(trace, ended_with="send_failed", error=str(e))
         raise HTTPException(status_code=500, detail=str(e))
 
+    # 重新分发（首个内容块之前失败时的重试、对冲）所需的信息（见 _dispatch_again）
+    hedge_model = model_name if model_name in snapshot.models else "other"  # 与指标中的模型标签一致
+    dispatch = {
+        "model": model_name, "response_model": response_model, "cache_key": request_cache_key,
+        "openai_req": openai_req, "snapshot": snapshot, "payload": lmarena_payload,
+        "mapping": selected_mapping, "entries": snapshot.endpoint_map.get(model_name) if selected_mapping else None,
+        "tabs": {worker.worker_id}, "sessions": {selected_mapping.get("session_id")} if selected_mapping else set(),
+        "hedge_delay": HEDGES.delay(hedge_model, config) if wants_hedge(request.headers, model_name, config) else None,
+        "trace": trace,
+    }
+
+    # 2. 根据 stream 参数决定返回类型
+    if is_stream:
+        # 返回流式响应
+        return StreamingResponse(
+            stream_generator(request_id, response_model, cache_key=request_cache_key, dispatch=dispatch),
+            media_type="text/event-stream"
+        )
+    else:
+        # 返回非流式响应
+        status_code = 499  # 请求处理被取消（客户端断开）时保持默认值
+        try:
+            response = await non_stream_response(request_id, response_model, cache_key=request_cache_key,
+                                                 is_disconnected=request.is_disconnected, dispatch=dispatch)
+            status_code = response.status_code
+            return response
+        finally:
+            TRACER.end(trace, ended_with=status_code)
+
+async def _probe_session(model_name: str, entry: dict):
+    """
+    会话探测：通过空闲的标签页向指定会话发送一条最短的请求，并把结果记录到 SESSION_POOL。
+    没有空闲标签页时跳过本次探测（真实请求优先）。
+    """
+    worker = WORKER_POOL.pick()
+    if not worker or not worker.has_capacity():
+        return
+    request_id = str(uuid.uuid4())
+    response_channels[request_id] = _new_response_channel(request_id)
+    WORKER_POOL.assign(request_id, worker)
+    SESSION_POOL.begin(request_id, model_name, entry, probe=True)
+    logger.info(f"PROBE [ID: {request_id[:8]}]: 探测模型 '{model_name}' 的会话 ...{str(entry.get('session_id'))[-6:]}（标签页 {worker.worker_id}）。")
+    try:
+        payload = convert_openai_to_lmarena_payload(
+            {"model": model_name, "messages": [{"role": "user", "content": "ping"}]},
+            entry.get("session_id"),
+            entry.get("message_id"),
+            mode_override=entry.get("mode"),
+            battle_target_override=entry.get("battle_target"),
+        )
+        await worker.send_request(request_id, payload)
+    except Exception as e:
+        WORKER_POOL.release(request_id)
+        SESSION_POOL.end(request_id, None)
+        response_channels.pop(request_id, None)
+        logger.warning(f"PROBE [ID: {request_id[:8]}]: 发送探测请求失败: {e}")
+        return
+    async for event_type, data in _process_lmarena_stream(request_id, timeout=60, model=model_name):
+        if event_type == 'error':
+            logger.warning(f"PROBE [ID: {request_id[:8]}]: 会话探测失败: {data}")
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus 文本格式的运行指标。"""
+    return Response(content=METRICS.render(), media_type=METRICS_CONTENT_TYPE)
+
+@app.get("/internal/attachments/{ref}")
+async def get_attachment(ref: str):
+    """油猴脚本按内容哈希取回附件的 data URL（纯文本）。"""
+    headers = {"Cache-Control": "private, max-age=86400, immutable"}
+    path = ATTACHMENT_STORE.path(ref) if is_valid_ref(ref) else None
+    if path is not None:
+        # 转存到临时文件的大附件直接以文件发送，不读入内存
+        return FileResponse(path, media_type="text/plain", headers=headers)
+    data_url = await ATTACHMENT_STORE.get(ref) if is_valid_ref(ref) else None
+    if data_url is None:
+        raise HTTPException(status_code=404, detail="附件不存在或已被淘汰。")
+    return Response(content=data_url, media_type="text/plain", headers=headers)
+
+@app.get("/status")
+async def server_status():
+    """返回标签页列表（含心跳往返时间与最后活动时间）、准入控制和重启状态。"""
+    return JSONResponse({
+        "version": CONFIG.get("version"),
+        "ws_connected": len(WORKER_POOL) > 0,
+        "tabs": WORKER_POOL.status(),
+        "admission": ADMISSION.status(),
+        "restart": {"phase": RESTART_STATE["phase"], "pid": os.getpid()},
+    })
+
+@app.get("/status/cancellations")
+async def cancellation_status():
+    """返回发给标签页的取消指令数（按原因）、已确认数和取消后仍到达的数据块数。"""
+    return JSONResponse(CANCELS.status())
+
+@app.get("/status/hedging")
+async def hedging_status():
+    """返回对冲请求的发出/胜出/跳过次数，以及各模型近期首字延迟样本数和当前的对冲延迟。"""
+    return JSONResponse(HEDGES.status(CONFIG))
+
+@app.get("/status/capture")
+async def capture_status():
+    """返回流量记录的抽样比例、当前文件与写入计数。"""
+    return JSONResponse(CAPTURE.status())
+
+@app.get("/status/context")
+async def context_budget_status():
+    """返回各模型的上下文预算与裁剪计数。"""
+    return JSONResponse(CONTEXT_BUDGET.status())
+
+@app.get("/debug/trace")
+async def debug_trace(limit: int = 0):
+    """以 Chrome trace 格式导出最近请求的各阶段耗时（chrome://tracing 或 ui.perfetto.dev 打开）；limit 限制导出的已结束请求数。"""
+    return Response(content=json_dumps_bytes(TRACER.chrome_trace(limit)), media_type="application/json")
+
+@app.get("/status/cache")
+async def cache_status():
+    """返回响应缓存的条目数、占用量以及命中/未命中计数。"""
+    return JSONResponse(RESPONSE_CACHE.status())
+
+@app.get("/status/admission")
+async def admission_status():
+    """返回准入控制的当前状态：在途请求、排队长度、事件循环延迟和拒绝计数。"""
+    return JSONResponse(ADMISSION.status())
+
+@app.get("/status/sessions")
+async def session_status():
+    """返回每个映射会话的健康状况，用于判断哪些会话ID需要重新捕获。"""
+    return JSONResponse({"cooldown_seconds": SESSION_POOL.cooldown_seconds, "sessions": SESSION_POOL.status()})
+
+@app.get("/status/restart")
+async def restart_status():
+    """返回重启交接的当前阶段（idle / starting / draining / handoff）以及新进程的 PID。"""
+    return JSONResponse({**RESTART_STATE, "pid": os.getpid(), "handoff_supported": handoff_supported(),
+                         "started_by_handoff": HANDOFF_STARTED_AT is not None})
+
 # --- 内部通信端点 ---
+@app.post("/internal/restart")
+async def request_restart():
+    """以不中断服务的方式重启服务器（例如手动更新文件后）。交接在后台进行，进度见 /status/restart。"""
+    if not handoff_supported() or UVICORN_SERVER is None:
+        raise HTTPException(status_code=501, detail="当前平台或启动方式不支持不中断服务的重启。")
+    if RESTART_STATE["phase"] != "idle":
+        raise HTTPException(status_code=409, detail=f"重启已在进行中（{RESTART_STATE['phase']}）。")
+    asyncio.create_task(managed_restart("手动请求"))
+    return JSONResponse({"status": "restarting", "pid": os.getpid()}, status_code=202)
+
+@app.post("/internal/reload")
+async def reload_config_files():
+    """
+    立即重新检查并加载 config.jsonc、models.json 和 model_endpoint_map.json，
+    返回每个文件新增、移除和变更的键名（不包含具体值）。
+    """
+    changes = await asyncio.to_thread(CONFIG_STORE.reload, True)
+    apply_config_snapshot(CONFIG_STORE.snapshot)
+    log_config_changes(changes)
+    return JSONResponse({"status": "reloaded", "generation": CONFIG_STORE.snapshot.generation, "changes": changes})
+
 @app.post("/internal/start_id_capture")
 async def start_id_capture():
     """
     接收来自 id_updater.py 的通知，并通过 WebSocket 指令
     激活油猴脚本的 ID 捕获模式。
     """
-    if not browser_ws:
+    if not len(WORKER_POOL):
         logger.warning("ID CAPTURE: 收到激活请求，但没有浏览器连接。")
         raise HTTPException(status_code=503, detail="Browser client not connected.")
     
     try:
+        # 用户可能在任意一个标签页中点击重试，因此向所有标签页广播
         logger.info("ID CAPTURE: 收到激活请求，正在通过 WebSocket 发送指令...")
-        await browser_ws.send_text(json.dumps({"command": "activate_id_capture"}))
-        logger.info("ID CAPTURE: 激活指令已成功发送。")
+        sent = await WORKER_POOL.broadcast({"command": "activate_id_capture"})
+        logger.info(f"ID CAPTURE: 激活指令已成功发送到 {sent} 个标签页。")
         return JSONResponse({"status": "success", "message": "Activation command sent."})
     except Exception as e:
         logger.error(f"ID CAPTURE: 发送激活指令时出错: {e}", exc_info=True)
@@ -1066,4 +1658,10 @@ if __name__ == "__main__":
     logger.info(f"   - 监听地址: http://127.0.0.1:{api_port}")
     logger.info(f"   - WebSocket 端点: ws://127.0.0.1:{api_port}/ws")
     
-    uvicorn.run(app, host="0.0.0.0", port=api_port)
+    # 监听套接字由本进程创建，或在不中断服务的重启中从旧进程继承（见 modules/hot_restart.py）
+    LISTEN_SOCKET, inherited = listening_socket("0.0.0.0", api_port)
+    if inherited:
+        HANDOFF_STARTED_AT = time.monotonic()
+        logger.info("   - 已从旧进程接管监听套接字")
+    UVICORN_SERVER = uvicorn.Server(uvicorn.Config(app, host="0.0.0.0", port=api_port, timeout_graceful_shutdown=5))
+    UVICORN_SERVER.run(sockets=[LISTEN_SOCKET])
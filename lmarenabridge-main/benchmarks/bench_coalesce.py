@@ -0,0 +1,100 @@
+# bench_coalesce.py
+# 对比逐个增量写出 SSE 事件与 modules/coalesce.py 按时间窗口合并后写出的 CPU 开销。
+# 用法（在 lmarenabridge-main 目录下）: python benchmarks/bench_coalesce.py [并发流数] [每个流的 token 数]
+# 每个模拟流按固定间隔产生 token（间隔内偶尔一次到达多个，模拟一个 WebSocket 帧带多条 a0 记录），
+# 每个 SSE 事件与 format_openai_chunk 一样做一次 json.dumps，并通过真实的 socket 写出（对端持续读取丢弃）。
+# 输出每个流消耗的 CPU 时间（进程 CPU 时间 / 流数）、写出的事件数和墙钟时间；
+# 墙钟时间主要由 token 间隔决定，合并窗口只会让每个增量最多延迟一个窗口。
+
+import asyncio
+import json
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules.coalesce import coalesce_content
+
+TOKEN_INTERVAL = 0.004  # 约 250 token/s，接近较快模型的输出速度
+BURST_EVERY = 5  # 每 5 次到达中有一次一帧带 3 个 token
+
+
+def format_chunk(content: str, model: str, response_id: str) -> str:
+    """与 api_server.format_openai_chunk 相同的序列化工作量。"""
+    chunk = {
+        "id": response_id, "object": "chat.completion.chunk",
+        "created": int(time.time()), "model": model,
+        "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
+    }
+    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+
+async def token_source(tokens: int):
+    sent = 0
+    arrival = 0
+    while sent < tokens:
+        await asyncio.sleep(TOKEN_INTERVAL)
+        arrival += 1
+        for _ in range(3 if arrival % BURST_EVERY == 0 else 1):
+            if sent < tokens:
+                yield 'content', f"tok{sent} "
+                sent += 1
+    yield 'finish', 'stop'
+
+
+async def run_stream(writer, tokens: int, window: float, max_bytes: int) -> int:
+    events = token_source(tokens)
+    if window > 0:
+        events = coalesce_content(events, window, max_bytes)
+    written = 0
+    async for event_type, value in events:
+        if event_type == 'content':
+            writer.write(format_chunk(value, "bench-model", "chatcmpl-bench").encode("utf-8"))
+            await writer.drain()
+            written += 1
+    writer.write(b"data: [DONE]\n\n")
+    await writer.drain()
+    return written
+
+
+async def drain(sock):
+    loop = asyncio.get_running_loop()
+    while await loop.sock_recv(sock, 65536):
+        pass
+
+
+async def scenario(streams: int, tokens: int, window: float, max_bytes: int = 4096):
+    pairs = [socket.socketpair() for _ in range(streams)]
+    writers, readers = [], []
+    for a, b in pairs:
+        b.setblocking(False)
+        readers.append(asyncio.create_task(drain(b)))
+        _, writer = await asyncio.open_connection(sock=a)
+        writers.append(writer)
+    cpu, wall = time.process_time(), time.perf_counter()
+    written = await asyncio.gather(*(run_stream(w, tokens, window, max_bytes) for w in writers))
+    cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+    for writer in writers:
+        writer.close()
+    await asyncio.gather(*readers)
+    for _, b in pairs:
+        b.close()
+    return cpu / streams, sum(written) / streams, wall
+
+
+def main():
+    streams = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    tokens = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    print(f"{streams} 个并发流，每个 {tokens} 个 token，token 间隔 {TOKEN_INTERVAL * 1000:.0f}ms")
+    print(f"{'合并窗口':>10} {'CPU ms/流':>10} {'事件数/流':>10} {'墙钟 s':>8} {'CPU 节省':>9}")
+    baseline = None
+    for window_ms in (0, 15, 30):
+        cpu, events, wall = asyncio.run(scenario(streams, tokens, window_ms / 1000))
+        baseline = baseline or cpu
+        label = "关闭" if window_ms == 0 else f"{window_ms}ms"
+        print(f"{label:>10} {cpu * 1000:>10.1f} {events:>10.0f} {wall:>8.2f} {1 - cpu / baseline:>8.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# bench_json_codec.py
+# 对比 modules/json_codec.py 的两个后端（orjson 与标准库 json）在流式热路径上每个 token 的 CPU 开销。
+# 用法（在 lmarenabridge-main 目录下）: python benchmarks/bench_json_codec.py [token 数]
+# 后端在导入时选定，所以每个后端在单独的子进程中运行（LMARENA_JSON_BACKEND=stdlib 强制使用标准库）。
+# 每个 token 走完整的服务器端路径：
+# - v1: 解析 WebSocket 文本帧 {"request_id", "data": "a0:\"...\"\n"} → LMArenaStreamParser → ChunkEncoder.content_bytes；
+# - v2: 二进制帧不经过 JSON，只有解析器与 SSE 编码；
+# 另外测量一次发给浏览器的请求载荷（约 200KB 的多轮对话）的编码耗时。
+# 标准库后端的路径与引入编解码层之前相同（json.loads、raw_decode、encode_basestring 再 encode）。
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TOKENS = ["Hello", " world", "，这是", "一个流式", " response", " with \"quotes\"", "\n", " 😀"]
+
+
+def make_frames(count: int) -> list[str]:
+    frames = []
+    for i in range(count):
+        record = "a0:" + json.dumps(TOKENS[i % len(TOKENS)], ensure_ascii=False) + "\n"
+        frames.append(json.dumps({"request_id": "5f0c8a6e-6f1b-4c3e-9d57-0a1b2c3d4e5f", "data": record}, ensure_ascii=False))
+    return frames
+
+
+def make_payload() -> dict:
+    turn = "这是一段较长的对话内容，包含中英文混合的文本 and some English text. " * 20
+    messages = [{"role": "user" if i % 2 == 0 else "assistant", "content": turn, "attachments": []} for i in range(100)]
+    return {"message_templates": messages, "target_model_id": "a" * 36, "session_id": "b" * 36, "message_id": "c" * 36}
+
+
+def best_of(fn, repeat=5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.process_time()
+        fn()
+        best = min(best, time.process_time() - start)
+    return best
+
+
+def run(count: int) -> None:
+    """在当前进程中测量（由 main 以子进程方式调用），输出一行 JSON 结果。"""
+    from modules import json_codec
+    from modules.stream_parser import LMArenaStreamParser
+    from modules.sse_encoder import ChunkEncoder
+
+    frames = make_frames(count)
+    records = [json.loads(frame)["data"] for frame in frames]
+
+    def v1():
+        parser, encoder, out = LMArenaStreamParser(), ChunkEncoder("chatcmpl-bench", "bench-model"), []
+        for frame in frames:
+            message = json_codec.loads(frame)
+            for event_type, value in parser.feed(message["data"]):
+                out.append(encoder.content_bytes(value))
+
+    def v2():
+        parser, encoder, out = LMArenaStreamParser(), ChunkEncoder("chatcmpl-bench", "bench-model"), []
+        for record in records:
+            for event_type, value in parser.feed(record):
+                out.append(encoder.content_bytes(value))
+
+    payload = make_payload()
+    body = {"request_id": "5f0c8a6e-6f1b-4c3e-9d57-0a1b2c3d4e5f", "payload": payload}
+    print(json.dumps({
+        "backend": json_codec.BACKEND,
+        "v1": best_of(v1) / count,
+        "v2": best_of(v2) / count,
+        "payload": best_of(lambda: [json_codec.dumps_bytes(body) for _ in range(20)]) / 20,
+        "payload_kb": len(json_codec.dumps_bytes(body)) / 1024,
+    }))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    results = []
+    for backend in ("stdlib", "orjson"):
+        env = dict(os.environ, LMARENA_JSON_BACKEND=backend)
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), "--run", str(count)],
+                             env=env, capture_output=True, text=True, check=True).stdout
+        result = json.loads(out)
+        if result["backend"] != backend:
+            print(f"{backend} 未安装，跳过")
+            continue
+        results.append(result)
+
+    print(f"{count} 个 token（每个 token 一帧）")
+    print(f"{'后端':<8} {'v1 µs/token':>12} {'v2 µs/token':>12} {'载荷 ms':>9}")
+    for r in results:
+        print(f"{r['backend']:<8} {r['v1'] * 1e6:>12.2f} {r['v2'] * 1e6:>12.2f} {r['payload'] * 1000:>9.2f}")
+    if len(results) == 2:
+        base, fast = results
+        print(f"{'加速比':<8} {base['v1'] / fast['v1']:>11.2f}x {base['v2'] / fast['v2']:>11.2f}x {base['payload'] / fast['payload']:>8.2f}x")
+    if results:
+        print(f"（载荷约 {results[0]['payload_kb']:.0f}KB）")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--run":
+        run(int(sys.argv[2]))
+    else:
+        main()
@@ -0,0 +1,111 @@
+# bench_model_extractor.py
+# 对比旧的“正则找起点 + 逐字符数花括号”提取方式与 modules/model_extractor.py 中的单次扫描。
+# 用法（在 lmarenabridge-main 目录下）:
+#   python benchmarks/bench_model_extractor.py              # 使用生成的页面（约 2/8/32 MB）
+#   python benchmarks/bench_model_extractor.py page.html    # 使用保存的 LMArena 页面源码
+# 生成的页面仿照 Next.js 的 self.__next_f.push([1,"..."]) 结构：模型对象是转义后的 JSON，
+# 夹杂大量其他带 id 的对象和普通 HTML；部分模型描述中含有花括号与转义引号（旧版会提取失败）。
+
+import json
+import os
+import re
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules.model_extractor import extract_models
+
+
+def legacy_extract(html_content):
+    """旧版 extract_models_from_html 的逻辑（去掉日志）。"""
+    models = []
+    model_names = set()
+    for start_match in re.finditer(r'\{\\"id\\":\\"[a-f0-9-]+\\"', html_content):
+        start_index = start_match.start()
+        open_braces = 0
+        end_index = -1
+        for i in range(start_index, min(len(html_content), start_index + 10000)):
+            if html_content[i] == '{':
+                open_braces += 1
+            elif html_content[i] == '}':
+                open_braces -= 1
+                if open_braces == 0:
+                    end_index = i + 1
+                    break
+        if end_index != -1:
+            json_string = html_content[start_index:end_index].replace('\\"', '"').replace('\\\\', '\\')
+            try:
+                model_data = json.loads(json_string)
+            except json.JSONDecodeError:
+                continue
+            model_name = model_data.get('publicName')
+            if model_name and model_name not in model_names:
+                models.append(model_data)
+                model_names.add(model_name)
+    return models
+
+
+def _push(obj) -> str:
+    """把对象编码成 Next.js 页面中的形式：JSON 字符串再作为 JS 字符串字面量转义一次。"""
+    return json.dumps(json.dumps(obj, ensure_ascii=False, separators=(",", ":")), ensure_ascii=False)[1:-1]
+
+
+def make_page(target_bytes: int, models: int = 400, tricky: bool = False) -> str:
+    parts = ["<!DOCTYPE html><html><head><title>LMArena</title></head><body>"]
+    for i in range(models):
+        description = f"Model {i} — 多模态模型，支持长上下文。" * 8
+        if tricky and i % 10 == 0:
+            description += ' 示例: {"role": "user"} 与 C:\\path\\ 以及 } 多余的括号'
+        model = {
+            "id": str(uuid.UUID(int=i)),
+            "publicName": f"model-{i}",
+            "organization": "org",
+            "provider": {"id": str(uuid.UUID(int=10**9 + i)), "name": "provider"},
+            "capabilities": {"inputCapabilities": {"text": True, "image": i % 2 == 0}, "outputCapabilities": {"text": True}},
+            "description": description,
+        }
+        parts.append(f'<script>self.__next_f.push([1,"{_push({"models": [model]})}"])</script>')
+    filler_object = _push({"id": str(uuid.UUID(int=0)).replace("0", "f"), "type": "message", "content": "x" * 200, "meta": {"a": [1, 2, {"b": None}]}})
+    filler = f'<script>self.__next_f.push([1,"{filler_object}"])</script><div class="c">{"lorem ipsum " * 40}</div>'
+    size = sum(len(p) for p in parts)
+    while size < target_bytes:
+        parts.append(filler)
+        size += len(filler)
+    parts.append("</body></html>")
+    return "".join(parts)
+
+
+def bench(fn, html, repeat=3):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(html)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def report(title, html):
+    legacy_time, legacy = bench(legacy_extract, html)
+    new_time, new = bench(extract_models, html)
+    print(f"{title:>18} {len(html) / 1024 / 1024:>8.1f}MB {len(legacy):>8} {len(new):>8} "
+          f"{legacy_time * 1000:>10.1f} {new_time * 1000:>10.1f} {legacy_time / new_time:>7.1f}x")
+    return legacy, new
+
+
+def main():
+    print(f"{'页面':>18} {'大小':>10} {'旧版模型数':>8} {'新版模型数':>8} {'旧版 ms':>10} {'新版 ms':>10} {'加速比':>8}")
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "r", encoding="utf-8") as f:
+            report(os.path.basename(sys.argv[1]), f.read())
+        return
+    for size in (2, 8, 32):
+        legacy, new = report(f"生成页面", make_page(size * 1024 * 1024))
+        assert legacy == new
+    legacy, new = report("描述含花括号", make_page(8 * 1024 * 1024, tricky=True))
+    assert len(new) == 400 and len(legacy) < len(new)
+
+
+if __name__ == "__main__":
+    main()
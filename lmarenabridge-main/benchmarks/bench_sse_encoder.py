@@ -0,0 +1,76 @@
+# bench_sse_encoder.py
+# 对比逐块构建字典并 json.dumps 的旧做法与 modules/sse_encoder.py 中预先渲染模板的 ChunkEncoder。
+# 用法（在 lmarenabridge-main 目录下）: python benchmarks/bench_sse_encoder.py
+# 输出两种格式（OpenAI / LM Studio）在不同文本长度下的单块耗时；并先校验两者的输出逐字节相同。
+
+import json
+import os
+import re
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules.sse_encoder import ChunkEncoder, OPENAI, LMSTUDIO
+
+
+def legacy_openai(content: str, model: str, rid: str) -> str:
+    """旧版 api_server.format_openai_chunk。"""
+    chunk = {
+        "id": rid, "object": "chat.completion.chunk",
+        "created": int(time.time()), "model": model,
+        "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]
+    }
+    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+
+def legacy_lmstudio(content: str, model: str, rid: str) -> str:
+    """旧版移动端后端 lmstudio 模式的内容块（字典 + _sse_send）。"""
+    chunk = {"id": rid, "object": "text_completion", "created": int(time.time()), "model": model,
+             "choices": [{"index": 0, "text": content, "finish_reason": None}]}
+    return "data: " + json.dumps(chunk, ensure_ascii=False) + "\n\n"
+
+
+_CREATED = re.compile(r'"created": \d+')
+
+
+def check(texts):
+    rid, model = f"chatcmpl-{uuid.uuid4()}", "gemini-2.5-pro"
+    for compat, legacy in ((OPENAI, legacy_openai), (LMSTUDIO, legacy_lmstudio)):
+        encoder = ChunkEncoder(rid, model, compat)
+        for text in texts:
+            # created 可能恰好跨过一秒，比较时去掉
+            assert _CREATED.sub("", encoder.content(text)) == _CREATED.sub("", legacy(text, model, rid)), (compat, text)
+
+
+def bench(fn, texts, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in texts:
+            fn(text)
+        best = min(best, time.perf_counter() - start)
+    return best / len(texts)
+
+
+def main():
+    cases = [
+        ("单个 token", ["Hello", " world", ",", " this", " is"] * 20000),
+        ("中文短句", ["你好，这是一个流式响应的片段。"] * 50000),
+        ("含引号与换行", ['He said "hi"\n\tand left\\'] * 50000),
+        ("合并后约 2KB", ["token " * 340] * 5000),
+    ]
+    check([t for _, texts in cases for t in texts[:10]] + ["", "\x00", "emoji 😀", " "])
+    rid, model = f"chatcmpl-{uuid.uuid4()}", "gemini-2.5-pro"
+    for compat, legacy in (("OpenAI", legacy_openai), ("LM Studio", legacy_lmstudio)):
+        print(f"\n== {compat} ==")
+        print(f"{'文本':<12} {'旧版 µs/块':>12} {'模板 µs/块':>12} {'加速比':>8}")
+        encoder = ChunkEncoder(rid, model, OPENAI if compat == "OpenAI" else LMSTUDIO)
+        for title, texts in cases:
+            old = bench(lambda t: legacy(t, model, rid), texts)
+            new = bench(encoder.content, texts)
+            print(f"{title:<12} {old * 1e6:>12.2f} {new * 1e6:>12.2f} {old / new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
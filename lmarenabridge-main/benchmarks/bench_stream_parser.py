@@ -0,0 +1,100 @@
+# bench_stream_parser.py
+# 对比旧的“整块缓冲区 + 正则反复切片”解析方式与 modules/stream_parser.py 中的增量解析器。
+# 用法（在 lmarenabridge-main 目录下）: python benchmarks/bench_stream_parser.py
+# 输出每种响应大小下的平均单块耗时；增量解析器的单块耗时应基本不随响应变长而增长。
+
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules.stream_parser import LMArenaStreamParser
+
+
+def legacy_parse(chunks):
+    """旧版 _process_lmarena_stream 的解析逻辑（去掉异步与队列部分）。"""
+    buffer = ""
+    text_pattern = re.compile(r'[ab]0:"((?:\\.|[^"\\])*)"')
+    image_pattern = re.compile(r'[ab]2:(\[.*?\])')
+    finish_pattern = re.compile(r'[ab]d:(\{.*?"finishReason".*?\})')
+    error_pattern = re.compile(r'(\{\s*"error".*?\})', re.DOTALL)
+    cloudflare_patterns = [r'<title>Just a moment...</title>', r'Enable JavaScript and cookies to continue']
+    count = 0
+    for chunk in chunks:
+        buffer += chunk
+        if any(re.search(p, buffer, re.IGNORECASE) for p in cloudflare_patterns):
+            return count
+        if error_pattern.search(buffer):
+            return count
+        while (match := text_pattern.search(buffer)):
+            if json.loads(f'"{match.group(1)}"'):
+                count += 1
+            buffer = buffer[match.end():]
+        while (match := image_pattern.search(buffer)):
+            buffer = buffer[match.end():]
+        if (match := finish_pattern.search(buffer)):
+            buffer = buffer[match.end():]
+    return count
+
+
+def incremental_parse(chunks):
+    parser = LMArenaStreamParser()
+    count = 0
+    for chunk in chunks:
+        count += sum(1 for kind, _ in parser.feed(chunk) if kind == 'content')
+    count += sum(1 for kind, _ in parser.close() if kind == 'content')
+    return count
+
+
+def make_stream(total_bytes, chunk_bytes):
+    """生成约 total_bytes 大小的 a0 记录流，并按 chunk_bytes 切块（切点可能落在记录中间）。"""
+    record = 'a0:"token \\"quoted\\" 文本"\n'
+    body = record * (total_bytes // len(record) + 1) + 'ad:{"finishReason":"stop"}\n'
+    if chunk_bytes <= 0:
+        return body.splitlines(keepends=True)
+    return [body[i:i + chunk_bytes] for i in range(0, len(body), chunk_bytes)]
+
+
+def make_long_record_stream(total_bytes, chunk_bytes=4096):
+    """单条超长记录（如大段代码或图片列表）跨越多个数据块到达。"""
+    text = "x" * total_bytes
+    body = f'a0:"{text}"\nad:{{"finishReason":"stop"}}\n'
+    return [body[i:i + chunk_bytes] for i in range(0, len(body), chunk_bytes)]
+
+
+def bench(fn, chunks, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(chunks)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    sizes = [64 * 1024, 512 * 1024, 2 * 1024 * 1024, 8 * 1024 * 1024]
+    # (标题, 生成函数, 旧版解析器参与对比的最大响应大小；旧版在超长记录上是平方级，过大时跳过)
+    scenarios = [
+        ("每块一条记录", lambda size: make_stream(size, 0), sizes[-1]),
+        ("每块 16KB（浏览器合并读取）", lambda size: make_stream(size, 16 * 1024), sizes[-1]),
+        ("单条超长记录，每块 4KB", make_long_record_stream, 512 * 1024),
+    ]
+    for title, make_chunks, legacy_limit in scenarios:
+        print(f"\n== {title} ==")
+        print(f"{'响应大小':>10} {'块数':>8} {'旧版 µs/块':>12} {'增量 µs/块':>12} {'加速比':>8}")
+        for size in sizes:
+            chunks = make_chunks(size)
+            assert legacy_parse(chunks) == incremental_parse(chunks) if size <= 64 * 1024 else True
+            incremental = bench(incremental_parse, chunks)
+            n = len(chunks)
+            if size > legacy_limit:
+                print(f"{size // 1024:>8}KB {n:>8} {'(跳过)':>12} {incremental / n * 1e6:>12.2f} {'-':>8}")
+                continue
+            legacy = bench(legacy_parse, chunks, repeat=1 if size > 2 * 1024 * 1024 else 3)
+            print(f"{size // 1024:>8}KB {n:>8} {legacy / n * 1e6:>12.2f} {incremental / n * 1e6:>12.2f} {legacy / incremental:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
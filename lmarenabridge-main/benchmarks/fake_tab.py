@@ -0,0 +1,252 @@
+# fake_tab.py
+# 假浏览器标签页：LMArenaApiBridge.js 的 Python 替身，用于在没有真实 LMArena 标签页时压测桥接服务器。
+# 用法（在 lmarenabridge-main 目录下）: python benchmarks/fake_tab.py [--tabs 4] [--token-rate 50] [--ttft-ms 800] ...
+#   （python benchmarks/fake_tab.py --help 查看全部参数；benchmarks/load_test.py --server 会自动启动它）
+# 每个标签页以与脚本相同的查询参数连接 /ws（tab_id、max_concurrency、reconnect=drain、heartbeat=1，默认 protocol=2），
+# 收到请求后按对数正态分布的首字延迟等待，再以固定速率回传合成的 a0: 记录，最后发送 ad: 结束记录和 [DONE]。
+# 可按比例注入故障：Cloudflare 验证页、413、429（与脚本回传的错误消息格式相同）和连接断开（断开后 1.5 秒重连，与脚本相同）。
+# 与脚本一样处理 ping（回复 pong）、pause/resume（流控）、cancel（停止回传并回复 cancelled）、refresh（断开后重连）
+# 和 reconnect（计划内重启：立即连接新进程，旧连接上的请求继续回传，完成后由旧进程关闭）。
+# 按 Ctrl+C 退出时输出各标签页处理的请求数与注入的故障数。
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import struct
+import sys
+import zlib
+from collections import Counter
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules.ws_protocol import (FRAME_DATA, FRAME_OPEN, FLAG_DEFLATE, RECORD_DATA, RECORD_DONE, RECORD_ERROR,
+                                 PROTOCOL_V2)
+
+# 与 modules/ws_protocol.py 相同的帧格式
+_OPEN_HEADER = struct.Struct(">BBII")
+_RECORD_HEADER = struct.Struct(">BII")
+
+RECONNECT_DELAY = 1.5
+TOKENS = ["Hello", " world", "，这是", "一个流式", " response", " with \"quotes\"", "\n", " 😀"]
+CLOUDFLARE_PAGE = ("<!DOCTYPE html><html><head><title>Just a moment...</title></head>"
+                   "<body>Enable JavaScript and cookies to continue</body></html>")
+# 与脚本在 fetch 失败时回传的错误消息格式相同
+ERROR_MESSAGES = {
+    "cloudflare": f"网络响应不正常。状态: 403. 内容: {CLOUDFLARE_PAGE}",
+    "too_large": "网络响应不正常。状态: 413. 内容: Request Entity Too Large",
+    "rate_limited": "网络响应不正常。状态: 429. 内容: Too Many Requests",
+}
+FAULTS = ("cloudflare", "too_large", "rate_limited", "disconnect")
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """假标签页的参数（load_test.py 复用）。"""
+    parser.add_argument("--tabs", type=int, default=2, help="标签页（WebSocket 连接）数量")
+    parser.add_argument("--max-concurrency", type=int, default=8, help="每个标签页声明的并发上限")
+    parser.add_argument("--protocol", type=int, choices=(1, 2), default=2, help="WebSocket 协议版本")
+    parser.add_argument("--tokens", type=int, default=200, help="每个响应的 token 数")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="每个流每秒回传的 token 数")
+    parser.add_argument("--ttft-ms", type=float, default=800.0, help="首字延迟的中位数（毫秒）")
+    parser.add_argument("--ttft-sigma", type=float, default=0.5, help="首字延迟对数正态分布的 sigma，0 表示固定值")
+    for fault in FAULTS:
+        parser.add_argument(f"--{fault.replace('_', '-')}-rate", type=float, default=0.0,
+                            help=f"注入 {fault} 故障的请求比例（0–1）")
+    parser.add_argument("--seed", type=int, default=None, help="随机数种子")
+
+
+class FakeTab:
+    """
+    一个假标签页：维护一个 WebSocket 连接（断开后自动重连），并发处理分发到它的请求。
+    计划内重启期间同时有两个连接（旧连接只完成已收到的请求），每个请求从收到它的连接回传（conns / stream_ids）。
+    """
+
+    def __init__(self, url: str, tab_id: str, args, rng: random.Random, stats: Counter):
+        self.url = url
+        self.tab_id = tab_id
+        self.args = args
+        self.rng = rng
+        self.stats = stats
+        self.conns: dict[str, aiohttp.ClientWebSocketResponse] = {}
+        self.stream_ids: dict[str, int] = {}
+        self.tasks: dict[str, asyncio.Task] = {}
+        self.resumed: dict[str, asyncio.Event] = {}
+
+    async def run(self, session: aiohttp.ClientSession) -> None:
+        """连接并在断开后重连；收到 reconnect 时由新连接的 run 接管，本次调用等待它（不会返回）。"""
+        query = f"tab_id={self.tab_id}&max_concurrency={self.args.max_concurrency}&reconnect=drain&heartbeat=1"
+        if self.args.protocol == PROTOCOL_V2:
+            query += "&protocol=2&compress=deflate-raw"
+        while True:
+            successor = None
+            ws = None
+            try:
+                async with session.ws_connect(f"{self.url}?{query}", max_msg_size=0) as ws:
+                    self.stats["connects"] += 1
+                    successor = await self._serve(ws, session)
+            except aiohttp.ClientError:
+                pass
+            finally:
+                for request_id in [r for r, owner in self.conns.items() if owner is ws]:
+                    task = self.tasks.pop(request_id, None)
+                    if task is not None:
+                        task.cancel()
+                    self._forget(request_id)
+            if successor is not None:
+                await successor
+                return
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    async def _serve(self, ws, session: aiohttp.ClientSession):
+        """处理一个连接上的消息直到断开；收到 reconnect 后返回接管连接的任务，否则返回 None。"""
+        successor = None
+        async for msg in ws:
+            if msg.type == aiohttp.WSMsgType.BINARY:
+                self._open(ws, msg.data)
+            elif msg.type == aiohttp.WSMsgType.TEXT:
+                message = json.loads(msg.data)
+                command = message.get("command")
+                if command == "ping":
+                    await ws.send_str(json.dumps({"pong": message.get("seq")}))
+                elif command == "pause" and message.get("request_id") in self.resumed:
+                    self.resumed[message["request_id"]].clear()
+                elif command == "resume" and message.get("request_id") in self.resumed:
+                    self.resumed[message["request_id"]].set()
+                elif command == "cancel" and message.get("request_id"):
+                    await self._cancel(message["request_id"])
+                elif command == "refresh":
+                    # 脚本刷新页面：连接断开，页面加载后重新连接
+                    self.stats["refreshes"] += 1
+                    await ws.close()
+                elif command == "reconnect" and successor is None:
+                    # 计划内重启：立即连接新进程，本连接上的请求继续回传，完成后由旧进程关闭
+                    self.stats["drain_reconnects"] += 1
+                    successor = asyncio.create_task(self.run(session))
+                elif not command and message.get("request_id") and message.get("payload"):
+                    self._start(ws, message["request_id"])
+            elif msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.ERROR):
+                break
+        return successor
+
+    def _open(self, ws, frame: bytes) -> None:
+        """解析协议 v2 的 OPEN 帧（附件块不需要，直接忽略）。"""
+        kind, flags, stream_id, length = _OPEN_HEADER.unpack_from(frame)
+        if kind != FRAME_OPEN:
+            return
+        body = frame[_OPEN_HEADER.size:_OPEN_HEADER.size + length]
+        if flags & FLAG_DEFLATE:
+            body = zlib.decompress(body, -15)
+        request_id = json.loads(body)["request_id"]
+        self.stream_ids[request_id] = stream_id
+        self._start(ws, request_id)
+
+    def _start(self, ws, request_id: str) -> None:
+        self.stats["requests"] += 1
+        self.conns[request_id] = ws
+        event = self.resumed[request_id] = asyncio.Event()
+        event.set()
+        self.tasks[request_id] = asyncio.create_task(self._respond(request_id))
+
+    async def _cancel(self, request_id: str) -> None:
+        task = self.tasks.pop(request_id, None)
+        if task is None:
+            return
+        task.cancel()
+        self.stats["cancelled"] += 1
+        # 与脚本的 sendCancelled 相同：回复 cancelled，再发送结束记录（协议 v2 据此释放流 ID）
+        await self.conns[request_id].send_str(json.dumps({"cancelled": request_id}))
+        await self._send(request_id, "[DONE]")
+        self._forget(request_id)
+
+    def _forget(self, request_id: str) -> None:
+        self.conns.pop(request_id, None)
+        self.stream_ids.pop(request_id, None)
+        self.resumed.pop(request_id, None)
+
+    def _pick_fault(self):
+        roll = self.rng.random()
+        for fault in FAULTS:
+            roll -= getattr(self.args, f"{fault}_rate")
+            if roll < 0:
+                return fault
+        return None
+
+    def _ttft(self) -> float:
+        median = self.args.ttft_ms / 1000
+        if self.args.ttft_sigma <= 0 or median <= 0:
+            return max(0.0, median)
+        return self.rng.lognormvariate(math.log(median), self.args.ttft_sigma)
+
+    async def _send(self, request_id: str, data) -> None:
+        """与脚本的 sendToServer 相同：data 为文本、"[DONE]" 或 {"error": ...}。"""
+        ws = self.conns[request_id]
+        stream_id = self.stream_ids.get(request_id)
+        if stream_id is None:
+            await ws.send_str(json.dumps({"request_id": request_id, "data": data}, ensure_ascii=False))
+            return
+        if data == "[DONE]":
+            kind, body = RECORD_DONE, b""
+        elif isinstance(data, dict):
+            kind, body = RECORD_ERROR, str(data["error"]).encode("utf-8")
+        else:
+            kind, body = RECORD_DATA, data.encode("utf-8")
+        await ws.send_bytes(bytes((FRAME_DATA, 0)) + _RECORD_HEADER.pack(kind, stream_id, len(body)) + body)
+
+    async def _respond(self, request_id: str) -> None:
+        try:
+            fault = self._pick_fault()
+            await asyncio.sleep(self._ttft())
+            if fault is not None:
+                self.stats[fault] += 1
+            if fault in ERROR_MESSAGES:
+                await self._send(request_id, {"error": ERROR_MESSAGES[fault]})
+                await self._send(request_id, "[DONE]")
+                return
+            # 断开故障在首字之前或流中的随机位置发生
+            disconnect_at = self.rng.randint(0, self.args.tokens) if fault == "disconnect" else None
+            interval = 1 / self.args.token_rate if self.args.token_rate > 0 else 0
+            for i in range(self.args.tokens):
+                if i == disconnect_at:
+                    await self.conns[request_id].close()
+                    return
+                await self.resumed[request_id].wait()
+                await self._send(request_id, "a0:" + json.dumps(TOKENS[i % len(TOKENS)], ensure_ascii=False) + "\n")
+                await asyncio.sleep(interval)
+            await self._send(request_id, 'ad:{"finishReason":"stop"}\n')
+            await self._send(request_id, "[DONE]")
+            self.stats["completed"] += 1
+        except ConnectionResetError:
+            pass
+        finally:
+            if self.tasks.get(request_id) is asyncio.current_task():
+                del self.tasks[request_id]
+                self._forget(request_id)
+
+
+async def run_tabs(url: str, args, stats: Counter) -> None:
+    rng = random.Random(args.seed)
+    async with aiohttp.ClientSession() as session:
+        tabs = [FakeTab(url, f"fake-{i + 1}", args, rng, stats) for i in range(args.tabs)]
+        await asyncio.gather(*(tab.run(session) for tab in tabs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="假浏览器标签页（LMArenaApiBridge.js 的替身）")
+    parser.add_argument("--url", default="ws://127.0.0.1:5102/ws", help="服务器的 WebSocket 地址")
+    add_arguments(parser)
+    args = parser.parse_args()
+    print(f"{args.tabs} 个假标签页连接 {args.url}（协议 v{args.protocol}，{args.token_rate:g} token/s，"
+          f"首字延迟中位数 {args.ttft_ms:g}ms），按 Ctrl+C 退出", flush=True)
+    stats = Counter()
+    try:
+        asyncio.run(run_tabs(args.url, args, stats))
+    except KeyboardInterrupt:
+        pass
+    print(dict(stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+# load_test.py
+# 桥接服务器的压测：并发请求 /v1/chat/completions（流式与非流式），用 benchmarks/fake_tab.py 代替真实的 LMArena 标签页。
+# 用法（在 lmarenabridge-main 目录下）:
+#   python benchmarks/load_test.py --server api       # 启动 api_server.py 和假标签页，压测结束后全部退出
+#   python benchmarks/load_test.py --server mobile    # 同上，服务器为 TampermonkeyScript/lm模型后端.py
+#   python benchmarks/load_test.py --url http://127.0.0.1:5102 --pid 12345   # 压测已在运行的服务器（标签页需自行连接）
+# 两个服务器都固定监听 5102 端口，--server 模式下请先停止正在运行的实例。
+# 假标签页的参数（--tabs、--token-rate、--ttft-ms、--cloudflare-rate 等，见 fake_tab.py --help）在 --server 模式下原样传给它。
+# 输出每种模式的吞吐量、首字延迟（TTFT）与 token 间隔（ITL）的百分位、总耗时，以及服务器进程的 CPU 时间和内存（RSS，读取 /proc）。
+# --json 把结果写入文件，便于部署前与上一次的结果对比。
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+import uuid
+from collections import Counter
+
+import aiohttp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from benchmarks.fake_tab import add_arguments as add_tab_arguments
+
+SERVERS = {
+    "api": ["api_server.py"],
+    "mobile": [os.path.join("TampermonkeyScript", "lm模型后端.py")],
+}
+ERROR_MARKER = "[LMArena Bridge Error]"
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def percentile(values: list, p: float):
+    """最近秩法百分位；没有样本时返回 None。"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))]
+
+
+class ProcessSampler:
+    """定期读取 /proc/<pid> 的 CPU 时间与 RSS（非 Linux 系统上不可用，结果为 None）。"""
+
+    def __init__(self, pid: int | None, interval: float = 0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = 0
+
+    def cpu_seconds(self):
+        if self.pid is None:
+            return None
+        try:
+            with open(f"/proc/{self.pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            return None
+        # 第 14、15 个字段（utime、stime）在右括号之后的第 12、13 个位置
+        return (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS
+
+    def rss_bytes(self):
+        if self.pid is None:
+            return None
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    async def run(self):
+        while True:
+            rss = self.rss_bytes()
+            if rss is not None:
+                self.peak_rss = max(self.peak_rss, rss)
+            await asyncio.sleep(self.interval)
+
+
+async def one_request(session: aiohttp.ClientSession, base: str, model: str, stream: bool) -> dict:
+    """发出一个请求并记录时间点；每个请求的消息不同，不会命中响应缓存。"""
+    body = {"model": model, "stream": stream,
+            "messages": [{"role": "user", "content": f"load test {uuid.uuid4()}"}]}
+    result = {"stream": stream, "status": None, "ok": False, "ttft": None, "itl": [], "chars": 0}
+    start = time.perf_counter()
+    try:
+        async with session.post(base + "/v1/chat/completions", json=body) as resp:
+            result["status"] = resp.status
+            if not stream:
+                data = await resp.json(content_type=None)
+                if resp.status == 200:
+                    content = data["choices"][0]["message"]["content"] or ""
+                    result["chars"] = len(content)
+                    result["ok"] = ERROR_MARKER not in content
+            else:
+                last, failed = None, resp.status != 200
+                async for line in resp.content:
+                    if not line.startswith(b"data: ") or line.startswith(b"data: [DONE]"):
+                        continue
+                    choice = json.loads(line[6:])["choices"][0]
+                    text = choice.get("text") if "text" in choice else choice.get("delta", {}).get("content")
+                    if choice.get("finish_reason") == "error" or (text and ERROR_MARKER in text):
+                        failed = True
+                    if not text:
+                        continue
+                    now = time.perf_counter()
+                    if last is None:
+                        result["ttft"] = now - start
+                    else:
+                        result["itl"].append(now - last)
+                    last = now
+                    result["chars"] += len(text)
+                result["ok"] = not failed and last is not None
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        result["status"] = type(e).__name__
+    result["latency"] = time.perf_counter() - start
+    return result
+
+
+async def run_load(base: str, args, sampler: ProcessSampler) -> tuple[list, float, float | None]:
+    modes = {"stream": [True], "non-stream": [False], "mixed": [True, False]}[args.mode]
+    results = []
+    issued = 0
+
+    async def worker(session):
+        nonlocal issued
+        while issued < args.requests:
+            stream = modes[issued % len(modes)]
+            issued += 1
+            results.append(await one_request(session, base, args.model, stream))
+
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        sampling = asyncio.create_task(sampler.run())
+        cpu_start, wall = sampler.cpu_seconds(), time.perf_counter()
+        await asyncio.gather(*(worker(session) for _ in range(args.concurrency)))
+        wall = time.perf_counter() - wall
+        cpu_end = sampler.cpu_seconds()
+        sampling.cancel()
+    cpu = cpu_end - cpu_start if cpu_start is not None and cpu_end is not None else None
+    return results, wall, cpu
+
+
+def summarize(results: list, wall: float, cpu, sampler: ProcessSampler) -> dict:
+    summary = {"wall_seconds": wall, "server_cpu_seconds": cpu,
+               "server_peak_rss_bytes": sampler.peak_rss or None, "modes": {}}
+    for stream in (True, False):
+        group = [r for r in results if r["stream"] == stream]
+        if not group:
+            continue
+        ok = [r for r in group if r["ok"]]
+        ttft = [r["ttft"] for r in ok if r["ttft"] is not None]
+        itl = [gap for r in ok for gap in r["itl"]]
+        latency = [r["latency"] for r in ok]
+        summary["modes"]["stream" if stream else "non-stream"] = {
+            "requests": len(group), "ok": len(ok),
+            "statuses": dict(Counter(str(r["status"]) for r in group)),
+            "requests_per_second": len(ok) / wall,
+            "chars_per_second": sum(r["chars"] for r in ok) / wall,
+            "ttft": {f"p{p}": percentile(ttft, p) for p in (50, 90, 99)},
+            "itl": {f"p{p}": percentile(itl, p) for p in (50, 90, 99)},
+            "latency": {f"p{p}": percentile(latency, p) for p in (50, 90, 99)},
+        }
+    return summary
+
+
+def print_summary(summary: dict) -> None:
+    def ms(value):
+        return f"{value * 1000:.1f}" if value is not None else "-"
+
+    print(f"\n{'模式':<11} {'成功/总数':>10} {'req/s':>7} {'字符/s':>9} "
+          f"{'TTFT p50/p90/p99 ms':>22} {'ITL p50/p90/p99 ms':>20} {'耗时 p50/p99 ms':>16}")
+    for mode, m in summary["modes"].items():
+        ttft = "/".join(ms(m["ttft"][p]) for p in ("p50", "p90", "p99"))
+        itl = "/".join(ms(m["itl"][p]) for p in ("p50", "p90", "p99"))
+        latency = "/".join(ms(m["latency"][p]) for p in ("p50", "p99"))
+        print(f"{mode:<11} {m['ok']:>5}/{m['requests']:<4} {m['requests_per_second']:>7.1f} {m['chars_per_second']:>9.0f} "
+              f"{ttft:>22} {itl:>20} {latency:>16}")
+        if set(m["statuses"]) != {"200"}:
+            print(f"{'':<11} 状态: {m['statuses']}")
+    total = sum(m["requests"] for m in summary["modes"].values())
+    cpu, rss = summary["server_cpu_seconds"], summary["server_peak_rss_bytes"]
+    print(f"\n总耗时 {summary['wall_seconds']:.2f}s")
+    if cpu is not None:
+        print(f"服务器 CPU {cpu:.2f}s（{cpu / summary['wall_seconds']:.0%}，每请求 {cpu / max(1, total) * 1000:.1f}ms）")
+    if rss:
+        print(f"服务器 RSS 峰值 {rss / 1024 / 1024:.1f}MB")
+
+
+async def wait_ready(base: str, tabs: int, timeout: float = 30) -> None:
+    """等待服务器启动并且 tabs 个标签页都已连接。"""
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(base + "/status") as resp:
+                    if resp.status == 200 and len((await resp.json()).get("tabs") or ()) >= tabs:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.3)
+    raise RuntimeError("等待服务器或假标签页就绪超时")
+
+
+def stop(process: subprocess.Popen) -> None:
+    process.terminate()
+    try:
+        process.wait(5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def main():
+    tab_parser = argparse.ArgumentParser(add_help=False)
+    add_tab_arguments(tab_parser)
+    parser = argparse.ArgumentParser(description="桥接服务器压测（配合 fake_tab.py）", parents=[tab_parser])
+    parser.add_argument("--server", choices=sorted(SERVERS), help="启动指定的服务器和假标签页后再压测")
+    parser.add_argument("--url", default="http://127.0.0.1:5102", help="服务器地址")
+    parser.add_argument("--pid", type=int, default=None, help="已在运行的服务器进程 ID（用于统计 CPU 与 RSS）")
+    parser.add_argument("--mode", choices=("stream", "non-stream", "mixed"), default="mixed", help="请求模式")
+    parser.add_argument("--requests", type=int, default=200, help="请求总数")
+    parser.add_argument("--concurrency", type=int, default=16, help="并发请求数")
+    parser.add_argument("--model", default="gemini-2.5-pro", help="请求的模型名")
+    parser.add_argument("--timeout", type=float, default=120, help="单个请求的超时秒数")
+    parser.add_argument("--server-log", default=os.devnull, help="--server 模式下服务器输出的保存位置")
+    parser.add_argument("--json", help="把结果写入此 JSON 文件")
+    args = parser.parse_args()
+
+    processes = []
+    pid = args.pid
+    try:
+        if args.server:
+            env = dict(os.environ, LMARENA_PROJECT_DIR=ROOT)
+            with open(args.server_log, "w") as log:
+                server = subprocess.Popen([sys.executable] + SERVERS[args.server], cwd=ROOT, env=env,
+                                          stdout=log, stderr=subprocess.STDOUT)
+            processes.append(server)
+            pid = server.pid
+            # 假标签页的参数原样转给 fake_tab.py（选项名都是 --<dest>）
+            tab_argv = []
+            for dest in vars(tab_parser.parse_args([])):
+                if getattr(args, dest) is not None:
+                    tab_argv += [f"--{dest.replace('_', '-')}", str(getattr(args, dest))]
+            ws_url = args.url.replace("http", "ws", 1) + "/ws"
+            processes.append(subprocess.Popen([sys.executable, os.path.join(ROOT, "benchmarks", "fake_tab.py"),
+                                               "--url", ws_url] + tab_argv, stdout=subprocess.DEVNULL))
+            asyncio.run(wait_ready(args.url, args.tabs))
+        sampler = ProcessSampler(pid)
+        print(f"{args.requests} 个请求（{args.mode}），并发 {args.concurrency}，目标 {args.url}"
+              + (f"（{args.server}）" if args.server else ""), flush=True)
+        results, wall, cpu = asyncio.run(run_load(args.url, args, sampler))
+    finally:
+        for process in reversed(processes):
+            stop(process)
+    summary = summarize(results, wall, cpu, sampler)
+    summary["args"] = vars(args)
+    print_summary(summary)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
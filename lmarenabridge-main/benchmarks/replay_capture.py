@@ -0,0 +1,193 @@
+# replay_capture.py
+# 离线重放 modules/traffic_capture.py 记录的流量（traffic_capture_rate 开启后写入 captures/capture_*.jsonl.gz）。
+# 每个请求的原始数据块按记录时的分块边界送入 api_server._process_lmarena_stream，
+# 再像 stream_generator 一样编码为 SSE 块；输出 CPU 耗时、每个数据块的平均耗时，以及重放结果与记录结果不一致的请求数。
+# 用法（在 lmarenabridge-main 目录下）:
+#   python benchmarks/replay_capture.py captures/capture_*.jsonl.gz       # 以最快速度重放
+#   python benchmarks/replay_capture.py FILE... --speed 1                 # 按记录的时间间隔重放（2 表示两倍速）
+#   python benchmarks/replay_capture.py FILE... --parser-only             # 只经过 LMArenaStreamParser 与 ChunkEncoder（不需要 FastAPI）
+#   python benchmarks/replay_capture.py FILE... --events-out old.jsonl    # 保存每个请求产生的事件，用于对比两个版本的解析器
+#   python benchmarks/replay_capture.py FILE... --profile                 # 在 cProfile 下重放并输出累计耗时最多的函数
+# 记录中没有结束数据块（客户端提前断开、记录被截断）的请求，在最后一个数据块之后补一个错误，让处理器结束。
+
+import argparse
+import asyncio
+import cProfile
+import gzip
+import json
+import logging
+import os
+import pstats
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules.response_channel import ResponseChannel
+from modules.sse_encoder import ChunkEncoder
+from modules.stream_parser import LMArenaStreamParser
+
+CAPTURE_ENDED = "replay: 记录在此结束（请求未正常结束）"
+CONTENT_FILTER_WARNING = "\n\n响应被终止，可能是上下文超限或者模型内部审查（大概率）的原因"
+
+
+def load_captures(paths: list) -> list[dict]:
+    """读取记录文件，返回 [{"id", "model", "outcome", "truncated", "chunks": [(dt, data)]}]。"""
+    captures = []
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8", errors="surrogatepass") as f:
+            current = None
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record["k"] == "open":
+                    current = {"id": record["id"], "model": record.get("model") or "unknown",
+                               "outcome": None, "truncated": False, "chunks": []}
+                    captures.append(current)
+                elif current is None:
+                    continue
+                elif record["k"] == "c":
+                    current["chunks"].append((record["dt"], record["d"]))
+                elif record["k"] == "end":
+                    current["outcome"] = record.get("outcome")
+                    current["truncated"] = record.get("truncated", False)
+                    current = None
+    return captures
+
+
+def _terminated(chunks: list) -> bool:
+    return bool(chunks) and (chunks[-1][1] == "[DONE]" or isinstance(chunks[-1][1], dict))
+
+
+async def _feed(channel: ResponseChannel, chunks: list, speed: float) -> None:
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    for dt, data in chunks:
+        if speed > 0:
+            delay = start + dt / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        else:
+            await asyncio.sleep(0)  # 让处理器跟上，避免全部堆积在通道中
+        await channel.put(data)
+    if not _terminated(chunks):
+        await channel.put({"error": CAPTURE_ENDED})
+
+
+async def _parser_events(channel: ResponseChannel):
+    """--parser-only：与 _process_lmarena_stream 相同的数据块处理，但不涉及会话、指标等服务器状态（浏览器错误原样输出，不转换为提示文字）。"""
+    parser = LMArenaStreamParser()
+    while True:
+        raw = await channel.get()
+        if isinstance(raw, dict) and "error" in raw:
+            yield 'error', raw["error"]
+            return
+        done = raw == "[DONE]"
+        events = parser.close() if done else parser.feed("".join(str(x) for x in raw) if isinstance(raw, list) else raw)
+        for event_type, value in events:
+            yield ('error', value) if event_type == 'cloudflare' else (event_type, value)
+            if event_type in ('error', 'cloudflare'):
+                return
+        if done:
+            return
+
+
+async def replay_one(capture: dict, speed: float, server) -> dict:
+    """重放一个请求，返回产生的事件、SSE 字节数和重放得到的结果。"""
+    request_id = f"replay-{capture['id']}"
+    encoder = ChunkEncoder(f"chatcmpl-{request_id}", capture["model"])
+    report = {}
+    if server is not None:
+        channel = server.response_channels[request_id] = server._new_response_channel(request_id)
+        events = server._process_lmarena_stream(request_id, model=capture["model"], report=report)
+        finish_chunk, error_chunk = server.format_openai_finish_chunk, server.format_openai_error_chunk
+    else:
+        channel = ResponseChannel(request_id)
+        events = _parser_events(channel)
+        finish_chunk = lambda enc, reason: enc.chunk(None, reason) + "data: [DONE]\n\n"
+        error_chunk = lambda message, enc: enc.content(f"\n\n[LMArena Bridge Error]: {message}")
+
+    feeder = asyncio.create_task(_feed(channel, capture["chunks"], speed))
+    produced, sse_bytes, finish_reason = [], 0, 'stop'
+    try:
+        # 与 stream_generator 相同的编码
+        async for event_type, value in events:
+            produced.append((event_type, value))
+            if event_type == 'content':
+                sse_bytes += len(encoder.content_bytes(value))
+            elif event_type == 'finish':
+                finish_reason = value
+                if value == 'content-filter':
+                    sse_bytes += len(encoder.content(CONTENT_FILTER_WARNING).encode("utf-8"))
+            elif event_type == 'error':
+                sse_bytes += len(error_chunk(str(value), encoder).encode("utf-8"))
+                finish_reason = 'stop'
+                break
+        sse_bytes += len(finish_chunk(encoder, finish_reason).encode("utf-8"))
+    finally:
+        await events.aclose()
+        feeder.cancel()
+    return {"events": produced, "sse_bytes": sse_bytes, "outcome": report.get("outcome")}
+
+
+async def replay_all(captures: list, speed: float, concurrency: int, server) -> list:
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def run(capture):
+        async with semaphore:
+            return await replay_one(capture, speed, server)
+
+    return await asyncio.gather(*(run(capture) for capture in captures))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线重放流量记录")
+    parser.add_argument("files", nargs="+", help="记录文件（.jsonl.gz 或 .jsonl）")
+    parser.add_argument("--speed", type=float, default=0, help="按记录的时间间隔重放的倍速，0 表示最快速度")
+    parser.add_argument("--concurrency", type=int, default=32, help="同时重放的请求数")
+    parser.add_argument("--parser-only", action="store_true", help="只经过解析器与 SSE 编码，不导入 api_server")
+    parser.add_argument("--events-out", help="把每个请求产生的事件写入此 JSONL 文件")
+    parser.add_argument("--profile", action="store_true", help="在 cProfile 下重放")
+    args = parser.parse_args()
+
+    captures = load_captures(args.files)
+    if not captures:
+        print("记录文件中没有请求。")
+        return
+    server = None
+    if not args.parser_only:
+        import api_server as server
+        server.logger.setLevel(logging.WARNING)  # 不输出每个请求的日志
+
+    profiler = cProfile.Profile() if args.profile else None
+    cpu, wall = time.process_time(), time.perf_counter()
+    if profiler:
+        profiler.enable()
+    results = asyncio.run(replay_all(captures, args.speed, args.concurrency, server))
+    if profiler:
+        profiler.disable()
+    cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+
+    chunks = sum(len(c["chunks"]) for c in captures)
+    in_bytes = sum(len(d) for c in captures for _, d in c["chunks"] if isinstance(d, str))
+    print(f"{len(captures)} 个请求，{chunks} 个数据块，{in_bytes / 1024:.0f}KB 原始数据"
+          f"（{'解析器' if args.parser_only else '_process_lmarena_stream'}，{'最快速度' if args.speed <= 0 else f'{args.speed:g} 倍速'}）")
+    print(f"事件 {sum(len(r['events']) for r in results)} 个，SSE 输出 {sum(r['sse_bytes'] for r in results) / 1024:.0f}KB")
+    print(f"CPU {cpu * 1000:.1f}ms（每个数据块 {cpu / max(1, chunks) * 1e6:.1f}µs），墙钟 {wall:.2f}s")
+    if server is not None:
+        mismatched = Counter((c["outcome"], r["outcome"]) for c, r in zip(captures, results)
+                             if c["outcome"] != r["outcome"] and _terminated(c["chunks"]))
+        if mismatched:
+            print("重放结果与记录不一致（记录, 重放）:", dict(mismatched))
+    if args.events_out:
+        with open(args.events_out, "w", encoding="utf-8") as f:
+            for capture, result in zip(captures, results):
+                f.write(json.dumps({"id": capture["id"], "events": result["events"]}, ensure_ascii=False) + "\n")
+    if profiler:
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+
+
+if __name__ == "__main__":
+    main()
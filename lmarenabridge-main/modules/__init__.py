@@ -0,0 +1 @@
+# modules: api_server.py 与移动端后端共用的内部模块。
@@ -0,0 +1,193 @@
+# admission.py
+# 准入控制：在请求发送给浏览器之前检查全局、单标签页和单模型的并发上限。
+# 超出上限的请求进入有界的先到先服务等待队列（带超时）；队列已满、等待超时或事件循环延迟过高时
+# 立即拒绝并给出 Retry-After，让过载表现为快速失败，而不是等到 stream_response_timeout_seconds 超时。
+# api_server.py 与 TampermonkeyScript/lm模型后端.py 共用此模块。
+
+import asyncio
+import math
+import time
+from collections import deque
+
+_SERVICE_TIME_ALPHA = 0.2
+
+
+class AdmissionRejected(Exception):
+    """请求未被准入。status_code 为 429（排队已满/超时）或 503（事件循环过载）。"""
+
+    def __init__(self, reason: str, message: str, retry_after: int, status_code: int = 429):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+        self.status_code = status_code
+
+
+class _Waiter:
+    __slots__ = ("request_id", "model", "future", "enqueued_at", "avoid")
+
+    def __init__(self, request_id: str, model: str, future: asyncio.Future, avoid=()):
+        self.request_id = request_id
+        self.model = model
+        self.future = future
+        self.avoid = avoid
+        self.enqueued_at = time.time()
+
+
+class AdmissionController:
+    """
+    - acquire(): 为请求选择一个有空闲容量的标签页并调用 pool.assign()；没有容量时排队等待。
+      avoid 为应尽量避开的标签页 ID（重试时传入已失败的标签页）；其他标签页都没有容量时仍可使用它们。
+    - try_acquire(): 不排队的 acquire()，没有空闲容量时返回 None。
+    - release(): 请求结束时调用（在 pool.release() 之后），并按到达顺序放行等待中的请求。
+      排在前面的请求若只是被单模型上限挡住，不会阻塞其他模型的请求。
+    - dispatch(): 容量可能增加时调用（例如新标签页连接）。
+    - monitor_loop_lag(): 后台任务，测量事件循环延迟。
+    所有方法都只应在事件循环线程中调用（不加锁）。
+    """
+
+    def __init__(self, pool, max_in_flight: int = 0, model_limits=None, max_queue: int = 32,
+                 queue_timeout: float = 30.0, max_loop_lag: float = 0.5):
+        self.pool = pool
+        self.max_in_flight = max_in_flight
+        self.model_limits = dict(model_limits or {})
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_loop_lag = max_loop_lag
+        self.in_flight: dict[str, tuple[str, float]] = {}
+        self.model_in_flight: dict[str, int] = {}
+        self.waiters: deque[_Waiter] = deque()
+        self.loop_lag = 0.0
+        self.avg_service_time = 10.0
+        self.admitted = 0
+        self.rejected = {"queue_full": 0, "timeout": 0, "loop_lag": 0}
+
+    def configure(self, config) -> None:
+        """从 config.jsonc 读取上限（配置重新加载后调用）。0 表示不限制。"""
+        self.max_in_flight = int(config.get("max_concurrent_requests", 0) or 0)
+        self.model_limits = dict(config.get("model_concurrency_limits", {}) or {})
+        self.max_queue = int(config.get("admission_max_queue", 32))
+        self.queue_timeout = float(config.get("admission_queue_timeout_seconds", 30))
+        self.max_loop_lag = float(config.get("admission_max_loop_lag_ms", 500)) / 1000
+
+    def _model_limit(self, model: str) -> int:
+        return int(self.model_limits.get(model, self.model_limits.get("*", 0)) or 0)
+
+    def _blocker(self, model: str):
+        """返回阻止该请求立即准入的原因：'global'、'model'、'tabs'，可以准入时返回 None。"""
+        if self.max_in_flight and len(self.in_flight) >= self.max_in_flight:
+            return 'global'
+        limit = self._model_limit(model)
+        if limit and self.model_in_flight.get(model, 0) >= limit:
+            return 'model'
+        worker = self.pool.pick()
+        if worker is None or not worker.has_capacity():
+            return 'tabs'
+        return None
+
+    def _admit(self, request_id: str, model: str, avoid=()):
+        worker = self.pool.pick(exclude=avoid) if avoid else None
+        if worker is None or not worker.has_capacity():
+            worker = self.pool.pick()
+        self.pool.assign(request_id, worker)
+        self.in_flight[request_id] = (model, time.time())
+        self.model_in_flight[model] = self.model_in_flight.get(model, 0) + 1
+        self.admitted += 1
+        return worker
+
+    def retry_after(self) -> int:
+        """根据平均处理时长、排队长度和总容量估算客户端应在多少秒后重试。"""
+        capacity = sum(w.max_concurrency for w in self.pool.workers.values() if w.healthy) or 1
+        if self.max_in_flight:
+            capacity = min(capacity, self.max_in_flight)
+        estimate = self.avg_service_time * (len(self.waiters) + 1) / capacity
+        return max(1, min(120, math.ceil(estimate)))
+
+    async def acquire(self, request_id: str, model: str, avoid=()):
+        """返回已分配给该请求的标签页；无法准入时抛出 AdmissionRejected。"""
+        if self.max_loop_lag and self.loop_lag > self.max_loop_lag:
+            self.rejected["loop_lag"] += 1
+            raise AdmissionRejected('loop_lag', f"服务器过载（事件循环延迟 {self.loop_lag * 1000:.0f}ms），请稍后重试。",
+                                    self.retry_after(), status_code=503)
+        if not self.waiters and self._blocker(model) is None:
+            return self._admit(request_id, model, avoid)
+        if len(self.waiters) >= self.max_queue:
+            self.rejected["queue_full"] += 1
+            raise AdmissionRejected('queue_full', f"请求过多：等待队列已满（{self.max_queue}），请稍后重试。", self.retry_after())
+
+        waiter = _Waiter(request_id, model, asyncio.get_running_loop().create_future(), avoid)
+        self.waiters.append(waiter)
+        self.dispatch()  # 排在前面的请求可能只是被单模型上限挡住
+        try:
+            return await asyncio.wait_for(waiter.future, timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._discard(waiter)
+            self.rejected["timeout"] += 1
+            raise AdmissionRejected('timeout', f"请求在队列中等待超过 {self.queue_timeout:.0f} 秒仍未获得空闲标签页，请稍后重试。", self.retry_after())
+        except asyncio.CancelledError:
+            self._discard(waiter)
+            if waiter.future.done() and not waiter.future.cancelled():
+                # 已被准入，但调用方已经离开
+                self.pool.release(request_id)
+                self.release(request_id)
+            raise
+
+    def try_acquire(self, request_id: str, model: str, avoid=()):
+        """不排队的准入：没有请求在排队且有空闲容量时立即分配并返回标签页，否则返回 None（用于对冲等可有可无的请求）。"""
+        if self.waiters or (self.max_loop_lag and self.loop_lag > self.max_loop_lag) or self._blocker(model) is not None:
+            return None
+        return self._admit(request_id, model, avoid)
+
+    def _discard(self, waiter: _Waiter):
+        try:
+            self.waiters.remove(waiter)
+        except ValueError:
+            pass
+
+    def release(self, request_id: str):
+        entry = self.in_flight.pop(request_id, None)
+        if entry:
+            model, admitted_at = entry
+            self.model_in_flight[model] -= 1
+            if not self.model_in_flight[model]:
+                del self.model_in_flight[model]
+            duration = time.time() - admitted_at
+            self.avg_service_time += _SERVICE_TIME_ALPHA * (duration - self.avg_service_time)
+        self.dispatch()
+
+    def dispatch(self):
+        """按到达顺序放行可以准入的等待请求。"""
+        for waiter in list(self.waiters):
+            if waiter.future.done():
+                self._discard(waiter)
+                continue
+            blocker = self._blocker(waiter.model)
+            if blocker == 'model':
+                continue
+            if blocker is not None:
+                break
+            self._discard(waiter)
+            waiter.future.set_result(self._admit(waiter.request_id, waiter.model, waiter.avoid))
+
+    async def monitor_loop_lag(self, interval: float = 0.25):
+        """后台任务：测量 sleep 的超时量作为事件循环延迟，峰值会逐渐衰减。"""
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            lag = max(0.0, loop.time() - start - interval)
+            self.loop_lag = lag if lag > self.loop_lag else self.loop_lag * 0.5 + lag * 0.5
+
+    def status(self) -> dict:
+        return {
+            "in_flight": len(self.in_flight),
+            "in_flight_by_model": dict(self.model_in_flight),
+            "queued": len(self.waiters),
+            "max_in_flight": self.max_in_flight,
+            "model_limits": self.model_limits,
+            "max_queue": self.max_queue,
+            "queue_timeout_seconds": self.queue_timeout,
+            "loop_lag_ms": round(self.loop_lag * 1000, 1),
+            "avg_service_time_seconds": round(self.avg_service_time, 2),
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+        }
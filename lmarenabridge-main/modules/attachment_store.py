@@ -0,0 +1,265 @@
+# attachment_store.py
+# 按内容寻址的附件存储：客户端每轮都会重发完整历史，同一张图片的 base64 data URL 会反复出现。
+# 转换请求时附件只以短引用 {"ref": sha256} 放入载荷，data URL 本身保存在有大小上限的 LRU 中；
+# 支持引用的油猴脚本通过 GET /internal/attachments/<ref> 取回一次并在标签页内缓存，
+# 不支持的旧版脚本在发送前由 inline() 还原为完整的 data URL（转存到临时文件的附件在线程中读取，不阻塞事件循环）。
+# 流式读取请求体时（见 body_ingest.py），超过单请求内存预算的附件通过 writer() 直接写入临时文件，不在内存中驻留。
+# api_server.py 与 TampermonkeyScript/lm模型后端.py 共用此模块。
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+from collections import OrderedDict
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# 请求体中已经存入附件存储的 data URL 会被替换为 "<前缀><ref>"（见 body_ingest.py）
+REF_URL_PREFIX = "lmarena-attachment:"
+
+_REF_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+class AttachmentMissing(Exception):
+    """载荷引用的附件已被淘汰（或临时文件无法读取），无法还原为 data URL。"""
+
+    def __init__(self, ref: str):
+        super().__init__(f"附件 {ref[:12]} 已被淘汰，请重新发送该附件。")
+        self.ref = ref
+
+
+def is_valid_ref(ref: str) -> bool:
+    return bool(_REF_PATTERN.match(ref or ""))
+
+
+def _content_type(head: str) -> str:
+    """从 data URL 开头解析 MIME 类型，例如 data:image/png;base64,... -> image/png。"""
+    mime = head[5:].split(",", 1)[0].split(";", 1)[0] if head.startswith("data:") else ""
+    return mime or "application/octet-stream"
+
+
+class _SpilledAttachment:
+    """保存在临时文件中的附件（文件内容是完整的 data URL 文本）。"""
+    __slots__ = ("path", "size", "content_type")
+
+    def __init__(self, path: str, size: int, content_type: str):
+        self.path = path
+        self.size = size
+        self.content_type = content_type
+
+
+class AttachmentWriter:
+    """
+    以流的形式写入一个 data URL（JSON 字符串中的原始字节，转义序列必须完整），边写边计算哈希。
+    内存中最多保留 memory_limit 字节，超出后转存到临时文件。close() 后存入附件存储并返回引用。
+    """
+
+    def __init__(self, store: "AttachmentStore", memory_limit: int):
+        self._store = store
+        self._memory_limit = memory_limit
+        self._hash = hashlib.sha256()
+        self._chunks: list[bytes] = []
+        self._file = None
+        self._path = None
+        self._head = b""
+        self.size = 0
+
+    @property
+    def spilled(self) -> bool:
+        return self._file is not None
+
+    def write_raw(self, segment: bytes) -> None:
+        """写入 JSON 字符串中的一段原始字节（可能含有完整的转义序列）。"""
+        data = json.loads(b'"' + segment + b'"').encode("utf-8", "surrogatepass") if b"\\" in segment else bytes(segment)
+        if not data:
+            return
+        if len(self._head) < 256:
+            self._head += data[:256 - len(self._head)]
+        self._hash.update(data)
+        self.size += len(data)
+        if self._file is None and self.size > self._memory_limit:
+            self._file, self._path = self._store._new_spill_file()
+            for chunk in self._chunks:
+                self._file.write(chunk)
+            self._chunks = []
+        if self._file is not None:
+            self._file.write(data)
+        else:
+            self._chunks.append(data)
+
+    def close(self) -> str:
+        ref = self._hash.hexdigest()
+        content_type = _content_type(self._head.decode("utf-8", "replace"))
+        if self._file is not None:
+            self._file.close()
+            self._store._add_spilled(ref, self._path, self.size, content_type)
+        else:
+            self._store._add(ref, b"".join(self._chunks).decode("utf-8", "surrogatepass"))
+        return ref
+
+    def discard(self) -> None:
+        """放弃写入（例如请求体读取失败），删除临时文件。"""
+        if self._file is not None:
+            self._file.close()
+            _remove(self._path)
+        self._chunks = []
+
+
+def _read_text(path: str) -> str:
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class AttachmentStore:
+    """
+    - put(): 保存 data URL，返回其 SHA-256 引用（重复内容只保存一份，并刷新 LRU 位置）。
+    - writer(): 以流的形式写入 data URL，超过内存上限的部分写入临时文件。
+    - get() / path(): 按引用取回 data URL 文本（协程，临时文件在线程中读取）/ 临时文件路径（仅转存的附件），不存在时返回 None。
+    - inline(): 返回把载荷中附件引用还原为 data URL 的副本（协程，供不支持引用的标签页使用），附件已被淘汰时抛出 AttachmentMissing。
+    内存与临时文件合计不超过 max_bytes。所有方法都只应在事件循环线程中调用（不加锁）。
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0       # 内存中的 data URL 字符数
+        self.disk_size = 0  # 临时文件字节数
+        self.hits = 0
+        self.misses = 0
+        self._items: OrderedDict[str, str | _SpilledAttachment] = OrderedDict()
+        self._spill_dir: str | None = None
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def configure(self, config) -> None:
+        """从 config.jsonc 读取容量上限（配置重新加载后调用）。"""
+        self.max_bytes = int(config.get("attachment_store_max_mb", DEFAULT_MAX_BYTES // (1024 * 1024))) * 1024 * 1024
+        self._evict()
+
+    def put(self, data_url: str) -> str:
+        ref = hashlib.sha256(data_url.encode("utf-8", "surrogatepass")).hexdigest()
+        self._add(ref, data_url)
+        return ref
+
+    def writer(self, memory_limit: int) -> AttachmentWriter:
+        return AttachmentWriter(self, memory_limit)
+
+    def _add(self, ref: str, data_url: str) -> None:
+        if self._reuse(ref):
+            return
+        self._items[ref] = data_url
+        self.size += len(data_url)
+        self._evict(keep=ref)
+
+    def _add_spilled(self, ref: str, path: str, size: int, content_type: str) -> None:
+        if self._reuse(ref):
+            _remove(path)
+            return
+        self._items[ref] = _SpilledAttachment(path, size, content_type)
+        self.disk_size += size
+        self._evict(keep=ref)
+
+    def _reuse(self, ref: str) -> bool:
+        if ref in self._items:
+            self._items.move_to_end(ref)
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def _new_spill_file(self):
+        if self._spill_dir is None or not os.path.isdir(self._spill_dir):
+            self._spill_dir = tempfile.mkdtemp(prefix="lmarena-attachments-")
+        fd, path = tempfile.mkstemp(suffix=".txt", dir=self._spill_dir)
+        return os.fdopen(fd, "wb"), path
+
+    async def get(self, ref: str) -> str | None:
+        item = self._items.get(ref)
+        if item is None:
+            return None
+        self._items.move_to_end(ref)
+        if isinstance(item, _SpilledAttachment):
+            # 读取期间附件可能被淘汰（文件被删除），按不存在处理
+            try:
+                return await asyncio.to_thread(_read_text, item.path)
+            except OSError:
+                return None
+        return item
+
+    def path(self, ref: str) -> str | None:
+        """转存到临时文件的附件返回文件路径（可直接作为文件响应发送），内存中的附件返回 None。"""
+        item = self._items.get(ref)
+        if isinstance(item, _SpilledAttachment):
+            self._items.move_to_end(ref)
+            return item.path
+        return None
+
+    def describe(self, ref: str) -> tuple[str, int] | None:
+        """返回附件的 (MIME 类型, data URL 长度)，不存在时返回 None。"""
+        item = self._items.get(ref)
+        if item is None:
+            return None
+        if isinstance(item, _SpilledAttachment):
+            return item.content_type, item.size
+        return _content_type(item[:256]), len(item)
+
+    def _evict(self, keep: str | None = None) -> None:
+        # 刚放入的附件即使单独超过上限也保留，直到下一次放入时淘汰
+        while self.size + self.disk_size > self.max_bytes and len(self._items) > 1:
+            ref, item = next(iter(self._items.items()))
+            if ref == keep:
+                break
+            del self._items[ref]
+            if isinstance(item, _SpilledAttachment):
+                self.disk_size -= item.size
+                _remove(item.path)
+            else:
+                self.size -= len(item)
+
+    def close(self) -> None:
+        """删除所有临时文件（服务器退出时调用）。"""
+        self._items.clear()
+        self.size = self.disk_size = 0
+        if self._spill_dir:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
+
+    async def inline(self, payload: dict) -> dict:
+        """返回附件引用被替换为 data URL 的载荷副本；没有引用时返回原载荷。引用的附件不存在时抛出 AttachmentMissing。"""
+        templates = payload.get("message_templates") or ()
+        if not any(a.get("ref") for t in templates for a in t.get("attachments") or ()):
+            return payload
+        inlined = []
+        for template in templates:
+            attachments = []
+            for attachment in template.get("attachments") or ():
+                ref = attachment.get("ref")
+                if ref:
+                    attachment = {k: v for k, v in attachment.items() if k not in ("ref", "size")}
+                    url = await self.get(ref)
+                    if url is None:
+                        raise AttachmentMissing(ref)
+                    attachment["url"] = url
+                attachments.append(attachment)
+            inlined.append({**template, "attachments": attachments})
+        return {**payload, "message_templates": inlined}
+
+    def status(self) -> dict:
+        return {
+            "entries": len(self._items),
+            "size_chars": self.size,
+            "disk_bytes": self.disk_size,
+            "max_bytes": self.max_bytes,
+            "reused": self.hits,
+            "stored": self.misses,
+        }
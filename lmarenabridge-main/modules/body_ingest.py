@@ -0,0 +1,226 @@
+# body_ingest.py
+# 流式读取 /v1/chat/completions 的请求体。
+# 多模态请求的 base64 图片可能有几十 MB，request.json() 会先把整个请求体读入内存，再解析出同样大小的字符串，
+# 之后转换载荷时还会再复制。这里边接收边扫描 JSON：
+# - 超过 max_request_body_mb 时立即返回 413（有 Content-Length 时在读取前就拒绝），不再读取剩余部分；
+# - messages[].content[].image_url.url 中的 data URL 不进入解析结果，而是边读边写入附件存储（超过单请求内存预算的部分写入临时文件），
+#   在 JSON 中替换为 "lmarena-attachment:<ref>"，_process_openai_message 直接使用该引用（其他位置的 "url" 字段原样保留）；
+# - 其余部分（文本消息等）通常很小，最后交给 json.loads 解析并校验。
+# api_server.py 与 TampermonkeyScript/lm模型后端.py 共用此模块。
+
+import json
+import re
+
+from modules.attachment_store import REF_URL_PREFIX
+
+DEFAULT_MAX_BODY_BYTES = 64 * 1024 * 1024
+DEFAULT_MEMORY_BUDGET = 4 * 1024 * 1024
+
+_STRUCTURAL = re.compile(rb'["{}\[\],:]')
+_STRING_SPECIAL = re.compile(rb'["\\]')
+_HIGH_SURROGATE = re.compile(rb'\\u[dD][89abAB][0-9a-fA-F]{2}')
+_URL_KEY = b"url"
+# 附件 "url" 所在对象的容器路径：每一层为该容器所属的键，数组元素为 None
+_ATTACHMENT_PATH = (None, b"messages", None, b"content", None, b"image_url")
+# 键只需保留到足以与路径中最长的键区分
+_KEY_LIMIT = max(len(k) for k in _ATTACHMENT_PATH if k) + 1
+_DATA_PREFIX = b"data:"
+
+# 字符串扫描状态
+_PLAIN, _KEY, _PROBE, _ATTACHMENT = range(4)
+
+
+class BodyTooLarge(Exception):
+    """请求体超过 max_request_body_mb（对应 HTTP 413）。"""
+
+    def __init__(self, limit: int):
+        super().__init__(f"请求体超过 {limit // (1024 * 1024)} MB 上限。")
+        self.limit = limit
+
+
+def limits_from_config(config) -> tuple[int, int]:
+    """返回 (请求体字节上限, 单请求内存预算字节数)。"""
+    max_body = int(config.get("max_request_body_mb", DEFAULT_MAX_BODY_BYTES // (1024 * 1024))) * 1024 * 1024
+    budget = int(config.get("request_memory_budget_kb", DEFAULT_MEMORY_BUDGET // 1024)) * 1024
+    return max_body, budget
+
+
+def check_content_length(value, max_body_bytes: int) -> None:
+    """请求头声明的长度已经超过上限时抛出 BodyTooLarge（不读取请求体）。"""
+    try:
+        length = int(value) if value is not None else None
+    except ValueError:
+        return
+    if length is not None and max_body_bytes and length > max_body_bytes:
+        raise BodyTooLarge(max_body_bytes)
+
+
+def _escape_length(buf: bytes, pos: int) -> int:
+    """buf[pos] 为反斜杠，返回完整转义序列的长度（UTF-16 代理对按一个序列计算）。"""
+    if buf[pos + 1:pos + 2] != b"u":
+        return 2
+    if _HIGH_SURROGATE.match(buf, pos):
+        return 12
+    return 6
+
+
+class _Scanner:
+    """增量扫描 JSON 字节流，把 messages[].content[].image_url.url 中的 data URL 写入附件存储，其余字节原样输出。"""
+
+    def __init__(self, store, memory_budget: int):
+        self.store = store
+        self.budget = memory_budget
+        self.out = bytearray()
+        self.stack = bytearray()  # b"{" 或 b"["
+        self.path = []  # 与 stack 对应：每个容器所属的键（数组元素与根为 None）
+        self.expect_key = False
+        self.last_key = b""
+        self.in_string = False
+        self.mode = _PLAIN
+        self.key = bytearray()
+        self.probe = bytearray()
+        self.writer = None
+        self.pending = b""
+        self.attachments = 0
+        self.spilled = 0
+
+    def feed(self, chunk: bytes) -> None:
+        buf = self.pending + chunk if self.pending else chunk
+        self.pending = b""
+        i, n = 0, len(buf)
+        while i < n:
+            if self.in_string:
+                m = _STRING_SPECIAL.search(buf, i)
+                if m is None:
+                    self._string_bytes(buf[i:])
+                    return
+                j = m.start()
+                if buf[j] == 0x22:  # '"'
+                    self._string_bytes(buf[i:j])
+                    self._end_string()
+                    i = j + 1
+                    continue
+                if j + 1 >= n or j + _escape_length(buf, j) > n:
+                    # 转义序列被数据块截断，留到下一块
+                    self._string_bytes(buf[i:j])
+                    self.pending = bytes(buf[j:])
+                    return
+                end = j + _escape_length(buf, j)
+                self._string_bytes(buf[i:end])
+                i = end
+                continue
+            m = _STRUCTURAL.search(buf, i)
+            if m is None:
+                self.out += buf[i:]
+                return
+            j = m.start()
+            self.out += buf[i:j]
+            token = buf[j]
+            i = j + 1
+            if token == 0x22:
+                self._start_string()
+                continue
+            self.out.append(token)
+            if token in (0x7B, 0x5B):  # { [
+                in_object = bool(self.stack) and self.stack[-1] == 0x7B
+                self.path.append(self.last_key if in_object else None)
+                self.stack.append(token)
+                self.expect_key = token == 0x7B
+            elif token in (0x7D, 0x5D):  # } ]
+                if self.stack:
+                    self.stack.pop()
+                    self.path.pop()
+                self.expect_key = False
+            elif token == 0x2C:  # ,
+                self.expect_key = bool(self.stack) and self.stack[-1] == 0x7B
+            else:  # :
+                self.expect_key = False
+
+    def _start_string(self) -> None:
+        self.in_string = True
+        in_object = bool(self.stack) and self.stack[-1] == 0x7B
+        if in_object and self.expect_key:
+            self.mode = _KEY
+            self.key.clear()
+            self.out.append(0x22)
+        elif in_object and self.last_key == _URL_KEY and tuple(self.path) == _ATTACHMENT_PATH:
+            self.mode = _PROBE
+            self.probe.clear()
+        else:
+            self.mode = _PLAIN
+            self.out.append(0x22)
+
+    def _string_bytes(self, data) -> None:
+        if not data:
+            return
+        if self.mode == _ATTACHMENT:
+            self.writer.write_raw(data)
+        elif self.mode == _PROBE:
+            self.probe += data
+            if len(self.probe) >= len(_DATA_PREFIX):
+                self._decide()
+        else:
+            self.out += data
+            if self.mode == _KEY and len(self.key) <= _KEY_LIMIT:
+                self.key += data
+
+    def _decide(self) -> None:
+        """值的开头已经足够判断：data URL 转入附件写入器，否则按普通字符串输出。"""
+        if self.probe.startswith(_DATA_PREFIX):
+            self.writer = self.store.writer(max(self.budget, 0))
+            self.writer.write_raw(bytes(self.probe))
+            self.mode = _ATTACHMENT
+        else:
+            self.out.append(0x22)
+            self.out += self.probe
+            self.mode = _PLAIN
+        self.probe.clear()
+
+    def _end_string(self) -> None:
+        self.in_string = False
+        if self.mode == _PROBE:
+            self._decide()
+        if self.mode == _ATTACHMENT:
+            writer, self.writer = self.writer, None
+            ref = writer.close()
+            self.attachments += 1
+            if writer.spilled:
+                self.spilled += 1
+            else:
+                self.budget -= writer.size
+            self.out += json.dumps(REF_URL_PREFIX + ref).encode("ascii")
+            return
+        self.out.append(0x22)
+        if self.mode == _KEY:
+            self.last_key = bytes(self.key)
+            self.expect_key = False
+
+    def discard(self) -> None:
+        if self.writer is not None:
+            self.writer.discard()
+            self.writer = None
+
+
+async def ingest_json(chunks, store, max_body_bytes: int = DEFAULT_MAX_BODY_BYTES,
+                      memory_budget: int = DEFAULT_MEMORY_BUDGET) -> tuple[object, dict]:
+    """
+    从异步字节块迭代器读取并解析 JSON 请求体，返回 (解析结果, 统计信息)。
+    超过上限时抛出 BodyTooLarge，JSON 无效时抛出 ValueError。
+    """
+    scanner = _Scanner(store, memory_budget)
+    total = 0
+    try:
+        async for chunk in chunks:
+            total += len(chunk)
+            if max_body_bytes and total > max_body_bytes:
+                raise BodyTooLarge(max_body_bytes)
+            scanner.feed(chunk)
+        if scanner.in_string or scanner.pending:
+            raise ValueError("请求体在字符串中间结束")
+    except BaseException:
+        scanner.discard()
+        raise
+    data = json.loads(bytes(scanner.out)) if scanner.out.strip() else None
+    if data is None:
+        raise ValueError("请求体为空")
+    return data, {"bytes": total, "attachments": scanner.attachments, "spilled": scanner.spilled}
@@ -0,0 +1,122 @@
+# cancellation.py
+# 通知标签页取消不再需要的请求（api_server.py 与 TampermonkeyScript/lm模型后端.py 共用）。
+# 客户端断开或服务器等待超时后，响应通道被清理，但油猴脚本并不知道，仍会继续读取 LMArena 的响应并回传，
+# 占用标签页与 LMArena 的并发，回传的数据也只会被记为“未知或已关闭请求”。
+# 现在请求在标签页完成之前结束时，向负责它的标签页发送 {"command": "cancel", "request_id": ...}，
+# 脚本中止 fetch 后回复 {"cancelled": request_id}；从发出指令到收到回复的时间记为取消延迟。
+# 取消之后陆续到达的数据块（已在途的帧、脚本的结束记录）不再记录警告，只计数。
+# 流式请求在写出失败时就能发现客户端断开；非流式请求在聚合期间不写出任何内容，由 until_disconnected 定期检查。
+
+import asyncio
+import inspect
+import time
+
+# 已取消的请求保留多久，用于识别之后到达的数据块和迟到的确认
+RECENT_SECONDS = 60.0
+
+
+def ack_request_id(message) -> str | None:
+    """文本帧是取消确认时返回其 request_id，否则返回 None。"""
+    if isinstance(message, dict) and "cancelled" in message and "request_id" not in message:
+        value = message["cancelled"]
+        return value if isinstance(value, str) else None
+    return None
+
+
+class CancelTracker:
+    """
+    - cancel(worker, request_id, reason): 在后台向标签页发送 cancel 指令（不阻塞调用方，可在 finally 中调用）。
+    - ack(request_id): 收到确认时调用，返回取消延迟（秒）；未发出过指令或重复确认时返回 None。
+    - is_cancelled(request_id): 最近是否取消过该请求（用于忽略之后到达的数据块）。
+    所有方法都只应在事件循环线程中调用（不加锁）。
+    """
+
+    def __init__(self, recent_seconds: float = RECENT_SECONDS):
+        self.recent_seconds = recent_seconds
+        self._recent: dict[str, list] = {}  # request_id -> [发出时间, 原因, 是否已确认]
+        self._tasks: set[asyncio.Task] = set()
+        self.stats = {"sent": 0, "acked": 0, "send_failed": 0, "late_chunks": 0}
+        self.by_reason: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return sum(1 for entry in self._recent.values() if not entry[2])
+
+    def cancel(self, worker, request_id: str, reason: str) -> None:
+        if worker is None or request_id in self._recent:
+            return
+        self._prune()
+        self._recent[request_id] = [time.monotonic(), reason, False]
+        self.by_reason[reason] = self.by_reason.get(reason, 0) + 1
+        task = asyncio.get_running_loop().create_task(self._send(worker, request_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, worker, request_id: str) -> None:
+        try:
+            await worker.send_json({"command": "cancel", "request_id": request_id})
+            self.stats["sent"] += 1
+        except Exception:
+            self.stats["send_failed"] += 1
+
+    def ack(self, request_id: str) -> float | None:
+        entry = self._recent.get(request_id)
+        if entry is None or entry[2]:
+            return None
+        entry[2] = True
+        self.stats["acked"] += 1
+        return time.monotonic() - entry[0]
+
+    def is_cancelled(self, request_id: str) -> bool:
+        return request_id in self._recent
+
+    def late_chunk(self) -> None:
+        self.stats["late_chunks"] += 1
+
+    def _prune(self) -> None:
+        cutoff = time.monotonic() - self.recent_seconds
+        for request_id in [r for r, entry in self._recent.items() if entry[0] < cutoff]:
+            del self._recent[request_id]
+
+    def status(self) -> dict:
+        self._prune()
+        return {"awaiting_ack": len(self), "stats": dict(self.stats), "by_reason": dict(self.by_reason)}
+
+
+async def _wait_disconnected(is_disconnected, interval: float) -> None:
+    while True:
+        result = is_disconnected()
+        if inspect.isawaitable(result):
+            result = await result
+        if result:
+            return
+        await asyncio.sleep(interval)
+
+
+async def until_disconnected(events, is_disconnected, interval: float = 1.0):
+    """
+    转发异步生成器 events 产生的 (类型, 值) 事件；is_disconnected()（普通函数或协程函数）返回真时，
+    取消 events（其 finally 随即执行，发出 cancel 指令），产生 ('client_disconnected', None) 后结束。
+    """
+    watcher = asyncio.ensure_future(_wait_disconnected(is_disconnected, interval))
+    step = None
+    try:
+        while True:
+            step = asyncio.ensure_future(events.__anext__())
+            await asyncio.wait({step, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if not step.done():
+                yield "client_disconnected", None
+                return
+            try:
+                item = step.result()
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        watcher.cancel()
+        if step is not None and not step.done():
+            step.cancel()
+            try:
+                await step
+            except (asyncio.CancelledError, StopAsyncIteration):
+                pass
+        await events.aclose()
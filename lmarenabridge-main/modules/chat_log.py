@@ -0,0 +1,235 @@
+# chat_log.py
+# 对话记录的后台写入（TampermonkeyScript/lm模型后端.py 使用）。
+# 原先每个请求结束时在事件循环中同步写两个文件，并对整个请求做带缩进的 json.dumps，写入期间所有流都会停顿。
+# 现在请求路径上只是一次入队；专用线程批量取出记录，追加到按大小/时间轮换的 JSONL 文件（每行一条记录），
+# 并按需为每条记录生成便于阅读的 Markdown 文件。
+# 队列已满时按 chat_log_full_policy 处理：drop（默认）丢弃并计数；block 在工作线程中等待入队，最多 chat_log_block_timeout_ms。
+
+import asyncio
+import json
+import os
+import queue
+import re
+import threading
+import time
+from datetime import datetime
+
+DEFAULT_QUEUE_SIZE = 1000
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_ROTATE_BYTES = 16 * 1024 * 1024
+DEFAULT_ROTATE_SECONDS = 24 * 3600
+FLUSH_INTERVAL = 1.0
+
+_STOP = object()
+
+
+def _safe(s: str) -> str:
+    return re.sub(r'[\\/:*?"<>|]+', '_', s)
+
+
+def _prompt_snippet(req: dict) -> str:
+    """最后一条用户消息的前 20 个字符，用作 Markdown 文件名的一部分。"""
+    messages = req.get("messages", [])
+    if messages and isinstance(messages, list):
+        for msg in reversed(messages):
+            if isinstance(msg, dict) and msg.get("role") == "user":
+                content = msg.get("content")
+                if isinstance(content, str):
+                    return content.strip()[:20] or "空提问"
+                if isinstance(content, list):  # 多模态消息
+                    for part in content:
+                        if isinstance(part, dict) and part.get("type") == "text":
+                            return part.get("text", "").strip()[:20] or "图片提问"
+                break
+    return "无提问"
+
+
+def _markdown(rec: dict) -> str:
+    return "\n".join([
+        f"# 模型: {rec['model'] or 'unknown'}",
+        f"- 时间: {rec['timestamp']}",
+        f"- 结束原因: {rec['finish_reason']}",
+        "",
+        "## 提问",
+        "```json",
+        json.dumps(rec["request"].get("messages", []), ensure_ascii=False, indent=2),
+        "```",
+        "",
+        "## 回复",
+        rec["reply"] or "",
+    ])
+
+
+class ChatLogWriter:
+    """
+    - save(): 协程，在事件循环中调用；通常只是一次 put_nowait。
+    - 写线程在第一次 save() 时启动，close() 写完队列中剩余的记录后退出。
+    - stats: written / dropped / batches / rotations / errors。
+    请求字典在入队后由写线程读取，调用方之后不应再修改它。
+    """
+
+    def __init__(self, base_dir: str):
+        self.dir = base_dir
+        self.policy = "drop"
+        self.block_timeout = 0.5
+        self.batch_size = DEFAULT_BATCH_SIZE
+        self.rotate_bytes = DEFAULT_ROTATE_BYTES
+        self.rotate_seconds = DEFAULT_ROTATE_SECONDS
+        self.markdown = True
+        self.stats = {"written": 0, "dropped": 0, "batches": 0, "rotations": 0, "errors": 0}
+        self.current_file: str | None = None
+        self._queue: queue.Queue = queue.Queue(DEFAULT_QUEUE_SIZE)
+        self._thread: threading.Thread | None = None
+        self._file = None
+        self._file_size = 0
+        self._file_opened = 0.0
+
+    @property
+    def dropped(self) -> int:
+        return self.stats["dropped"]
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def configure(self, config) -> None:
+        """从 config.jsonc 读取队列与轮换参数（配置重新加载后调用）。"""
+        self._queue.maxsize = max(1, int(config.get("chat_log_queue_size", DEFAULT_QUEUE_SIZE)))
+        self.policy = "block" if config.get("chat_log_full_policy", "drop") == "block" else "drop"
+        self.block_timeout = int(config.get("chat_log_block_timeout_ms", 500)) / 1000
+        self.rotate_bytes = int(config.get("chat_log_rotate_mb", DEFAULT_ROTATE_BYTES // (1024 * 1024))) * 1024 * 1024
+        self.rotate_seconds = float(config.get("chat_log_rotate_hours", DEFAULT_ROTATE_SECONDS / 3600)) * 3600
+        self.markdown = bool(config.get("chat_log_markdown", True))
+
+    async def save(self, model: str, req: dict, reply: str, reason: str) -> bool:
+        """把一条对话记录放入写入队列；返回 False 表示队列已满、记录被丢弃。"""
+        rec = {"timestamp": datetime.now().strftime("%Y-%m-%d_%H-%M-%S"), "model": model,
+               "finish_reason": reason, "request": req, "reply": reply}
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(rec)
+            return True
+        except queue.Full:
+            pass
+        if self.policy == "block":
+            try:
+                await asyncio.to_thread(self._queue.put, rec, True, self.block_timeout)
+                return True
+            except queue.Full:
+                pass
+        self.stats["dropped"] += 1
+        return False
+
+    def _ensure_thread(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="chat-log-writer", daemon=True)
+            self._thread.start()
+
+    def close(self, timeout: float = 5.0) -> None:
+        """写完队列中的记录并停止写线程（服务器退出时调用）。"""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    # --- 以下方法只在写线程中运行 ---
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            try:
+                first = self._queue.get(timeout=FLUSH_INTERVAL)
+            except queue.Empty:
+                self._maybe_rotate()
+                continue
+            batch = []
+            item = first
+            while True:
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self._write_batch(batch)
+        self._close_file()
+
+    def _write_batch(self, batch: list) -> None:
+        lines = []
+        for rec in batch:
+            try:
+                lines.append(json.dumps(rec, ensure_ascii=False) + "\n")
+            except (TypeError, ValueError):
+                self.stats["errors"] += 1
+        try:
+            self._maybe_rotate()
+            if self._file is None:
+                self._open_file()
+            data = "".join(lines).encode("utf-8")
+            self._file.write(data)
+            self._file.flush()
+            self._file_size += len(data)
+            self.stats["written"] += len(lines)
+            self.stats["batches"] += 1
+        except OSError as e:
+            self.stats["errors"] += 1
+            print(f"[WARN] 写入对话日志失败: {e}")
+            self._close_file()
+        if self.markdown:
+            for rec in batch:
+                self._write_markdown(rec)
+
+    def _write_markdown(self, rec: dict) -> None:
+        base = f"{rec['timestamp']}_{_safe(rec['model'] or 'unknown')}_{_safe(_prompt_snippet(rec['request']))}"
+        try:
+            with open(os.path.join(self.dir, f"{base}.md"), "w", encoding="utf-8") as f:
+                f.write(_markdown(rec))
+        except (OSError, TypeError, ValueError) as e:
+            self.stats["errors"] += 1
+            print(f"[WARN] 保存Markdown日志失败: {e}")
+
+    def _open_file(self) -> None:
+        os.makedirs(self.dir, exist_ok=True)
+        stem = os.path.join(self.dir, f"chat_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}")
+        path, n = f"{stem}.jsonl", 1
+        while os.path.exists(path):  # 同一秒内多次轮换
+            path, n = f"{stem}_{n}.jsonl", n + 1
+        self._file = open(path, "wb")
+        self._file_size = 0
+        self._file_opened = time.monotonic()
+        self.current_file = path
+
+    def _maybe_rotate(self) -> None:
+        if self._file is None:
+            return
+        too_big = self.rotate_bytes > 0 and self._file_size >= self.rotate_bytes
+        too_old = self.rotate_seconds > 0 and time.monotonic() - self._file_opened >= self.rotate_seconds
+        if too_big or too_old:
+            self._close_file()
+            self.stats["rotations"] += 1
+
+    def _close_file(self) -> None:
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            self._file = None
+
+    def status(self) -> dict:
+        return {
+            "dir": self.dir,
+            "current_file": self.current_file,
+            "queue_depth": self.qsize(),
+            "queue_size": self._queue.maxsize,
+            "policy": self.policy,
+            "markdown": self.markdown,
+            "stats": dict(self.stats),
+        }
@@ -0,0 +1,125 @@
+# coalesce.py
+# 流式响应的增量合并（api_server.py 与 TampermonkeyScript/lm模型后端.py 共用，需显式开启）。
+# LMArena 的每条 a0 记录通常只有一两个 token，逐条转发时每个 token 都要一次 json.dumps 和一次写出；
+# 同时进行的流较多时，这些很小的 SSE 事件占用了大部分 CPU 和系统调用。
+# 开启后，在 sse_coalesce_window_ms 时间窗口内到达的内容增量合并为一个 SSE 事件，
+# 累计超过 sse_coalesce_max_bytes 时立即发出；结束原因、错误等其他事件到达时先发出已合并的内容，再立即转发。
+# 第一个内容块总是立即发出（不影响首字延迟），之后每个增量最多延迟一个窗口（通常 15–30ms，肉眼不可见）。
+
+import asyncio
+
+from modules.metrics import utf8_len
+
+DEFAULT_MAX_BYTES = 4096
+
+
+def settings_from_config(config) -> tuple[float, int]:
+    """返回 (合并窗口秒数, 单个事件的字节上限)；窗口为 0 表示关闭。"""
+    window = max(0.0, float(config.get("sse_coalesce_window_ms", 0) or 0)) / 1000
+    max_bytes = max(1, int(config.get("sse_coalesce_max_bytes", DEFAULT_MAX_BYTES)))
+    return window, max_bytes
+
+
+class _Pump:
+    """
+    在单独的任务中读取上游事件并缓存，只在需要时唤醒消费方：
+    缓存为空时来了任何事件、非内容事件、缓存的内容达到字节上限、上游结束。
+    同一窗口内的其他内容增量只追加到列表，不产生唤醒、定时器或任务，这是合并能节省 CPU 的关键。
+    缓存的内容达到字节上限后暂停读取，直到消费方取走（保持上游的流控有效）。
+    """
+
+    def __init__(self, events, max_bytes: int):
+        self.events = events
+        self.max_bytes = max_bytes
+        self.items = []
+        self.size = 0
+        self.finished = False
+        self.error = None
+        self.urgent = False  # 有需要立即发出的事件
+        self.waiter = None  # 消费方正在等待的 future
+        self.wake_on_any = True  # 消费方缓存为空，任何事件都应唤醒它
+        self.room = None  # 缓存已满时本任务等待的 future
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def wake(self) -> None:
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def _run(self) -> None:
+        try:
+            async for item in self.events:
+                self.items.append(item)
+                if item[0] == 'content':
+                    self.size += utf8_len(item[1])
+                    if self.size >= self.max_bytes:
+                        self.urgent = True
+                else:
+                    self.urgent = True
+                if self.urgent or self.wake_on_any:
+                    self.wake()
+                if self.size >= self.max_bytes:
+                    self.room = asyncio.get_running_loop().create_future()
+                    await self.room
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished = True
+            self.wake()
+
+    def take(self) -> list:
+        """取走缓存的全部事件，相邻的内容增量合并为一个。"""
+        merged, parts = [], []
+        for event_type, value in self.items:
+            if event_type == 'content':
+                parts.append(value)
+                continue
+            if parts:
+                merged.append(('content', "".join(parts)))
+                parts = []
+            merged.append((event_type, value))
+        if parts:
+            merged.append(('content', "".join(parts)))
+        self.items, self.size, self.urgent = [], 0, False
+        if self.room is not None and not self.room.done():
+            self.room.set_result(None)
+        return merged
+
+
+async def coalesce_content(events, window: float, max_bytes: int):
+    """
+    转发 (类型, 值) 事件，把 window 秒内连续到达的 'content' 合并为一个；
+    非内容事件（结束原因、错误）和上游结束时立即发出（已合并的内容在它之前发出）。
+    """
+    loop = asyncio.get_running_loop()
+    pump = _Pump(events, max_bytes)
+    first = True  # 第一个内容块立即发出，不增加首字延迟
+    try:
+        while True:
+            if not pump.items and not pump.finished:
+                pump.wake_on_any = True
+                pump.waiter = loop.create_future()
+                await pump.waiter
+            if pump.items and not pump.urgent and not pump.finished and not first:
+                # 只有内容：等到窗口结束，期间只被需要立即发出的事件唤醒
+                pump.wake_on_any = False
+                pump.waiter = loop.create_future()
+                timer = loop.call_later(window, pump.wake)
+                try:
+                    await pump.waiter
+                finally:
+                    timer.cancel()
+            first = False
+            for item in pump.take():
+                yield item
+            if pump.finished and not pump.items:
+                if pump.error is not None:
+                    raise pump.error
+                return
+    finally:
+        if not pump.task.done():
+            pump.task.cancel()
+            try:
+                await pump.task
+            except asyncio.CancelledError:
+                pass
+        await events.aclose()
@@ -0,0 +1,143 @@
+# config_store.py
+# 配置快照：config.jsonc、models.json、model_endpoint_map.json 只在文件发生变化时重新解析。
+# 每次重新加载都会生成一个新的只读快照并整体替换，正在处理的请求持有旧快照，视图始终一致。
+# api_server.py 与 TampermonkeyScript/lm模型后端.py 共用此模块。
+
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Any, Mapping
+
+CONFIG_FILE = "config.jsonc"
+MODELS_FILE = "models.json"
+ENDPOINT_MAP_FILE = "model_endpoint_map.json"
+
+_EMPTY = MappingProxyType({})
+
+
+def parse_jsonc(text: str) -> dict:
+    """解析 JSONC 文本：移除 // 行注释和 /* */ 块注释。空文本返回空字典。"""
+    text = re.sub(r'//.*', '', text)
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.DOTALL)
+    return json.loads(text) if text.strip() else {}
+
+
+def parse_model_map(raw: dict) -> dict:
+    """将 models.json 的原始映射转换为 {name: {"id": ..., "type": ...}}，支持 'id:type' 格式。"""
+    processed = {}
+    for name, value in raw.items():
+        if isinstance(value, str) and ':' in value:
+            model_id, model_type = value.split(':', 1)
+            processed[name] = {"id": None if model_id.lower() == 'null' else model_id, "type": model_type}
+        else:
+            # 默认或旧格式处理
+            processed[name] = {"id": value, "type": "text"}
+    return processed
+
+
+def diff_keys(old: Mapping, new: Mapping) -> dict:
+    """比较两个映射的键和值，返回 added/removed/changed 键名列表（不含具体值，避免泄露 api_key 等）。"""
+    return {
+        "added": sorted(k for k in new if k not in old),
+        "removed": sorted(k for k in old if k not in new),
+        "changed": sorted(k for k in new if k in old and old[k] != new[k]),
+    }
+
+
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    """某一时刻三个配置文件的只读视图。"""
+    config: Mapping[str, Any] = field(default_factory=lambda: _EMPTY)
+    models: Mapping[str, Any] = field(default_factory=lambda: _EMPTY)
+    endpoint_map: Mapping[str, Any] = field(default_factory=lambda: _EMPTY)
+    generation: int = 0
+    loaded_at: float = field(default_factory=time.time)
+
+
+class ConfigStore:
+    """
+    维护当前配置快照。
+    - reload(): 检查三个文件的 mtime/大小，只重新解析发生变化的文件，并原子地替换快照。
+    - watch(): 在后台定期调用 reload()（文件读取和解析放在工作线程中，不阻塞事件循环）。
+    解析失败时保留该文件上一次成功加载的内容（首次加载失败则为空）。
+    """
+
+    def __init__(self, base_dir: str = "."):
+        self.base_dir = base_dir
+        self.snapshot = ConfigSnapshot()
+        self._stamps: dict[str, tuple | None] = {}
+        self._lock = threading.Lock()
+
+    def _path(self, filename: str) -> str:
+        return os.path.join(self.base_dir, filename)
+
+    def _stamp(self, filename: str):
+        try:
+            st = os.stat(self._path(filename))
+            return (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            return None
+
+    def _load(self, filename: str) -> dict:
+        with open(self._path(filename), 'r', encoding='utf-8') as f:
+            content = f.read()
+        if filename == CONFIG_FILE:
+            return parse_jsonc(content)
+        data = json.loads(content) if content.strip() else {}
+        return parse_model_map(data) if filename == MODELS_FILE else data
+
+    def reload(self, force: bool = False) -> dict:
+        """
+        重新加载有变化的文件。返回变化摘要，例如:
+        {"config.jsonc": {"added": [], "removed": [], "changed": ["session_id"]}, "errors": {...}}
+        没有任何变化时返回空字典。
+        """
+        with self._lock:
+            current = self.snapshot
+            values = {CONFIG_FILE: current.config, MODELS_FILE: current.models, ENDPOINT_MAP_FILE: current.endpoint_map}
+            changes, errors = {}, {}
+            for filename, old_value in values.items():
+                stamp = self._stamp(filename)
+                if not force and filename in self._stamps and stamp == self._stamps[filename]:
+                    continue
+                self._stamps[filename] = stamp
+                if stamp is None:
+                    errors[filename] = "文件未找到"
+                    new_value = {}
+                else:
+                    try:
+                        new_value = self._load(filename)
+                    except (OSError, ValueError) as e:
+                        errors[filename] = str(e)
+                        continue
+                diff = diff_keys(old_value, new_value)
+                if any(diff.values()) or force:
+                    changes[filename] = diff
+                values[filename] = MappingProxyType(new_value)
+
+            if changes:
+                self.snapshot = ConfigSnapshot(
+                    config=values[CONFIG_FILE],
+                    models=values[MODELS_FILE],
+                    endpoint_map=values[ENDPOINT_MAP_FILE],
+                    generation=current.generation + 1,
+                )
+            if errors:
+                changes["errors"] = errors
+            return changes
+
+    async def watch(self, interval: float = 2.0, on_change=None):
+        """后台任务：每隔 interval 秒检查一次文件变化；有变化时调用 on_change(changes)。"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                changes = await asyncio.to_thread(self.reload)
+            except Exception:
+                continue
+            if changes and on_change:
+                on_change(changes)
@@ -0,0 +1,111 @@
+# context_budget.py
+# 发送前按模型的上下文预算裁剪对话历史（api_server.py 与 TampermonkeyScript/lm模型后端.py 共用，需显式开启）。
+# SillyTavern 等客户端每轮都发送完整的历史，对话越长载荷越大：上传变慢，最后常以 content-filter（多半是上下文超限）结束，
+# 整次生成白白浪费。在 context_budget_kb 中为模型设置预算（按 UTF-8 文本字节数加附件大小估算载荷）后，超出预算的请求：
+# 1. 先从最早的消息开始去掉附件（正文末尾注明省略的附件名）；
+# 2. 仍然超出时，从最早的消息开始丢弃整条消息，丢弃后历史以 user 消息开头；说明（context_trim_notice）加在该 user 消息正文之前，
+#    不单独插入一条消息，避免出现连续两条 user 消息。
+# system 消息（酒馆模式合并后的系统提示）、客户端标记了 "pinned": true 的消息和最后一条消息始终保留；
+# 保留的部分本身超出预算时按原样发送。
+
+from modules.metrics import utf8_len
+
+DEFAULT_NOTICE = "[为控制上下文长度，省略了更早的 {count} 条消息]"
+
+
+def message_size(message: dict) -> int:
+    """估算一条消息在载荷中的大小：正文的 UTF-8 字节数加附件大小。"""
+    return utf8_len(message.get("content") or "") + sum(a.get("size") or 0 for a in message.get("attachments") or ())
+
+
+class ContextBudget:
+    """
+    trim(messages, model): 对 _process_openai_message 处理后的消息列表（酒馆模式合并之后）应用预算，
+    返回 (新列表, 裁剪摘要)；未超出预算时返回原列表与 None。不修改传入的消息。
+    stats: trimmed（裁剪的请求数）/ dropped_messages / stripped_attachments / saved_bytes / over_budget（保留部分仍超出预算）。
+    """
+
+    def __init__(self):
+        self.budgets: dict[str, int] = {}
+        self.notice = DEFAULT_NOTICE
+        self.stats = {"trimmed": 0, "dropped_messages": 0, "stripped_attachments": 0, "saved_bytes": 0, "over_budget": 0}
+
+    def configure(self, config) -> None:
+        """从 config.jsonc 读取各模型的预算（配置重新加载后调用）。"""
+        self.budgets = {model: int(kb or 0) * 1024 for model, kb in (config.get("context_budget_kb", {}) or {}).items()}
+        notice = config.get("context_trim_notice", DEFAULT_NOTICE)
+        self.notice = notice if isinstance(notice, str) else DEFAULT_NOTICE
+
+    def budget_for(self, model: str) -> int:
+        """该模型的预算（字节），0 表示不限制。"""
+        return self.budgets.get(model, self.budgets.get("*", 0))
+
+    def trim(self, messages: list, model: str) -> tuple[list, dict | None]:
+        budget = self.budget_for(model)
+        if budget <= 0 or not messages:
+            return messages, None
+        sizes = [message_size(m) for m in messages]
+        before = total = sum(sizes)
+        if total <= budget:
+            return messages, None
+
+        last = len(messages) - 1
+        keep = [i == last or m.get("role") == "system" or bool(m.get("pinned")) for i, m in enumerate(messages)]
+        messages = list(messages)
+
+        # 1. 去掉较早消息的附件
+        stripped = 0
+        for i, message in enumerate(messages):
+            if total <= budget:
+                break
+            if keep[i] or not message.get("attachments"):
+                continue
+            names = "、".join(a.get("name") or "附件" for a in message["attachments"])
+            content = (message.get("content") or "").strip()
+            note = f"[附件已省略: {names}]"
+            messages[i] = dict(message, content=f"{content}\n\n{note}" if content else note, attachments=[])
+            stripped += len(message["attachments"])
+            size = message_size(messages[i])
+            total += size - sizes[i]
+            sizes[i] = size
+
+        # 2. 丢弃较早的消息；之后保留的历史应以 user 消息开头，不以孤立的 assistant 回复开头
+        dropped = set()
+        for i in range(len(messages)):
+            if total <= budget:
+                break
+            if not keep[i]:
+                if not dropped:
+                    total += utf8_len(self.notice)  # 说明也计入预算（按模板长度估算）
+                dropped.add(i)
+                total -= sizes[i]
+        if dropped:
+            for i in range(max(dropped) + 1, len(messages)):
+                if keep[i]:
+                    continue
+                if messages[i].get("role") != "assistant":
+                    break
+                dropped.add(i)
+                total -= sizes[i]
+
+        if dropped:
+            first = min(dropped)
+            # 说明加在丢弃位置之后第一条保留的 user 消息之前；之后没有 user 消息（例如以 assistant 预填结尾）时不加
+            target = next((i for i in range(first + 1, len(messages))
+                           if i not in dropped and messages[i].get("role") == "user"), None) if self.notice else None
+            if target is not None:
+                notice = self.notice.replace("{count}", str(len(dropped)))
+                content = messages[target].get("content") or ""
+                messages[target] = dict(messages[target], content=f"{notice}\n\n{content}" if content.strip() else notice)
+            messages = [m for i, m in enumerate(messages) if i not in dropped]
+
+        self.stats["trimmed"] += 1
+        self.stats["dropped_messages"] += len(dropped)
+        self.stats["stripped_attachments"] += stripped
+        self.stats["saved_bytes"] += before - total
+        if total > budget:
+            self.stats["over_budget"] += 1
+        return messages, {"budget": budget, "before": before, "after": total, "dropped": len(dropped), "stripped": stripped}
+
+    def status(self) -> dict:
+        return {"budgets_kb": {model: size // 1024 for model, size in self.budgets.items()}, "stats": dict(self.stats)}
@@ -0,0 +1,58 @@
+# failover.py
+# 首个内容块之前的透明重试（api_server.py 与 TampermonkeyScript/lm模型后端.py 共用）。
+# 标签页在请求中途断开、遇到 Cloudflare 验证页、被 LMArena 限流 (429) 或回传其他浏览器错误时，
+# 如果还没有任何内容发给客户端，就把同一个请求重新分发给另一个标签页（以及映射中的另一个会话），
+# 客户端只会看到稍长的首字延迟，而不是一个错误。
+# 已经开始输出内容之后的错误照旧原样返回（重试会产生重复或不一致的内容）。
+# 重试次数 (failover_max_attempts) 与时间预算 (failover_time_budget_seconds，从第一次分发算起) 都有上限。
+
+import time
+
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_TIME_BUDGET = 20.0
+
+# 与具体标签页或会话相关、换一个标签页/会话就可能成功的失败
+RETRYABLE_OUTCOMES = frozenset({'browser_disconnect', 'cloudflare', 'rate_limited', 'browser_error'})
+
+
+def settings_from_config(config) -> tuple[int, float]:
+    """返回 (最多尝试次数（含第一次）, 时间预算秒数)；尝试次数为 1 表示关闭重试。"""
+    max_attempts = max(1, int(config.get("failover_max_attempts", DEFAULT_MAX_ATTEMPTS)))
+    budget = float(config.get("failover_time_budget_seconds", DEFAULT_TIME_BUDGET))
+    return max_attempts, budget
+
+
+async def with_failover(events, report: dict, redispatch, max_attempts: int, budget: float):
+    """
+    转发 (类型, 值) 事件；首个 'content' 之前出现 'error' 时，关闭当前尝试并在允许时重新分发。
+    report: 当前尝试结束时由事件生成器写入 'outcome'（请求结果）的字典。
+    redispatch(outcome, remaining) 协程函数：remaining 为剩余预算秒数，
+    返回新一次尝试的 (events, report)，无法重新分发时返回 None（此时原样返回最后一次的错误）。
+    """
+    started = time.monotonic()
+    attempt = 1
+    try:
+        while True:
+            error = None
+            content_started = False
+            async for event_type, value in events:
+                if event_type == 'content':
+                    content_started = True
+                elif event_type == 'error' and not content_started:
+                    error = value
+                    break
+                yield event_type, value
+            if error is None:
+                return
+            await events.aclose()  # 先执行其 finally（释放标签页、记录会话结果），report 中才有 outcome
+            remaining = budget - (time.monotonic() - started)
+            if report.get('outcome') in RETRYABLE_OUTCOMES and attempt < max_attempts and remaining > 0:
+                retry = await redispatch(report['outcome'], remaining)
+                if retry is not None:
+                    events, report = retry
+                    attempt += 1
+                    continue
+            yield 'error', error
+            return
+    finally:
+        await events.aclose()
@@ -0,0 +1,61 @@
+# heartbeat.py
+# WebSocket 应用层心跳（api_server.py 与 TampermonkeyScript/lm模型后端.py 共用）。
+# 被冻结的标签页（后台节流、电脑睡眠、卡在 Cloudflare 验证页）的 TCP 连接往往仍然存在，
+# 浏览器网络层也会自动应答协议层的 ping，连接看起来正常，分发给它的请求却要等到超时才失败。
+# 因此由服务器定期发送 {"command": "ping", "seq": n}，脚本的 JS 收到后立即回复 {"pong": n}：
+# - 按回复时间计算平滑往返时间（与 TCP 的 SRTT 相同，新样本占 1/8）；
+# - 一个心跳周期内既没有 pong 也没有其他消息时记一次未响应，此后不再向它分发新请求；
+# - 连续 ws_heartbeat_max_missed 次未响应时判定为失效，由 on_dead 回调立即注销它并让它负责的请求失败。
+# 只有连接时声明 heartbeat=1 的脚本会收到 ping；旧版脚本只记录最后一次收到消息的时间，不会被判定失效。
+
+import asyncio
+
+DEFAULT_INTERVAL = 10.0
+DEFAULT_MAX_MISSED = 3
+
+
+def settings_from_config(config) -> tuple[float, int]:
+    """返回 (心跳间隔秒数, 判定失效前允许的连续未响应次数)；间隔为 0 表示关闭心跳。"""
+    interval = float(config.get("ws_heartbeat_interval_seconds", DEFAULT_INTERVAL))
+    max_missed = max(1, int(config.get("ws_heartbeat_max_missed", DEFAULT_MAX_MISSED)))
+    return interval, max_missed
+
+
+def pong_seq(message) -> int | None:
+    """文本帧是 pong 回复时返回其序号，否则返回 None。"""
+    if isinstance(message, dict) and "pong" in message and "request_id" not in message:
+        try:
+            return int(message["pong"])
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+async def run_heartbeat(worker, get_settings, on_dead) -> None:
+    """
+    为一个标签页发送心跳，直到连接断开（任务被取消或发送失败）或判定失效。
+    get_settings() 每个周期调用一次，返回 settings_from_config 的结果，配置修改后立即生效。
+    on_dead(worker) 为协程函数，判定失效时调用一次。
+    """
+    seq = 0
+    while True:
+        interval, max_missed = get_settings()
+        if interval <= 0:
+            worker.missed_heartbeats = 0
+            await asyncio.sleep(DEFAULT_INTERVAL)  # 心跳已关闭，定期检查配置
+            continue
+        await asyncio.sleep(interval)
+        if worker.ping_outstanding:
+            if worker.seen_since_ping:
+                worker.missed_heartbeats = 0  # 仍在收到数据，JS 没有被冻结
+            else:
+                worker.missed_heartbeats += 1
+                if worker.missed_heartbeats >= max_missed:
+                    await on_dead(worker)
+                    return
+        seq += 1
+        worker.mark_ping(seq)
+        try:
+            await worker.send_json({"command": "ping", "seq": seq})
+        except Exception:
+            return  # 连接已断开，由接收循环清理
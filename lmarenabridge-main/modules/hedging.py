@@ -0,0 +1,145 @@
+# hedging.py
+# 对冲请求：降低首字延迟的长尾（api_server.py 与 TampermonkeyScript/lm模型后端.py 共用，需显式开启）。
+# LMArena 的首字延迟在不同会话、不同标签页之间差异很大，少数请求要等很久才开始输出。
+# 开启对冲后，请求发出超过该模型近期首字延迟的某个百分位（hedge_percentile）仍没有任何内容时，
+# 把同一个载荷再发给另一个标签页（映射中有其他会话时也换一个会话）；先产生内容的一方胜出，另一方立即取消。
+# 对冲只使用空闲容量（有请求排队或没有空闲标签页时不发出），不会让过载更严重。
+# 开启方式：config.jsonc 的 hedge_models（模型名列表，"*" 表示全部），或请求头 X-LMArena-Hedge: 1（0 表示关闭）。
+
+import asyncio
+import math
+from collections import deque
+
+HEDGE_HEADER = "X-LMArena-Hedge"
+_ON_VALUES = ("1", "true", "on", "yes")
+_OFF_VALUES = ("0", "false", "off", "no")
+
+# 近期样本不足时使用 hedge_default_delay_ms
+MIN_SAMPLES = 20
+WINDOW = 200
+
+
+def wants_hedge(headers, model: str, config) -> bool:
+    """请求头优先；没有请求头时看模型是否在 hedge_models 中。"""
+    value = headers.get(HEDGE_HEADER, "").strip().lower()
+    if value in _ON_VALUES:
+        return True
+    if value in _OFF_VALUES:
+        return False
+    models = config.get("hedge_models") or ()
+    return "*" in models or model in models
+
+
+class HedgeTracker:
+    """
+    - record_ttft(model, seconds): 记录一次首字延迟（每个请求第一次收到内容时调用）。
+    - delay(model, config): 返回该模型的对冲延迟（秒）：近期首字延迟的 hedge_percentile 百分位，
+      不低于 hedge_min_delay_ms；样本不足 MIN_SAMPLES 个时使用 hedge_default_delay_ms。
+    - stats: fired（发出对冲）、won（对冲一方胜出）、skipped（到达延迟但没有空闲容量）。
+    所有方法都只应在事件循环线程中调用（不加锁）。
+    """
+
+    def __init__(self, window: int = WINDOW):
+        self.window = window
+        self._samples: dict[str, deque] = {}
+        self.stats = {"fired": 0, "won": 0, "skipped": 0}
+
+    def record_ttft(self, model: str, seconds: float) -> None:
+        samples = self._samples.get(model)
+        if samples is None:
+            samples = self._samples[model] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def delay(self, model: str, config) -> float:
+        floor = float(config.get("hedge_min_delay_ms", 500)) / 1000
+        samples = self._samples.get(model)
+        if not samples or len(samples) < MIN_SAMPLES:
+            return max(floor, float(config.get("hedge_default_delay_ms", 3000)) / 1000)
+        ordered = sorted(samples)
+        percentile = min(100.0, max(0.0, float(config.get("hedge_percentile", 95))))
+        index = min(len(ordered) - 1, max(0, math.ceil(percentile / 100 * len(ordered)) - 1))
+        return max(floor, ordered[index])
+
+    def status(self, config) -> dict:
+        return {
+            "stats": dict(self.stats),
+            "delays": {model: {"samples": len(samples), "delay_seconds": round(self.delay(model, config), 3)}
+                       for model, samples in self._samples.items()},
+        }
+
+
+async def _close(racer, lost: bool) -> None:
+    """结束一方：取消尚未完成的 __anext__，然后关闭生成器（其 finally 通知标签页取消）。"""
+    events, report, step = racer
+    if lost:
+        report["closed_as"] = "hedge_lost"
+    if step is not None and not step.done():
+        step.cancel()
+        try:
+            await step
+        except (asyncio.CancelledError, StopAsyncIteration):
+            pass
+    await events.aclose()
+
+
+async def with_hedge(events, report: dict, launch, delay: float, tracker: HedgeTracker):
+    """
+    转发 (类型, 值) 事件。delay 秒内主请求没有产生任何事件时调用 launch()（协程函数，
+    返回对冲请求的 (events, report)，没有空闲容量时返回 None），之后两者中先产生非错误事件的一方胜出。
+    一方在胜出之前出错时只丢弃它；全部出错时返回最后一个错误。
+    report: 主请求的结果字典；结束时写入胜出一方（或最后出错一方）的请求结果，供外层的 with_failover 判断能否重试。
+    """
+    racers = [[events, report, None]]  # [事件生成器, 请求结果, 进行中的 __anext__]
+    last = racers[0]
+    loop = asyncio.get_running_loop()
+    hedge_at = loop.time() + delay
+    hedged = False
+    try:
+        winner, event = None, None
+        while winner is None:
+            for racer in racers:
+                if racer[2] is None:
+                    racer[2] = asyncio.ensure_future(racer[0].__anext__())
+            timeout = None if hedged else max(0.0, hedge_at - loop.time())
+            done, _ = await asyncio.wait([r[2] for r in racers], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                hedged = True
+                second = await launch()
+                if second is None:
+                    tracker.stats["skipped"] += 1
+                else:
+                    tracker.stats["fired"] += 1
+                    racers.append([second[0], second[1], None])
+                continue
+            for racer in [r for r in racers if r[2] in done]:
+                step, racer[2] = racer[2], None
+                try:
+                    event = step.result()
+                except StopAsyncIteration:
+                    event = None
+                if event is not None and event[0] != 'error':
+                    winner = racer
+                    break
+                # 胜出之前出错（或没有任何事件就结束）：丢弃这一方
+                racers.remove(racer)
+                last = racer
+                await racer[0].aclose()
+                if not racers:
+                    if event is not None:
+                        yield event
+                    return
+
+        for racer in racers:
+            if racer is not winner:
+                await _close(racer, lost=True)
+        racers, last = [winner], winner
+        if winner[1] is not report:
+            tracker.stats["won"] += 1
+        yield event
+        async for event in winner[0]:
+            yield event
+    finally:
+        for racer in racers:
+            await _close(racer, lost=False)
+        if last[1] is not report:
+            report.update(last[1])
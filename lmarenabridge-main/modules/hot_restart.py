@@ -0,0 +1,104 @@
+# hot_restart.py
+# 不中断服务的重启（api_server.py 使用，仅 POSIX）。
+# 旧做法是通知标签页刷新后 os.execv / os._exit：端口在新进程启动前无人监听（客户端看到连接被拒绝），
+# 正在进行的流式响应全部中断。现在的步骤是：
+#   1. 启动新进程，并通过文件描述符继承把监听套接字交给它（环境变量 LMARENA_LISTEN_FD）；
+#   2. 新进程启动完成后通过管道（LMARENA_READY_FD）通知旧进程；
+#   3. 旧进程关闭自己的监听，新连接全部由新进程接受；已有连接上的响应带 Connection: close；
+#   4. 旧进程等待在途请求结束（有截止时间），之后才让油猴脚本重连（此时连到新进程），然后退出。
+# 监听套接字在交接期间始终由至少一个进程持有，内核会把新连接排在 backlog 中，不会被拒绝。
+
+import asyncio
+import os
+import select
+import socket
+import subprocess
+import time
+
+LISTEN_FD_ENV = "LMARENA_LISTEN_FD"
+READY_FD_ENV = "LMARENA_READY_FD"
+
+
+def handoff_supported() -> bool:
+    """文件描述符继承（pass_fds）只在 POSIX 系统上可用；其他系统退回旧的重启方式。"""
+    return os.name == "posix"
+
+
+def listening_socket(host: str, port: int, backlog: int = 2048) -> tuple[socket.socket, bool]:
+    """返回 (监听套接字, 是否继承自上一个进程)；不是由重启启动时新建一个。"""
+    fd = os.environ.pop(LISTEN_FD_ENV, None)
+    if fd:
+        return socket.socket(fileno=int(fd)), True
+    return socket.create_server((host, port), backlog=backlog), False
+
+
+def notify_ready() -> None:
+    """新进程启动完成后调用，通知等待中的旧进程（不是由重启启动时什么也不做）。"""
+    fd = os.environ.pop(READY_FD_ENV, None)
+    if not fd:
+        return
+    try:
+        os.write(int(fd), b"1")
+        os.close(int(fd))
+    except OSError:
+        pass
+
+
+def spawn_successor(sock: socket.socket, argv: list[str]) -> tuple[subprocess.Popen, int]:
+    """启动继承监听套接字的新进程，返回 (进程, 就绪管道的读端)。"""
+    read_fd, write_fd = os.pipe()
+    env = {**os.environ, LISTEN_FD_ENV: str(sock.fileno()), READY_FD_ENV: str(write_fd)}
+    try:
+        proc = subprocess.Popen(argv, env=env, pass_fds=(sock.fileno(), write_fd))
+    except OSError:
+        os.close(read_fd)
+        raise
+    finally:
+        os.close(write_fd)
+    return proc, read_fd
+
+
+async def wait_ready(read_fd: int, timeout: float) -> bool:
+    """等待新进程的就绪通知；超时或新进程在就绪前退出（管道被关闭）时返回 False。"""
+    def wait() -> bool:
+        readable, _, _ = select.select([read_fd], [], [], timeout)
+        return bool(readable) and os.read(read_fd, 1) == b"1"
+
+    try:
+        return await asyncio.to_thread(wait)
+    finally:
+        os.close(read_fd)
+
+
+async def wait_until(predicate, timeout: float, interval: float = 0.2) -> bool:
+    """轮询直到 predicate() 为真；超时返回 False。"""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(interval)
+    return True
+
+
+class DrainMiddleware:
+    """
+    ASGI 中间件：排空期间给 HTTP 响应加上 Connection: close，
+    让客户端的下一个请求建立新连接（由新进程接受），而不是继续复用到旧进程的长连接。
+    """
+
+    def __init__(self, app, is_draining):
+        self.app = app
+        self.is_draining = is_draining
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.is_draining():
+            return await self.app(scope, receive, send)
+
+        async def send_with_close(message):
+            if message["type"] == "http.response.start":
+                headers = [(k, v) for k, v in message.get("headers", ()) if k.lower() != b"connection"]
+                headers.append((b"connection", b"close"))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        await self.app(scope, receive, send_with_close)
@@ -0,0 +1,96 @@
+# json_codec.py
+# 热路径上的 JSON 编解码（api_server.py 与 TampermonkeyScript/lm模型后端.py 共用）。
+# 每个 WebSocket 帧、每条 a0 文本增量、每个 SSE 块、发给浏览器的请求载荷都要经过一次 JSON 编解码。
+# 安装了 orjson 时使用它（C 实现，直接输出 UTF-8 字节），否则回退到标准库 json，行为保持一致：
+# - dumps() 返回 str，非 ASCII 字符原样保留（等同于 json.dumps(..., ensure_ascii=False)，但没有空格分隔）；
+# - dumps_bytes() / string_bytes() 直接返回 UTF-8 字节，WebSocket 二进制帧和 SSE 写出时省去一次 str→bytes 复制；
+# - orjson 不接受的输入（NaN、孤立代理项等）自动改用标准库处理。
+# 设置环境变量 LMARENA_JSON_BACKEND=stdlib 可强制使用标准库（用于对比测试）。
+
+import json
+import os
+from json.encoder import encode_basestring, encode_basestring_ascii
+
+try:
+    import orjson as _orjson
+except ImportError:  # orjson 是可选依赖
+    _orjson = None
+
+if os.environ.get("LMARENA_JSON_BACKEND", "").strip().lower() == "stdlib":
+    _orjson = None
+
+BACKEND = "orjson" if _orjson is not None else "stdlib"
+
+_DECODER = json.JSONDecoder()
+_COMPACT = (",", ":")
+
+
+def _loads_stdlib(data):
+    return json.loads(data)
+
+
+def _dumps_stdlib(obj) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=_COMPACT)
+
+
+def _dumps_bytes_stdlib(obj) -> bytes:
+    try:
+        return _dumps_stdlib(obj).encode("utf-8")
+    except UnicodeEncodeError:
+        # 孤立代理项无法编码为 UTF-8，改为 \uXXXX 转义
+        return json.dumps(obj, separators=_COMPACT).encode("ascii")
+
+
+def _string_bytes_stdlib(text: str) -> bytes:
+    try:
+        return encode_basestring(text).encode("utf-8")
+    except UnicodeEncodeError:
+        # 孤立代理项无法编码为 UTF-8，改为 \uXXXX 转义
+        return encode_basestring_ascii(text).encode("ascii")
+
+
+if _orjson is not None:
+    def loads(data):
+        """解析 str 或 bytes。"""
+        try:
+            return _orjson.loads(data)
+        except _orjson.JSONDecodeError:
+            return _loads_stdlib(data)
+
+    def dumps_bytes(obj) -> bytes:
+        try:
+            return _orjson.dumps(obj)
+        except _orjson.JSONEncodeError:
+            return _dumps_bytes_stdlib(obj)
+
+    def dumps(obj) -> str:
+        try:
+            return _orjson.dumps(obj).decode("utf-8")
+        except _orjson.JSONEncodeError:
+            return _dumps_stdlib(obj)
+
+    def string_bytes(text: str) -> bytes:
+        """把字符串编码为 JSON 字符串字面量（带引号）的 UTF-8 字节。"""
+        try:
+            return _orjson.dumps(text)
+        except _orjson.JSONEncodeError:
+            return _string_bytes_stdlib(text)
+
+    def decode_at(text: str, pos: int, end: int) -> tuple:
+        """
+        解析 text 中从 pos 开始的一个 JSON 值，返回 (值, 值之后的位置)；无法解析时抛出 ValueError。
+        常见情况下 text[pos:end] 恰好是一个完整的值（一行一条记录），一次解析即可；
+        否则（一行多条记录、半条记录）回退到标准库的 raw_decode。
+        """
+        try:
+            return _orjson.loads(text[pos:end]), end
+        except _orjson.JSONDecodeError:
+            return _DECODER.raw_decode(text, pos)
+else:
+    loads = _loads_stdlib
+    dumps = _dumps_stdlib
+    dumps_bytes = _dumps_bytes_stdlib
+    string_bytes = _string_bytes_stdlib
+
+    def decode_at(text: str, pos: int, end: int) -> tuple:
+        return _DECODER.raw_decode(text, pos)
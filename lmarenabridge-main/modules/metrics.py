@@ -0,0 +1,261 @@
+# metrics.py
+# 轻量的 Prometheus 文本格式指标（无第三方依赖）。
+# 记录指标只是一次字典查找加一次加法，直方图使用 bisect 定位桶，可以在生产环境中常开。
+# api_server.py 与 TampermonkeyScript/lm模型后端.py 共用此模块，两个服务器都通过 /metrics 输出。
+
+import bisect
+import math
+
+TTFT_BUCKETS = (0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60)
+INTER_CHUNK_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DURATION_BUCKETS = (1, 2, 5, 10, 20, 30, 60, 120, 300)
+CANCEL_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def utf8_len(text: str) -> int:
+    """UTF-8 编码后的字节数；纯 ASCII 文本（最常见的情况）不需要实际编码。"""
+    return len(text) if text.isascii() else len(text.encode('utf-8'))
+
+
+def metered_send(send, counter):
+    """包装发送文本帧或二进制帧的协程函数，把发送的字节数累加到 counter（如 ws_bytes.labels("out")）。"""
+    async def metered(data):
+        counter.inc(len(data) if isinstance(data, (bytes, bytearray)) else utf8_len(data))
+        await send(data)
+    return metered
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: dict = {}
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def render(self) -> list[str]:
+        lines = self._header()
+        for values, child in self._children.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}")
+        return lines
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def render(self) -> list[str]:
+        lines = self._header()
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), child.counts):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+class GaugeFunc(_Metric):
+    """在输出时才计算的仪表：fn() 返回单个数值，或 {标签值元组: 数值} 字典。"""
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, fn, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.fn = fn
+
+    def render(self) -> list[str]:
+        lines = self._header()
+        try:
+            result = self.fn()
+        except Exception:
+            return lines
+        items = result.items() if isinstance(result, dict) else [((), result)]
+        for values, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(value)}")
+        return lines
+
+
+class CounterFunc(GaugeFunc):
+    """在输出时才读取的计数器（值由其他对象累加，例如后台线程中的统计）。"""
+    type_name = "counter"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, fn, labelnames=()) -> GaugeFunc:
+        return self.register(GaugeFunc(name, documentation, fn, labelnames))
+
+    def counter_func(self, name, documentation, fn, labelnames=()) -> CounterFunc:
+        return self.register(CounterFunc(name, documentation, fn, labelnames))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class BridgeMetrics:
+    """
+    两个服务器共用的指标集合。
+    请求结果 (outcome) 取值: success, content_filter, timeout, cloudflare, attachment_too_large,
+    lmarena_error, browser_error, rate_limited, browser_disconnect, buffer_overflow, client_disconnect, hedge_lost。
+    """
+
+    def __init__(self):
+        self.registry = Registry()
+        r = self.registry
+        self.requests = r.counter("lmarena_requests_total", "按模型和结果统计的已完成请求数。", ("model", "outcome"))
+        self.rejections = r.counter("lmarena_admission_rejections_total", "被准入控制拒绝的请求数。", ("reason",))
+        self.ttft = r.histogram("lmarena_time_to_first_token_seconds", "从发送给标签页到收到第一个内容块的时间。", ("model",), TTFT_BUCKETS)
+        self.inter_chunk = r.histogram("lmarena_inter_chunk_seconds", "同一请求相邻两个数据块到达的间隔。", ("model",), INTER_CHUNK_BUCKETS)
+        self.duration = r.histogram("lmarena_request_duration_seconds", "从发送给标签页到请求结束的时间。", ("model",), DURATION_BUCKETS)
+        self.ws_bytes = r.counter("lmarena_websocket_bytes_total", "与油猴脚本之间 WebSocket 传输的字节数。", ("direction",))
+        self.cache = r.counter("lmarena_response_cache_lookups_total", "响应缓存查询结果（hit_memory / hit_disk / miss / bypass）。", ("result",))
+        self.cancel_latency = r.histogram("lmarena_cancel_latency_seconds", "从发出 cancel 指令到标签页确认中止的时间。", (), CANCEL_BUCKETS)
+        self.tab_evictions = r.counter("lmarena_tab_heartbeat_evictions_total", "因连续心跳无应答而被移除的标签页数。")
+        self.failovers = r.counter("lmarena_failover_retries_total", "首个内容块之前失败后重新分发给其他标签页/会话的次数（按上一次失败的原因）。", ("reason",))
+
+    def register_gauges(self, pool, admission, channels: dict):
+        """注册在输出时读取的运行状态：标签页、在途请求、排队长度和响应通道积压。"""
+        r = self.registry
+        r.gauge("lmarena_tabs_connected", "已连接的浏览器标签页数。", lambda: len(pool))
+        r.gauge("lmarena_tab_in_flight_requests", "每个标签页正在处理的请求数。",
+                lambda: {(w.worker_id,): w.in_flight for w in pool.workers.values()}, ("tab",))
+        r.gauge("lmarena_tab_rtt_seconds", "每个标签页的心跳平滑往返时间。",
+                lambda: {(w.worker_id,): w.rtt for w in pool.workers.values() if w.rtt is not None}, ("tab",))
+        r.gauge("lmarena_in_flight_requests", "已准入、正在处理的请求数。", lambda: len(admission.in_flight))
+        r.gauge("lmarena_admission_queue_depth", "等待准入的请求数。", lambda: len(admission.waiters))
+        r.gauge("lmarena_event_loop_lag_seconds", "最近测得的事件循环延迟。", lambda: admission.loop_lag)
+        r.gauge("lmarena_response_channels", "打开的响应通道数。", lambda: len(channels))
+        r.gauge("lmarena_response_buffered_chars", "所有响应通道中尚未被消费的数据量（字符）。",
+                lambda: sum(c.buffered for c in list(channels.values())))
+        r.gauge("lmarena_paused_streams", "当前被流控暂停的请求数。",
+                lambda: sum(1 for c in list(channels.values()) if c.paused))
+
+    def register_cache(self, cache):
+        """注册响应缓存的条目数和占用量。"""
+        r = self.registry
+        r.gauge("lmarena_response_cache_entries", "响应缓存内存层中的条目数。", lambda: len(cache))
+        r.gauge("lmarena_response_cache_chars", "响应缓存内存层占用的数据量（字符）。", lambda: cache.size)
+
+    def register_attachments(self, store):
+        """注册附件存储的条目数和占用量。"""
+        r = self.registry
+        r.gauge("lmarena_attachment_store_entries", "附件存储中的附件数。", lambda: len(store))
+        r.gauge("lmarena_attachment_store_chars", "附件存储在内存中占用的数据量（data URL 字符数）。", lambda: store.size)
+        r.gauge("lmarena_attachment_store_disk_bytes", "转存到临时文件的附件占用的字节数。", lambda: store.disk_size)
+
+    def register_chat_log(self, writer):
+        """注册对话日志写入队列的深度和丢弃计数。"""
+        r = self.registry
+        r.gauge("lmarena_chat_log_queue_depth", "等待后台线程写入的对话记录数。", writer.qsize)
+        r.counter_func("lmarena_chat_log_dropped_total", "因写入队列已满而丢弃的对话记录数。", lambda: writer.dropped)
+
+    def register_cancellations(self, tracker):
+        """注册发给标签页的取消指令数（按原因）与取消后仍到达的数据块数。"""
+        r = self.registry
+        r.counter_func("lmarena_cancellations_total", "因客户端断开、超时等原因发给标签页的取消指令数。",
+                       lambda: {(reason,): n for reason, n in tracker.by_reason.items()}, ("reason",))
+        r.counter_func("lmarena_cancelled_late_chunks_total", "请求取消后仍从标签页到达的数据块数。", lambda: tracker.stats["late_chunks"])
+
+    def register_hedging(self, tracker):
+        """注册对冲请求的发出、胜出与因没有空闲容量而跳过的次数。"""
+        self.registry.counter_func("lmarena_hedges_total", "对冲请求次数（fired 发出 / won 对冲一方胜出 / skipped 没有空闲容量）。",
+                                   lambda: {(result,): n for result, n in tracker.stats.items()}, ("result",))
+
+    def render(self) -> str:
+        return self.registry.render()
@@ -0,0 +1,127 @@
+# model_extractor.py
+# 从 LMArena 页面源码中提取模型对象（/internal/update_available_models）。
+# 模型定义位于 Next.js 的 self.__next_f.push([1, "..."]) 字符串中，是转义后的 JSON：{\"id\":\"...\",\"publicName\":...}。
+# 旧做法对每个匹配逐字符向后数花括号（最多 10000 个字符），不识别字符串，描述里的花括号会导致截断或多截。
+# 这里只扫描一遍：用正则跳到下一个 {\"id\":\"<uuid>\" 起点，按转义 JSON 的字符串状态匹配花括号，
+# 匹配成功后从对象末尾继续查找，整个页面的扫描是线性的。
+# 页面有几 MB，调用方应在工作线程中运行（asyncio.to_thread）。
+# api_server.py 与 TampermonkeyScript/lm模型后端.py 共用此模块。
+
+import json
+import re
+
+MAX_OBJECT_CHARS = 64 * 1024
+
+_MODEL_START = re.compile(r'\{\\"id\\":\\"[a-f0-9-]+\\"')
+# 字符串外只关心花括号和字符串起点 \"（转义 JSON 在字符串外没有反斜杠）
+_OUTSIDE = re.compile(r'[{}]|\\"')
+
+
+def _string_end(html: str, pos: int, limit: int) -> int:
+    """
+    pos 位于字符串起点 \\" 之后，返回字符串结尾 \\" 之后的位置（没有结尾时返回 -1）。
+    只在反斜杠处停下：\\" 结束字符串；\\\\ 是 JSON 转义，连同其后的一个字符（可能是 \\" 或 \\\\）一起跳过；其他 JS 转义跳过两个字符。
+    """
+    while True:
+        i = html.find("\\", pos, limit)
+        if i == -1 or i + 1 >= limit:
+            return -1
+        c = html[i + 1]
+        if c == '"':
+            return i + 2
+        if c == "\\":
+            pos = i + 4 if html.startswith("\\", i + 2) else i + 3
+        else:
+            pos = i + 2
+
+
+def _object_end(html: str, start: int, limit: int) -> int:
+    """返回从 start 开始的转义 JSON 对象的结束位置，在 limit 之前没有闭合时返回 -1。"""
+    depth = 0
+    pos = start
+    while True:
+        m = _OUTSIDE.search(html, pos, limit)
+        if m is None:
+            return -1
+        token = m.group()
+        if token == '\\"':
+            pos = _string_end(html, m.end(), limit)
+            if pos == -1:
+                return -1
+            continue
+        pos = m.end()
+        if token == '{':
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return pos
+
+
+def _decode(escaped: str):
+    """先按 JS 字符串字面量反转义，再解析 JSON；前者失败时退回旧的简单替换。"""
+    try:
+        return json.loads(json.loads(f'"{escaped}"'))
+    except ValueError:
+        return json.loads(escaped.replace('\\"', '"').replace('\\\\', '\\'))
+
+
+def model_key(model: dict, name_keys=("publicName",)):
+    for key in name_keys:
+        value = model.get(key)
+        if value:
+            return value
+    return None
+
+
+def extract_models(html: str, name_keys=("publicName",), max_object_chars: int = MAX_OBJECT_CHARS) -> list[dict]:
+    """
+    一次线性扫描提取所有模型对象，按 name_keys 中第一个非空字段去重（保留先出现的）。
+    没有名字的对象（例如嵌套的其他带 id 的对象）被忽略。
+    """
+    models = []
+    names = set()
+    markers = tuple(f'\\"{key}\\":' for key in name_keys)
+    pos = 0
+    while True:
+        m = _MODEL_START.search(html, pos)
+        if m is None:
+            break
+        start = m.start()
+        end = _object_end(html, start, min(len(html), start + max_object_chars))
+        if end == -1:
+            pos = m.end()
+            continue
+        pos = end
+        if not any(html.find(marker, start, end) != -1 for marker in markers):
+            continue  # 没有名字字段的对象不必解析
+        try:
+            model = _decode(html[start:end])
+        except ValueError:
+            continue
+        name = model_key(model, name_keys) if isinstance(model, dict) else None
+        if name and name not in names:
+            names.add(name)
+            models.append(model)
+    return models
+
+
+def diff_models(old: list, new: list, name_keys=("publicName",)) -> dict:
+    """比较新旧模型列表，返回新增、移除和内容有变化的模型名（已排序）。"""
+    old_by_name = {model_key(m, name_keys) or m.get("id"): m for m in old if isinstance(m, dict)}
+    new_by_name = {model_key(m, name_keys) or m.get("id"): m for m in new if isinstance(m, dict)}
+    return {
+        "added": sorted(n for n in new_by_name if n not in old_by_name),
+        "removed": sorted(n for n in old_by_name if n not in new_by_name),
+        "changed": sorted(n for n, m in new_by_name.items() if n in old_by_name and old_by_name[n] != m),
+    }
+
+
+def load_models(path: str) -> list:
+    """读取已有的 available_models.json；文件不存在或无法解析时返回空列表。"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return []
+    return data if isinstance(data, list) else []
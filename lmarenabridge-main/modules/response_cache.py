@@ -0,0 +1,195 @@
+# response_cache.py
+# 完全相同请求的响应缓存（默认关闭）。
+# 键是转换后 LMArena 载荷的规范化哈希（目标模型 ID、消息模板含附件、会话模式），不含 session_id/message_id，
+# 因此会话池选中哪个会话不影响命中。内存层为带 TTL 的 LRU，可选的磁盘层在重启后仍然有效。
+# 只缓存正常结束（收到 [DONE] 且未被内容审查截断）的响应。
+# api_server.py 与 TampermonkeyScript/lm模型后端.py 共用此模块。
+
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+# 客户端可以用这两个请求头跳过缓存（既不读取也不写入）
+BYPASS_HEADER = "X-LMArena-Cache"
+_BYPASS_VALUES = ("bypass", "no-cache", "off")
+_BYPASS_CACHE_CONTROL = ("no-cache", "no-store")
+
+_KEY_EXCLUDED_FIELDS = ("session_id", "message_id")
+
+
+def cache_key(payload: dict, mode: str | None = None) -> str:
+    """计算载荷的规范化 SHA-256（键排序、紧凑分隔符），忽略会话 ID。"""
+    canonical = {k: v for k, v in payload.items() if k not in _KEY_EXCLUDED_FIELDS}
+    canonical["mode"] = mode
+    data = json.dumps(canonical, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def should_bypass(headers) -> bool:
+    """请求头中带有 X-LMArena-Cache: bypass 或 Cache-Control: no-cache/no-store 时返回 True。"""
+    if headers.get(BYPASS_HEADER, "").strip().lower() in _BYPASS_VALUES:
+        return True
+    cache_control = headers.get("Cache-Control", "").lower()
+    return any(v in cache_control for v in _BYPASS_CACHE_CONTROL)
+
+
+class CachedResponse:
+    """一次完整响应：按到达顺序保存的内容块和结束原因。"""
+    __slots__ = ("parts", "finish_reason", "created_at", "size")
+
+    def __init__(self, parts, finish_reason: str = "stop", created_at: float | None = None):
+        self.parts = tuple(parts)
+        self.finish_reason = finish_reason
+        self.created_at = created_at if created_at is not None else time.time()
+        self.size = sum(len(p) for p in self.parts)
+
+    @property
+    def content(self) -> str:
+        return "".join(self.parts)
+
+    def to_json(self) -> dict:
+        return {"parts": list(self.parts), "finish_reason": self.finish_reason, "created_at": self.created_at}
+
+    @classmethod
+    def from_json(cls, data: dict) -> "CachedResponse":
+        return cls(data["parts"], data.get("finish_reason", "stop"), data["created_at"])
+
+
+class ResponseCache:
+    """
+    - lookup(): 先查内存层，未命中时在工作线程中读取磁盘层（命中后放回内存层）。
+    - put(): 写入内存层；启用磁盘层时在工作线程中写文件，不阻塞事件循环。
+    - stats 记录 hit_memory / hit_disk / miss / bypass / stored 次数。
+    lookup/put 只应在事件循环线程中调用（不加锁）。
+    """
+
+    def __init__(self, base_dir: str = ".", enabled: bool = False, ttl: float = 3600,
+                 max_entries: int = 512, max_bytes: int = 64 * 1024 * 1024, disk_dir: str = ""):
+        self.base_dir = base_dir
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.size = 0  # 内存层占用，按字符数计（与 ResponseChannel 一致）
+        self.stats = {"hit_memory": 0, "hit_disk": 0, "miss": 0, "bypass": 0, "stored": 0}
+        self._entries: OrderedDict[str, CachedResponse] = OrderedDict()
+        self._disk_tasks: set = set()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def configure(self, config) -> None:
+        """从 config.jsonc 读取缓存参数（配置重新加载后调用）。关闭缓存时清空内存层。"""
+        self.enabled = bool(config.get("response_cache_enabled", False))
+        self.ttl = float(config.get("response_cache_ttl_seconds", 3600))
+        self.max_entries = int(config.get("response_cache_max_entries", 512))
+        self.max_bytes = int(config.get("response_cache_max_mb", 64)) * 1024 * 1024
+        disk_dir = config.get("response_cache_disk_dir", "") or ""
+        self.disk_dir = os.path.join(self.base_dir, disk_dir) if disk_dir else ""
+        if not self.enabled:
+            self.clear()
+        else:
+            self._evict()
+
+    def clear(self) -> None:
+        """清空内存层（磁盘层的文件保留，过期后在读取时删除）。"""
+        self._entries.clear()
+        self.size = 0
+
+    def _expired(self, entry: CachedResponse, now: float) -> bool:
+        return self.ttl > 0 and now - entry.created_at > self.ttl
+
+    def _remember(self, key: str, entry: CachedResponse) -> None:
+        old = self._entries.pop(key, None)
+        if old:
+            self.size -= old.size
+        self._entries[key] = entry
+        self.size += entry.size
+        self._evict()
+
+    def _evict(self) -> None:
+        while self._entries and (len(self._entries) > self.max_entries or self.size > self.max_bytes):
+            _, entry = self._entries.popitem(last=False)
+            self.size -= entry.size
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def _read_disk(self, path: str) -> CachedResponse | None:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = CachedResponse.from_json(json.load(f))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError):
+            entry = None
+        if entry is None or self._expired(entry, time.time()):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return entry
+
+    def _write_disk(self, path: str, entry: CachedResponse) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(entry.to_json(), f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    async def lookup(self, key: str) -> tuple[CachedResponse | None, str]:
+        """返回 (缓存的响应或 None, 结果)，结果为 'hit_memory'、'hit_disk' 或 'miss'。"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            if not self._expired(entry, time.time()):
+                self._entries.move_to_end(key)
+                self.stats["hit_memory"] += 1
+                return entry, "hit_memory"
+            del self._entries[key]
+            self.size -= entry.size
+        if self.disk_dir:
+            entry = await asyncio.to_thread(self._read_disk, self._disk_path(key))
+            if entry is not None:
+                self._remember(key, entry)
+                self.stats["hit_disk"] += 1
+                return entry, "hit_disk"
+        self.stats["miss"] += 1
+        return None, "miss"
+
+    def record_bypass(self) -> None:
+        self.stats["bypass"] += 1
+
+    def put(self, key: str, parts, finish_reason: str = "stop") -> None:
+        if not self.enabled:
+            return
+        entry = CachedResponse(parts, finish_reason)
+        if not entry.size or entry.size > self.max_bytes:
+            return
+        self._remember(key, entry)
+        self.stats["stored"] += 1
+        if self.disk_dir:
+            task = asyncio.get_running_loop().create_task(asyncio.to_thread(self._write_disk, self._disk_path(key), entry))
+            self._disk_tasks.add(task)
+            task.add_done_callback(self._disk_write_done)
+
+    def _disk_write_done(self, task: asyncio.Task) -> None:
+        self._disk_tasks.discard(task)
+        if not task.cancelled():
+            task.exception()  # 磁盘写入失败只影响重启后的命中，忽略
+
+    def status(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "entries": len(self),
+            "max_entries": self.max_entries,
+            "size_chars": self.size,
+            "max_chars": self.max_bytes,
+            "ttl_seconds": self.ttl,
+            "disk_dir": self.disk_dir or None,
+            "stats": dict(self.stats),
+        }
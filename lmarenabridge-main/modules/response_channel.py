@@ -0,0 +1,112 @@
+# response_channel.py
+# 有界的单请求响应通道，以及与油猴脚本之间的流控（pause/resume）。
+# 积压超过高水位时通知负责该请求的标签页暂停读取上游响应体，降到低水位后恢复；
+# 标签页不支持流控（旧版脚本）时，积压达到硬上限后丢弃后续数据并以错误结束请求。
+# 因此每个流的内存占用上限约为 max_bytes 加一个数据块。
+# api_server.py 与 TampermonkeyScript/lm模型后端.py 共用此模块。
+
+import asyncio
+import time
+
+DEFAULT_HIGH_WATERMARK = 256 * 1024
+DEFAULT_LOW_WATERMARK = 64 * 1024
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024
+
+CHANNEL_OVERFLOW_ERROR = "响应缓冲区已满（客户端读取过慢），请求已中止。"
+
+
+def _item_size(item) -> int:
+    """按字符数估算数据块大小；错误字典和 [DONE] 之类的控制数据不计入。"""
+    if isinstance(item, str):
+        return len(item)
+    if isinstance(item, list):
+        return sum(len(x) for x in item if isinstance(x, str))
+    return 0
+
+
+class ResponseChannel:
+    """
+    替代无界的 asyncio.Queue。生产者是 WebSocket 接收循环（put 不会阻塞，避免拖慢同一标签页上的其他请求），
+    消费者是该请求的流处理器（get）。
+    - send_control: 协程函数，接收 {"command": "pause"|"resume", "request_id": ...}，发送给负责该请求的标签页。
+    """
+
+    def __init__(self, request_id: str, send_control=None,
+                 high_watermark: int = DEFAULT_HIGH_WATERMARK,
+                 low_watermark: int = DEFAULT_LOW_WATERMARK,
+                 max_bytes: int = DEFAULT_MAX_BYTES):
+        self.request_id = request_id
+        self.high_watermark = high_watermark
+        self.low_watermark = min(low_watermark, high_watermark)
+        self.max_bytes = max(max_bytes, high_watermark)
+        self.buffered = 0
+        self.paused = False
+        self.overflowed = False
+        self.pause_count = 0
+        self.created_at = time.monotonic()
+        self.last_gap: float | None = None  # 最近一次 get() 取出的数据块与上一块的到达间隔（秒）
+        self._last_arrival: float | None = None
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._send_control = send_control
+        self._control_task: asyncio.Task | None = None
+
+    @classmethod
+    def from_config(cls, request_id: str, config, send_control=None) -> "ResponseChannel":
+        return cls(
+            request_id,
+            send_control,
+            high_watermark=int(config.get("response_buffer_high_watermark_kb", DEFAULT_HIGH_WATERMARK // 1024)) * 1024,
+            low_watermark=int(config.get("response_buffer_low_watermark_kb", DEFAULT_LOW_WATERMARK // 1024)) * 1024,
+            max_bytes=int(config.get("response_buffer_max_kb", DEFAULT_MAX_BYTES // 1024)) * 1024,
+        )
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def put_nowait(self, item) -> bool:
+        """放入数据；返回 False 表示数据因通道溢出被丢弃。"""
+        if self.overflowed:
+            return False
+        size = _item_size(item)
+        if size and self.buffered + size > self.max_bytes:
+            # 标签页没有响应 pause：保留已缓冲的数据，丢弃之后的一切，并以错误结束
+            self.overflowed = True
+            self._queue.put_nowait(({"error": CHANNEL_OVERFLOW_ERROR}, 0, time.monotonic()))
+            return False
+        self.buffered += size
+        self._queue.put_nowait((item, size, time.monotonic()))
+        if not self.paused and self.buffered > self.high_watermark:
+            self.paused = True
+            self.pause_count += 1
+            self._signal("pause")
+        return True
+
+    async def put(self, item) -> bool:
+        return self.put_nowait(item)
+
+    async def get(self):
+        item, size, arrived = await self._queue.get()
+        self.buffered -= size
+        if size:
+            self.last_gap = arrived - self._last_arrival if self._last_arrival is not None else None
+            self._last_arrival = arrived
+        if self.paused and self.buffered <= self.low_watermark:
+            self.paused = False
+            self._signal("resume")
+        return item
+
+    def _signal(self, command: str):
+        """按顺序异步发送流控指令（get() 可能被 wait_for 取消，因此不在其中直接 await 网络发送）。"""
+        if not self._send_control:
+            return
+        previous = self._control_task
+
+        async def send():
+            if previous:
+                await asyncio.gather(previous, return_exceptions=True)
+            try:
+                await self._send_control({"command": command, "request_id": self.request_id})
+            except Exception:
+                pass
+
+        self._control_task = asyncio.get_running_loop().create_task(send())
@@ -0,0 +1,204 @@
+# session_pool.py
+# 会话池：跟踪 model_endpoint_map.json 中每个 session_id/message_id 的健康状况，
+# 按“加权最小负载”选择会话，连续失败的会话进入冷却期，可选的后台探测任务会检查空闲会话。
+# api_server.py 与 TampermonkeyScript/lm模型后端.py 共用此模块。
+
+import asyncio
+import random
+import time
+from collections import deque
+
+# 成功率使用指数滑动平均，新会话从 1.0 开始；单次失败不会让会话完全失去流量
+_SUCCESS_ALPHA = 0.2
+_TTFT_ALPHA = 0.3
+_MIN_WEIGHT = 0.05
+
+
+class SessionState:
+    """单个会话（model + session_id + message_id）的运行时统计。"""
+
+    def __init__(self, model: str, entry: dict):
+        self.model = model
+        self.session_id = entry.get("session_id")
+        self.message_id = entry.get("message_id")
+        self.mode = entry.get("mode")
+        self.in_flight = 0
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.success_rate = 1.0
+        self.ttft_avg: float | None = None
+        self.recent_errors: deque = deque(maxlen=5)
+        self.cooldown_until = 0.0
+        self.last_used = 0.0
+        self.last_probe = 0.0
+
+    @property
+    def weight(self) -> float:
+        return max(self.success_rate, _MIN_WEIGHT)
+
+    def cooling(self, now: float) -> bool:
+        return self.cooldown_until > now
+
+    def to_status(self, now: float) -> dict:
+        return {
+            "model": self.model,
+            "session_id": self.session_id,
+            "message_id": self.message_id,
+            "mode": self.mode,
+            "in_flight": self.in_flight,
+            "successes": self.successes,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "success_rate": round(self.success_rate, 3),
+            "ttft_avg_seconds": round(self.ttft_avg, 3) if self.ttft_avg is not None else None,
+            "cooldown_remaining_seconds": round(max(0.0, self.cooldown_until - now), 1),
+            "recent_errors": [{"at": at, "error": err} for at, err in self.recent_errors],
+            "last_used": self.last_used or None,
+            "last_probe": self.last_probe or None,
+        }
+
+
+class SessionPool:
+    """
+    - choose(): 在某个模型的映射条目中选择 (in_flight + 1) / 成功率 最小的会话，跳过冷却中的会话。
+    - begin() / first_token() / end(): 按 request_id 记录一次请求的生命周期与结果。
+    - 连续失败达到 failure_threshold 次后进入冷却，冷却时间按 cooldown_seconds 指数增长，最长 cooldown_max_seconds。
+    所有方法都只应在事件循环线程中调用（不加锁）。
+    """
+
+    def __init__(self, cooldown_seconds: float = 30, failure_threshold: int = 2, cooldown_max_seconds: float = 600):
+        self.cooldown_seconds = cooldown_seconds
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.cooldown_max_seconds = cooldown_max_seconds
+        self.states: dict[tuple, SessionState] = {}
+        self._leases: dict[str, tuple[SessionState, float, bool]] = {}
+
+    def configure(self, config) -> None:
+        """从 config.jsonc 读取冷却参数（配置重新加载后调用）。"""
+        self.cooldown_seconds = config.get("session_cooldown_seconds", 30)
+        self.failure_threshold = max(1, int(config.get("session_failure_threshold", 2)))
+        self.cooldown_max_seconds = config.get("session_cooldown_max_seconds", 600)
+
+    @staticmethod
+    def _key(model: str, entry: dict) -> tuple:
+        return (model, entry.get("session_id"), entry.get("message_id"))
+
+    def state_for(self, model: str, entry: dict) -> SessionState:
+        key = self._key(model, entry)
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = SessionState(model, entry)
+        return state
+
+    def choose(self, model: str, entries, avoid=()) -> dict | None:
+        """
+        从映射条目（列表或旧格式的单个字典）中选择一个会话；全部冷却时选择最早结束冷却的会话。
+        avoid 为应尽量避开的 session_id（重试时传入已失败的会话）；没有其他会话时仍可选择它们。
+        """
+        if isinstance(entries, dict):
+            entries = [entries]
+        entries = [e for e in entries or () if isinstance(e, dict)]
+        if avoid:
+            entries = [e for e in entries if e.get("session_id") not in avoid] or entries
+        if not entries:
+            return None
+        now = time.time()
+        states = [(entry, self.state_for(model, entry)) for entry in entries]
+        available = [(e, s) for e, s in states if not s.cooling(now)]
+        if not available:
+            return min(states, key=lambda es: es[1].cooldown_until)[0]
+        best_score = min((s.in_flight + 1) / s.weight for _, s in available)
+        best = [e for e, s in available if (s.in_flight + 1) / s.weight <= best_score * 1.0001]
+        return random.choice(best)
+
+    def begin(self, request_id: str, model: str, entry: dict, probe: bool = False):
+        state = self.state_for(model, entry)
+        state.in_flight += 1
+        now = time.time()
+        if probe:
+            state.last_probe = now
+        else:
+            state.last_used = now
+        self._leases[request_id] = (state, now, False)
+
+    def first_token(self, request_id: str):
+        """记录首个内容块到达的时间（只记录第一次）。"""
+        lease = self._leases.get(request_id)
+        if not lease or lease[2]:
+            return
+        state, started, _ = lease
+        ttft = time.time() - started
+        state.ttft_avg = ttft if state.ttft_avg is None else state.ttft_avg + _TTFT_ALPHA * (ttft - state.ttft_avg)
+        self._leases[request_id] = (state, started, True)
+
+    def end(self, request_id: str, ok: bool | None, error: str | None = None):
+        """
+        结束一次请求。ok=True 成功，ok=False 记为该会话的失败，
+        ok=None 表示结果与会话无关（客户端断开、附件过大、标签页断开等），只释放 in_flight。
+        """
+        lease = self._leases.pop(request_id, None)
+        if not lease:
+            return
+        state = lease[0]
+        state.in_flight = max(0, state.in_flight - 1)
+        if ok is None:
+            return
+        if ok:
+            state.successes += 1
+            state.consecutive_failures = 0
+            state.cooldown_until = 0.0
+            state.success_rate += _SUCCESS_ALPHA * (1.0 - state.success_rate)
+            return
+        now = time.time()
+        state.failures += 1
+        state.consecutive_failures += 1
+        state.success_rate -= _SUCCESS_ALPHA * state.success_rate
+        state.recent_errors.append((now, str(error or "unknown error")[:300]))
+        if state.consecutive_failures >= self.failure_threshold:
+            exponent = state.consecutive_failures - self.failure_threshold
+            state.cooldown_until = now + min(self.cooldown_seconds * (2 ** exponent), self.cooldown_max_seconds)
+
+    def prune(self, endpoint_map) -> None:
+        """移除已不在 model_endpoint_map.json 中的会话统计（配置重新加载后调用）。"""
+        live = set()
+        for model, entries in endpoint_map.items():
+            for entry in ([entries] if isinstance(entries, dict) else entries or ()):
+                if isinstance(entry, dict):
+                    live.add(self._key(model, entry))
+        for key in [k for k, s in self.states.items() if k not in live and not s.in_flight]:
+            del self.states[key]
+
+    def idle_sessions(self, endpoint_map, idle_after: float) -> list[tuple[str, dict]]:
+        """返回超过 idle_after 秒没有真实请求或探测、当前也不在冷却中的会话。"""
+        now = time.time()
+        result = []
+        for model, entries in endpoint_map.items():
+            for entry in ([entries] if isinstance(entries, dict) else entries or ()):
+                if not isinstance(entry, dict):
+                    continue
+                state = self.state_for(model, entry)
+                if state.in_flight or state.cooling(now):
+                    continue
+                if now - max(state.last_used, state.last_probe) >= idle_after:
+                    result.append((model, entry))
+        return result
+
+    async def probe_loop(self, get_endpoint_map, probe, interval: float):
+        """
+        后台探测任务：每隔 interval 秒，对空闲超过 interval 秒的会话逐个调用 await probe(model, entry)。
+        probe 负责通过 begin()/end() 记录结果；抛出的异常会被忽略。
+        """
+        while True:
+            await asyncio.sleep(interval)
+            for model, entry in self.idle_sessions(get_endpoint_map(), interval):
+                try:
+                    await probe(model, entry)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    pass
+
+    def status(self) -> list[dict]:
+        now = time.time()
+        return [s.to_status(now) for s in sorted(self.states.values(), key=lambda s: (s.model, -s.consecutive_failures))]
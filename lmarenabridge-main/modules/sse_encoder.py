@@ -0,0 +1,72 @@
+# sse_encoder.py
+# 流式响应块的预序列化编码（api_server.py 与 TampermonkeyScript/lm模型后端.py 共用）。
+# 同一个流的所有内容块中，除了文本增量和 created 时间戳，其余字段（id、object、model、choices 结构）都不变，
+# 而旧做法每个 token 都新建一个嵌套字典并对整个字典做 json.dumps。
+# ChunkEncoder 在流开始时把块渲染成“前缀 + 文本 + 后缀”的模板，之后每个块只对文本做 JSON 转义再拼接；
+# created 的秒数变化时才重新渲染前缀。输出与原来的 json.dumps(..., ensure_ascii=False) 逐字节相同。
+# 支持 OpenAI（chat.completion.chunk）与 LM Studio（text_completion）两种格式。
+# content_bytes() 直接返回 UTF-8 字节（文本转义由 modules/json_codec.py 完成），写出时不再需要 str→bytes 转换。
+
+import json
+import time
+from json.encoder import encode_basestring
+
+from modules.json_codec import string_bytes
+
+# 渲染模板时占位的文本（JSON 转义后在块中唯一）
+_PLACEHOLDER = "\x00delta\x00"
+_PLACEHOLDER_JSON = encode_basestring(_PLACEHOLDER)
+
+OPENAI = "openai"
+LMSTUDIO = "lmstudio"
+
+
+def chunk_dict(response_id: str, model: str, created: int, content, finish_reason=None, compat: str = OPENAI) -> dict:
+    """原来逐块构建的字典；content 为 None 时是不带文本的结束块。"""
+    if compat == LMSTUDIO:
+        return {"id": response_id, "object": "text_completion", "created": created, "model": model,
+                "choices": [{"index": 0, "text": content if content is not None else "", "finish_reason": finish_reason}]}
+    return {"id": response_id, "object": "chat.completion.chunk", "created": created, "model": model,
+            "choices": [{"index": 0, "delta": {"content": content} if content is not None else {}, "finish_reason": finish_reason}]}
+
+
+class ChunkEncoder:
+    """
+    一个流的块编码器：
+    - content(text): 内容块，返回完整的 SSE 事件文本 "data: {...}\\n\\n"（热路径，只转义 text）；
+    - content_bytes(text): 同 content()，但返回 UTF-8 字节；
+    - chunk(text, finish_reason): 带结束原因的块（如错误块），text 为 None 时是不带文本的结束块（不常用，直接序列化）。
+    """
+
+    __slots__ = ("response_id", "model", "compat", "_created", "_prefix", "_suffix", "_prefix_bytes", "_suffix_bytes")
+
+    def __init__(self, response_id: str, model: str, compat: str = OPENAI):
+        self.response_id = response_id
+        self.model = model
+        self.compat = compat
+        self._created = None
+        self._prefix = self._suffix = ""
+        self._prefix_bytes = self._suffix_bytes = b""
+
+    def _render(self, created: int) -> None:
+        text = json.dumps(chunk_dict(self.response_id, self.model, created, _PLACEHOLDER, None, self.compat), ensure_ascii=False)
+        prefix, suffix = text.split(_PLACEHOLDER_JSON)
+        self._prefix, self._suffix = "data: " + prefix, suffix + "\n\n"
+        self._prefix_bytes, self._suffix_bytes = self._prefix.encode("utf-8"), self._suffix.encode("utf-8")
+        self._created = created
+
+    def content(self, text: str) -> str:
+        created = int(time.time())
+        if created != self._created:
+            self._render(created)
+        return self._prefix + encode_basestring(text) + self._suffix
+
+    def content_bytes(self, text: str) -> bytes:
+        created = int(time.time())
+        if created != self._created:
+            self._render(created)
+        return self._prefix_bytes + string_bytes(text) + self._suffix_bytes
+
+    def chunk(self, text, finish_reason) -> str:
+        data = chunk_dict(self.response_id, self.model, int(time.time()), text, finish_reason, self.compat)
+        return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
@@ -0,0 +1,158 @@
+# stream_parser.py
+# LMArena 流式响应的增量解析器。
+# 每个数据块只扫描一次新数据，跨块的半条记录会被保留到下一块补全，整体为线性时间。
+# api_server.py 与 TampermonkeyScript/lm模型后端.py 共用此模块。
+
+import json
+import re
+
+from modules.json_codec import decode_at
+
+# 记录格式: <参与者位置 a|b><类型>:<JSON 值>，例如 a0:"文本"、a2:[...]、ad:{"finishReason":"stop"}
+_RECORD_RE = re.compile(r'([ab])([0-9a-z]):')
+_ERROR_RE = re.compile(r'(\{\s*"error".*?\})', re.DOTALL)
+# 油猴脚本在请求被限流时回传 "网络响应不正常。状态: 429. ..."
+_RATE_LIMIT_RE = re.compile(r'\b429\b|too many requests|rate limit', re.IGNORECASE)
+
+CLOUDFLARE_MARKERS = ('<title>just a moment...</title>', 'enable javascript and cookies to continue')
+_MARKER_OVERLAP = max(len(m) for m in CLOUDFLARE_MARKERS) - 1
+
+# 尚未遇到换行的半行超过此长度时，不再尝试提前解析，直接等待换行（避免对超长记录反复扫描）
+_EAGER_PARSE_LIMIT = 4096
+# 非记录文本（如错误 JSON）的最大保留长度
+_LOOSE_LIMIT = 65536
+
+
+def is_cloudflare_page(text: str) -> bool:
+    """判断文本中是否包含 Cloudflare 人机验证页面的特征。"""
+    lowered = text.lower()
+    return any(marker in lowered for marker in CLOUDFLARE_MARKERS)
+
+
+def classify_browser_error(message) -> str:
+    """
+    对油猴脚本回传的错误消息进行分类。
+    返回 'attachment_too_large'、'cloudflare'、'rate_limited' 或 'other'。
+    """
+    if isinstance(message, str):
+        if '413' in message or 'too large' in message.lower():
+            return 'attachment_too_large'
+        if is_cloudflare_page(message):
+            return 'cloudflare'
+        if _RATE_LIMIT_RE.search(message):
+            return 'rate_limited'
+    return 'other'
+
+
+class LMArenaStreamParser:
+    """
+    有状态的 LMArena 记录流解析器。
+    feed() 接收新的数据块并返回本块产生的事件列表；收到 [DONE] 后调用 close() 处理残留数据。
+    事件类型:
+    - ('content', str): 文本增量，或以 Markdown 包装的图片
+    - ('finish', str): 结束原因
+    - ('error', 任意值): 来自 LMArena 的错误（值可能为 None，由调用方提供默认提示）
+    - ('cloudflare', None): 检测到 Cloudflare 验证页面
+    """
+
+    def __init__(self):
+        self._partial: list[str] = []
+        self._partial_len = 0
+        self._tail = ""
+        self._loose = ""
+
+    def feed(self, data: str) -> list:
+        events = []
+        if not data:
+            return events
+
+        # 只检查新数据，以及上一块末尾可能被截断的标记
+        window = self._tail + data
+        if is_cloudflare_page(window):
+            return [('cloudflare', None)]
+        self._tail = window[-_MARKER_OVERLAP:]
+
+        start = 0
+        newline = data.find('\n')
+        if newline != -1 and self._partial:
+            self._partial.append(data[:newline])
+            line = ''.join(self._partial)
+            self._partial.clear()
+            self._partial_len = 0
+            self._parse(line, events, final=True)
+            start = newline + 1
+            newline = data.find('\n', start)
+
+        while newline != -1:
+            self._parse(data[start:newline], events, final=True)
+            start = newline + 1
+            newline = data.find('\n', start)
+
+        if start < len(data):
+            self._partial.append(data[start:])
+            self._partial_len += len(data) - start
+            # 记录之间可能没有换行：对较短的半行尝试提前解析已完整的记录
+            if self._partial_len <= _EAGER_PARSE_LIMIT:
+                pending = ''.join(self._partial)
+                consumed = self._parse(pending, events, final=False)
+                rest = pending[consumed:]
+                self._partial = [rest] if rest else []
+                self._partial_len = len(rest)
+        return events
+
+    def close(self) -> list:
+        """处理流结束时仍未以换行结尾的数据。"""
+        events = []
+        if self._partial:
+            line = ''.join(self._partial)
+            self._partial.clear()
+            self._partial_len = 0
+            self._parse(line, events, final=True)
+        return events
+
+    def _parse(self, text: str, events: list, final: bool) -> int:
+        """解析 text 中的连续记录，返回已消费的字符数。final=False 时遇到不完整的记录即停止。"""
+        pos, end = 0, len(text.rstrip())
+        while pos < end:
+            match = _RECORD_RE.match(text, pos)
+            if not match:
+                if not final:
+                    return pos
+                self._feed_loose(text[pos:end], events)
+                return len(text)
+            try:
+                value, pos = decode_at(text, match.end(), end)
+            except ValueError:
+                # final=True 时整行都无法解析，直接丢弃
+                return pos if not final else len(text)
+            self._dispatch(match.group(2), value, events)
+        return len(text) if final else pos
+
+    def _dispatch(self, kind: str, value, events: list):
+        if kind == '0':
+            if isinstance(value, str) and value:
+                events.append(('content', value))
+        elif kind == '2':
+            if isinstance(value, list) and value:
+                info = value[0]
+                if isinstance(info, dict) and info.get("type") == "image" and "image" in info:
+                    events.append(('content', f"![Image]({info['image']})"))
+        elif kind == 'd':
+            if isinstance(value, dict) and "finishReason" in value:
+                events.append(('finish', value.get("finishReason") or "stop"))
+        elif kind == '3':
+            events.append(('error', value))
+
+    def _feed_loose(self, text: str, events: list):
+        """非记录文本：在有界缓冲区中查找 {"error": ...} 形式的错误。"""
+        self._loose = (self._loose + text + "\n")[-_LOOSE_LIMIT:]
+        match = _ERROR_RE.search(self._loose)
+        if not match:
+            return
+        try:
+            error_json = json.loads(match.group(1))
+        except json.JSONDecodeError:
+            return
+        self._loose = ""
+        if isinstance(error_json, dict):
+            events.append(('error', error_json.get("error")))
@@ -0,0 +1,160 @@
+# tracing.py
+# 按请求记录带时间戳的阶段（api_server.py 与 TampermonkeyScript/lm模型后端.py 共用），用于查看延迟花在哪里。
+# 每个被抽中（trace_sample_rate）的请求记录：
+# - 时间段: parse（读取请求体）、convert（转换载荷）、admission（准入排队）、ws_send（发送给标签页）、request（整个请求）；
+# - 时间点: first_browser_byte（标签页回传第一块数据）、first_sse_write（向客户端写出第一个内容块）、stream_end（浏览器流结束及结果）、
+#   failover / hedge（重新分发），以及 finish。
+# 参数只包含计数、长度、标签页与结果等元数据，不含消息文本；字符串参数超过 trace_max_arg_chars 时截断。
+# 结束的请求放入固定大小的环形缓冲区（trace_buffer_size 个请求），GET /debug/trace 导出为 Chrome trace 格式
+# （chrome://tracing 或 https://ui.perfetto.dev 打开），每个请求一条轨道，进行中的请求也一并导出。
+# 未抽中的请求得到 NULL_TRACE，它的方法什么也不做，调用方不需要判断是否抽中。
+
+import os
+import random
+import time
+from collections import deque
+
+DEFAULT_BUFFER_SIZE = 256
+DEFAULT_MAX_ARG_CHARS = 200
+# active 中的 request_id 数上限。绑定后没有调用 end 的 trace 不会被淘汰，会一直作为“进行中”出现在 /debug/trace 中
+# （每个最多 MAX_EVENTS 个事件）；达到上限后新请求不再抽样，计入 stats["skipped"]
+MAX_ACTIVE = 1024
+# 单个请求最多记录的事件数（多次重试时防止无限增长）
+MAX_EVENTS = 64
+# perf_counter 与墙钟时间的差，导出的时间戳为墙钟微秒，便于与日志对照
+_EPOCH = time.time() - time.perf_counter()
+
+
+class Trace:
+    __slots__ = ("tid", "start", "args", "events", "request_ids", "max_arg_chars", "ended")
+    sampled = True
+
+    def __init__(self, tid: int, max_arg_chars: int):
+        self.tid = tid
+        self.start = time.perf_counter()
+        self.args = {}
+        self.events = []
+        self.request_ids = []
+        self.max_arg_chars = max_arg_chars
+        self.ended = False
+
+    def _clip(self, args: dict) -> dict:
+        limit = self.max_arg_chars
+        return {k: (v[:limit] + "…" if isinstance(v, str) and len(v) > limit else v) for k, v in args.items() if v is not None}
+
+    def set(self, **args) -> None:
+        """设置整个请求的参数（模型、是否流式等），显示在 request 时间段上。"""
+        self.args.update(self._clip(args))
+
+    def span(self, name: str, start: float, **args) -> None:
+        """记录从 start（time.perf_counter()）到现在的时间段。"""
+        if len(self.events) < MAX_EVENTS:
+            self.events.append(("X", name, start, time.perf_counter() - start, self._clip(args) if args else None))
+
+    def mark(self, name: str, **args) -> None:
+        """记录一个时间点。"""
+        if len(self.events) < MAX_EVENTS:
+            self.events.append(("i", name, time.perf_counter(), 0, self._clip(args) if args else None))
+
+
+class _NullTrace:
+    """未抽中的请求：所有方法都不做任何事。"""
+    __slots__ = ()
+    sampled = False
+
+    def set(self, **args) -> None:
+        pass
+
+    def span(self, name: str, start: float, **args) -> None:
+        pass
+
+    def mark(self, name: str, **args) -> None:
+        pass
+
+
+NULL_TRACE = _NullTrace()
+
+
+class Tracer:
+    """
+    - begin(): 请求开始时调用，按 trace_sample_rate 返回 Trace 或 NULL_TRACE。
+    - bind(trace, request_id): 分配 request_id 后调用（重试/对冲的新 request_id 也绑定到同一个 trace），
+      之后在只知道 request_id 的地方用 get(request_id) 取回。
+    - end(trace, **args): 请求结束（响应写完或客户端断开）时调用，移入环形缓冲区。
+    只应在事件循环线程中调用（不加锁）。
+    """
+
+    def __init__(self):
+        self.rate = 1.0
+        self.max_arg_chars = DEFAULT_MAX_ARG_CHARS
+        self.finished: deque[Trace] = deque(maxlen=DEFAULT_BUFFER_SIZE)
+        self.active: dict[str, Trace] = {}
+        self.next_tid = 1
+        self.pid = os.getpid()
+        self.stats = {"sampled": 0, "finished": 0, "skipped": 0}
+
+    def configure(self, config) -> None:
+        """从 config.jsonc 读取抽样比例与缓冲区大小（配置重新加载后调用）。"""
+        self.rate = min(1.0, max(0.0, float(config.get("trace_sample_rate", 1.0))))
+        self.max_arg_chars = max(16, int(config.get("trace_max_arg_chars", DEFAULT_MAX_ARG_CHARS)))
+        size = max(1, int(config.get("trace_buffer_size", DEFAULT_BUFFER_SIZE)))
+        if size != self.finished.maxlen:
+            self.finished = deque(self.finished, maxlen=size)
+
+    def begin(self):
+        if self.rate <= 0 or (self.rate < 1 and random.random() >= self.rate):
+            return NULL_TRACE
+        if len(self.active) >= MAX_ACTIVE:
+            self.stats["skipped"] += 1
+            return NULL_TRACE
+        trace = Trace(self.next_tid, self.max_arg_chars)
+        self.next_tid += 1
+        self.stats["sampled"] += 1
+        return trace
+
+    def bind(self, trace, request_id: str) -> None:
+        if trace.sampled and not trace.ended:
+            trace.request_ids.append(request_id)
+            self.active[request_id] = trace
+
+    def get(self, request_id: str):
+        return self.active.get(request_id, NULL_TRACE)
+
+    def end(self, trace, **args) -> None:
+        if not trace.sampled or trace.ended:
+            return
+        trace.ended = True
+        trace.mark("finish", **args)
+        trace.events.append(("X", "request", trace.start, time.perf_counter() - trace.start, trace.args))
+        for request_id in trace.request_ids:
+            if self.active.get(request_id) is trace:
+                del self.active[request_id]
+        self.stats["finished"] += 1
+        self.finished.append(trace)
+
+    def chrome_trace(self, limit: int = None) -> dict:
+        """导出为 Chrome trace 事件格式（时间单位为微秒）：已结束的请求（最近 limit 个）加上进行中的请求。"""
+        traces = list(self.finished)
+        if limit:
+            traces = traces[-limit:]
+        seen = {id(t) for t in traces}
+        for trace in self.active.values():
+            if id(trace) not in seen:
+                seen.add(id(trace))
+                traces.append(trace)
+
+        events = [{"name": "process_name", "ph": "M", "pid": self.pid, "args": {"name": "LMArena Bridge"}}]
+        for trace in traces:
+            label = " ".join(filter(None, (str(trace.args.get("model") or ""), trace.request_ids[0][:8] if trace.request_ids else None)))
+            events.append({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": trace.tid, "args": {"name": label or f"request {trace.tid}"}})
+            for kind, name, start, duration, args in trace.events:
+                event = {"name": name, "ph": kind, "ts": round((_EPOCH + start) * 1e6), "pid": self.pid, "tid": trace.tid}
+                if kind == "X":
+                    event["dur"] = round(duration * 1e6)
+                else:
+                    event["s"] = "t"
+                if args:
+                    event["args"] = args
+                events.append(event)
+        return {"traceEvents": events, "displayTimeUnit": "ms",
+                "otherData": {"sample_rate": self.rate, "buffered": len(self.finished), "in_progress": len(self.active), **self.stats}}
@@ -0,0 +1,140 @@
+# traffic_capture.py
+# 按比例抽样记录浏览器回传的原始数据块（api_server.py 与 TampermonkeyScript/lm模型后端.py 共用，需显式开启）。
+# 解析器在真实流量上出错或变慢时，很难复现当时的分块方式；开启后抽中的请求会记录：
+# - 请求开始：request_id、时间、模型、标签页与协议版本、载荷元数据（每条消息的角色和长度、附件的类型和大小，不含文本与附件内容）；
+# - 每个数据块：相对请求开始的时间和原样的数据（文本块、"[DONE]" 或 {"error": ...}），保留原始的分块边界；
+# - 请求结束：结果（与 /metrics 的 outcome 相同）。
+# 请求进行中只在内存中追加（每个请求最多 traffic_capture_max_request_kb，超出后不再记录数据块），
+# 结束时整个请求压缩为一个 gzip 成员，在线程池中追加到 <traffic_capture_dir>/capture_<启动时间>.jsonl.gz
+# （多个 gzip 成员直接拼接仍是合法的 gzip 文件，可用 gzip.open 按行读取）。文件超过 traffic_capture_max_mb 后不再写入。
+# 用 benchmarks/replay_capture.py 离线重放。
+
+import asyncio
+import gzip
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime
+
+DEFAULT_MAX_REQUEST_BYTES = 4 * 1024 * 1024
+DEFAULT_MAX_FILE_BYTES = 256 * 1024 * 1024
+# 同时记录的请求数上限（正常情况下请求都会调用 end；防止异常路径上的记录无限累积）
+MAX_IN_PROGRESS = 256
+
+
+def payload_metadata(payload: dict) -> dict:
+    """载荷中可以记录的部分：目标模型、会话 ID 前缀、每条消息的角色/位置/长度和附件的类型/大小。"""
+    messages = []
+    for template in payload.get("message_templates") or ():
+        if not isinstance(template, dict):
+            continue
+        attachments = []
+        for attachment in template.get("attachments") or ():
+            if isinstance(attachment, dict):
+                url = attachment.get("url")
+                attachments.append({"type": attachment.get("contentType"),
+                                    "size": attachment.get("size") or (len(url) if isinstance(url, str) else None)})
+        content = template.get("content")
+        messages.append({"role": template.get("role"), "pos": template.get("participantPosition"),
+                         "chars": len(content) if isinstance(content, str) else 0, "attachments": attachments})
+    session_id = payload.get("session_id")
+    return {"target_model_id": payload.get("target_model_id"),
+            "session": session_id[:8] if isinstance(session_id, str) else None, "messages": messages}
+
+
+class _Capture:
+    __slots__ = ("started", "lines", "size", "truncated")
+
+    def __init__(self, started: float, first_line: str):
+        self.started = started
+        self.lines = [first_line]
+        self.size = len(first_line)
+        self.truncated = False
+
+
+class TrafficCapture:
+    """
+    - begin(request_id, model, payload, tab, protocol): 请求发给标签页之前调用，按 traffic_capture_rate 决定是否记录。
+    - chunk(request_id, data): 浏览器数据块放入响应通道时调用；未抽中的请求只是一次字典查找。
+    - end(request_id, outcome): 请求结束时调用，把记录交给后台线程写入；discard() 丢弃记录（发送失败时）。
+    - stats: sampled / written / truncated / dropped（文件已达上限）/ errors。
+    begin/chunk/end 只应在事件循环线程中调用（不加锁）。
+    """
+
+    def __init__(self, base_dir: str = "."):
+        self.base_dir = base_dir
+        self.dir = os.path.join(base_dir, "captures")
+        self.rate = 0.0
+        self.max_request_bytes = DEFAULT_MAX_REQUEST_BYTES
+        self.max_file_bytes = DEFAULT_MAX_FILE_BYTES
+        self.current_file: str | None = None
+        self.stats = {"sampled": 0, "written": 0, "truncated": 0, "dropped": 0, "errors": 0}
+        self._active: dict[str, _Capture] = {}
+        self._file_size = 0
+        self._lock = threading.Lock()
+
+    def configure(self, config) -> None:
+        """从 config.jsonc 读取抽样比例与大小上限（配置重新加载后调用）。"""
+        self.rate = min(1.0, max(0.0, float(config.get("traffic_capture_rate", 0) or 0)))
+        directory = config.get("traffic_capture_dir") or "captures"
+        self.dir = directory if os.path.isabs(directory) else os.path.join(self.base_dir, directory)
+        self.max_request_bytes = int(config.get("traffic_capture_max_request_kb", DEFAULT_MAX_REQUEST_BYTES // 1024)) * 1024
+        self.max_file_bytes = int(config.get("traffic_capture_max_mb", DEFAULT_MAX_FILE_BYTES // (1024 * 1024))) * 1024 * 1024
+
+    def begin(self, request_id: str, model: str, payload: dict, tab: str = None, protocol: int = None) -> None:
+        if self.rate <= 0 or random.random() >= self.rate or len(self._active) >= MAX_IN_PROGRESS:
+            return
+        now = time.time()
+        line = json.dumps({"k": "open", "id": request_id, "t": round(now, 3), "model": model, "tab": tab,
+                           "protocol": protocol, "meta": payload_metadata(payload)}, ensure_ascii=False)
+        self._active[request_id] = _Capture(now, line)
+        self.stats["sampled"] += 1
+
+    def chunk(self, request_id: str, data) -> None:
+        capture = self._active.get(request_id)
+        if capture is None or capture.truncated:
+            return
+        line = json.dumps({"k": "c", "dt": round(time.time() - capture.started, 4), "d": data}, ensure_ascii=False)
+        if capture.size + len(line) > self.max_request_bytes:
+            capture.truncated = True
+            self.stats["truncated"] += 1
+            return
+        capture.lines.append(line)
+        capture.size += len(line)
+
+    def discard(self, request_id: str) -> None:
+        self._active.pop(request_id, None)
+
+    def end(self, request_id: str, outcome: str) -> None:
+        capture = self._active.pop(request_id, None)
+        if capture is None:
+            return
+        capture.lines.append(json.dumps({"k": "end", "dt": round(time.time() - capture.started, 4),
+                                         "outcome": outcome, "truncated": capture.truncated}))
+        text = "\n".join(capture.lines) + "\n"
+        asyncio.get_running_loop().run_in_executor(None, self._write, text)
+
+    def _write(self, text: str) -> None:
+        """在线程池中运行：压缩为一个 gzip 成员并追加到当前文件。"""
+        data = gzip.compress(text.encode("utf-8", "surrogatepass"), compresslevel=6)
+        with self._lock:
+            if self._file_size + len(data) > self.max_file_bytes:
+                self.stats["dropped"] += 1
+                return
+            try:
+                if self.current_file is None:
+                    os.makedirs(self.dir, exist_ok=True)
+                    self.current_file = os.path.join(self.dir, f"capture_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.jsonl.gz")
+                with open(self.current_file, "ab") as f:
+                    f.write(data)
+                self._file_size += len(data)
+                self.stats["written"] += 1
+            except OSError as e:
+                self.stats["errors"] += 1
+                print(f"[WARN] 写入流量记录失败: {e}")
+
+    def status(self) -> dict:
+        return {"rate": self.rate, "file": self.current_file, "file_bytes": self._file_size,
+                "in_progress": len(self._active), "stats": dict(self.stats)}
@@ -1,4 +1,7 @@
 # update_script.py
+# 用法: python modules/update_script.py [--apply-only]
+# --apply-only: 只复制文件并合并配置，不等待主程序退出、也不启动主程序。
+#               api_server.py 在支持不中断服务的重启时使用，文件更新后由主程序自己完成进程交接。
 import os
 import shutil
 import time
@@ -34,12 +37,14 @@ def get_all_relative_paths(directory):
                 paths.add(os.path.relpath(dir_path, directory) + os.sep)
     return paths
 
-def main():
+def main(apply_only=False):
+    """应用 update_temp 中的更新，成功返回 True。"""
     print("--- 更新脚本已启动 ---")
     
-    # 1. 等待主程序退出
-    print("等待主程序关闭 (3秒)...")
-    time.sleep(3)
+    # 1. 等待主程序退出（--apply-only 时主程序仍在运行，无需等待）
+    if not apply_only:
+        print("等待主程序关闭 (3秒)...")
+        time.sleep(3)
     
     # 2. 定义路径
     destination_dir = os.getcwd()
@@ -51,7 +56,7 @@ def main():
     
     if not os.path.exists(source_dir_inner):
         print(f"错误：找不到源目录 {source_dir_inner}。更新失败。")
-        return
+        return False
         
     print(f"源目录: {os.path.abspath(source_dir_inner)}")
     print(f"目标目录: {os.path.abspath(destination_dir)}")
@@ -106,7 +111,7 @@ def main():
 
     except Exception as e:
         print(f"文件复制过程中发生错误: {e}")
-        return
+        return False
 
     # 8. 智能合并配置
     if old_config_values and os.path.exists(new_config_template_path):
@@ -150,13 +155,17 @@ def main():
     except Exception as e:
         print(f"清理临时文件时发生错误: {e}")
 
+    if apply_only:
+        print("--- 更新文件已应用，由主程序完成重启 ---")
+        return True
+
     # 10. 重启主程序
     print("\n[*] 正在重启主程序...")
     try:
         main_script_path = os.path.join(destination_dir, "api_server.py")
         if not os.path.exists(main_script_path):
              print(f"错误: 找不到主程序脚本 {main_script_path}。")
-             return
+             return False
         
         subprocess.Popen([sys.executable, main_script_path])
         print("主程序已在后台重新启动。")
@@ -165,6 +174,7 @@ def main():
         print(f"请手动运行 {main_script_path}")
 
     print("--- 更新完成 ---")
+    return True
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(0 if main(apply_only="--apply-only" in sys.argv[1:]) else 1)
\ No newline at end of file
@@ -0,0 +1,219 @@
+# worker_pool.py
+# 浏览器标签页工作池：管理多个油猴脚本 WebSocket 连接，并把请求分发到负载最低的健康标签页。
+# api_server.py 与 TampermonkeyScript/lm模型后端.py 共用此模块。
+
+import time
+import uuid
+
+from modules.json_codec import dumps
+
+# 油猴脚本未声明并发上限时使用的默认值
+DEFAULT_MAX_CONCURRENCY = 3
+# 平滑往返时间中新样本的权重（与 TCP 的 SRTT 相同）
+RTT_GAIN = 0.125
+
+
+class BrowserWorker:
+    """
+    一个已连接的浏览器标签页。
+    - send_text: 发送文本帧的协程函数（FastAPI 为 websocket.send_text，aiohttp 为 ws.send_str）。
+    - close: 可选的关闭连接协程函数，用于替换同 ID 的旧连接。
+    - send_bytes / codec: 协商为协议 v2 时发送二进制帧的协程函数和该连接的 StreamCodec（见 ws_protocol.py）。
+    - attachment_store: 标签页不支持附件引用（旧版脚本）时传入 AttachmentStore，发送前把引用还原为 data URL。
+    - drain_reconnect: 脚本收到 reconnect 指令后是否保留旧连接处理完已有请求（旧版脚本会刷新页面）。
+    - heartbeat: 脚本是否应答应用层心跳（见 heartbeat.py）；rtt 为平滑往返时间（秒），last_seen 为最后一次收到消息的时间。
+    - pending: 当前由该标签页负责的 request_id 集合。
+    """
+
+    def __init__(self, worker_id: str, send_text, max_concurrency: int = DEFAULT_MAX_CONCURRENCY, close=None,
+                 send_bytes=None, codec=None, attachment_store=None, drain_reconnect: bool = False,
+                 heartbeat: bool = False):
+        self.worker_id = worker_id
+        self.max_concurrency = max(1, int(max_concurrency or DEFAULT_MAX_CONCURRENCY))
+        self.healthy = True
+        self.pending: set[str] = set()
+        self.connected_at = time.time()
+        self.total_requests = 0
+        self._send_text = send_text
+        self._send_bytes = send_bytes
+        self._close = close
+        self.codec = codec if send_bytes is not None else None
+        self._attachment_store = attachment_store
+        self.drain_reconnect = drain_reconnect
+        self.heartbeat = heartbeat
+        self.last_seen = self.connected_at
+        self.rtt: float | None = None
+        self.missed_heartbeats = 0
+        self.seen_since_ping = False
+        self._ping_seq = 0
+        self._ping_sent_at: float | None = None
+
+    @property
+    def protocol(self) -> int:
+        return 2 if self.codec is not None else 1
+
+    @property
+    def attachment_refs(self) -> bool:
+        return self._attachment_store is None
+
+    @property
+    def in_flight(self) -> int:
+        return len(self.pending)
+
+    @property
+    def load(self) -> float:
+        """按并发上限归一化后的负载（0 表示空闲，1 表示已满）。"""
+        return len(self.pending) / self.max_concurrency
+
+    @property
+    def available(self) -> bool:
+        """健康且最近一次心跳有应答（未应答的标签页不再分发新请求）。"""
+        return self.healthy and not self.missed_heartbeats
+
+    @property
+    def ping_outstanding(self) -> bool:
+        return self._ping_sent_at is not None
+
+    def has_capacity(self) -> bool:
+        return self.available and len(self.pending) < self.max_concurrency
+
+    def touch(self):
+        """收到该标签页的任意消息时调用。"""
+        self.last_seen = time.time()
+        self.seen_since_ping = True
+
+    def mark_ping(self, seq: int):
+        self._ping_seq = seq
+        self._ping_sent_at = time.monotonic()
+        self.seen_since_ping = False
+
+    def record_pong(self, seq: int) -> float | None:
+        """处理 pong 回复，返回本次往返时间；序号与最近一次 ping 不符（迟到的回复）时忽略。"""
+        if seq != self._ping_seq or self._ping_sent_at is None:
+            return None
+        sample = time.monotonic() - self._ping_sent_at
+        self._ping_sent_at = None
+        self.missed_heartbeats = 0
+        self.rtt = sample if self.rtt is None else self.rtt + RTT_GAIN * (sample - self.rtt)
+        return sample
+
+    async def send_json(self, obj: dict):
+        await self._send_text(dumps(obj))
+
+    async def send_request(self, request_id: str, payload: dict):
+        """
+        把请求载荷发送给标签页：协议 v2 使用二进制 OPEN 帧，否则为 v1 的 JSON 文本帧。
+        不支持附件引用的标签页先还原附件，附件已被淘汰时抛出 AttachmentMissing（由调用方按发送失败处理）。
+        """
+        if self._attachment_store is not None:
+            payload = await self._attachment_store.inline(payload)
+        if self.codec is not None:
+            await self._send_bytes(self.codec.encode_request(request_id, payload))
+        else:
+            await self.send_json({"request_id": request_id, "payload": payload})
+
+    async def close(self):
+        if self._close:
+            try:
+                await self._close()
+            except Exception:
+                pass
+
+    def to_status(self) -> dict:
+        return {
+            "worker_id": self.worker_id,
+            "healthy": self.healthy,
+            "in_flight": len(self.pending),
+            "max_concurrency": self.max_concurrency,
+            "protocol": self.protocol,
+            "attachment_refs": self.attachment_refs,
+            "drain_reconnect": self.drain_reconnect,
+            "heartbeat": self.heartbeat,
+            "rtt_ms": round(self.rtt * 1000, 1) if self.rtt is not None else None,
+            "missed_heartbeats": self.missed_heartbeats,
+            "last_seen": self.last_seen,
+            "last_seen_ago_seconds": round(time.time() - self.last_seen, 1),
+            "total_requests": self.total_requests,
+            "connected_at": self.connected_at,
+        }
+
+
+class WorkerPool:
+    """
+    管理所有已连接的标签页，以及 request_id 到所属标签页的归属关系。
+    所有方法都只应在事件循环线程中调用（不加锁）。
+    """
+
+    def __init__(self):
+        self.workers: dict[str, BrowserWorker] = {}
+        self._owners: dict[str, BrowserWorker] = {}
+
+    def __len__(self) -> int:
+        return len(self.workers)
+
+    @staticmethod
+    def new_worker_id() -> str:
+        return f"tab-{uuid.uuid4().hex[:8]}"
+
+    def register(self, worker: BrowserWorker):
+        """注册标签页。若已存在同 ID 的连接，返回被替换的旧连接（调用方负责关闭）。"""
+        old = self.workers.get(worker.worker_id)
+        self.workers[worker.worker_id] = worker
+        return old if old is not worker else None
+
+    def unregister(self, worker: BrowserWorker) -> list[str]:
+        """注销标签页，返回仍由它负责、需要判定失败的 request_id 列表。"""
+        if self.workers.get(worker.worker_id) is worker:
+            del self.workers[worker.worker_id]
+        orphaned = list(worker.pending)
+        for request_id in orphaned:
+            if self._owners.get(request_id) is worker:
+                del self._owners[request_id]
+        worker.pending.clear()
+        return orphaned
+
+    def pick(self, exclude=()) -> BrowserWorker | None:
+        """选择负载最低的健康标签页；没有可用标签页时返回 None。"""
+        best = None
+        for worker in self.workers.values():
+            if not worker.available or worker.worker_id in exclude:
+                continue
+            if best is None or (worker.load, worker.in_flight, worker.total_requests) < (best.load, best.in_flight, best.total_requests):
+                best = worker
+        return best
+
+    def any(self) -> BrowserWorker | None:
+        """返回任意一个可用的标签页（用于发送页面源码等不针对具体请求的指令）。"""
+        healthy = [w for w in self.workers.values() if w.available]
+        candidates = healthy or list(self.workers.values())
+        return max(candidates, key=lambda w: w.connected_at) if candidates else None
+
+    def assign(self, request_id: str, worker: BrowserWorker):
+        worker.pending.add(request_id)
+        worker.total_requests += 1
+        self._owners[request_id] = worker
+
+    def release(self, request_id: str) -> BrowserWorker | None:
+        worker = self._owners.pop(request_id, None)
+        if worker:
+            worker.pending.discard(request_id)
+        return worker
+
+    def owner(self, request_id: str) -> BrowserWorker | None:
+        return self._owners.get(request_id)
+
+    async def broadcast(self, obj: dict, predicate=None) -> int:
+        """向所有标签页（或 predicate 为真的标签页）发送同一条指令，返回发送成功的数量。"""
+        sent = 0
+        for worker in list(self.workers.values()):
+            if predicate is not None and not predicate(worker):
+                continue
+            try:
+                await worker.send_json(obj)
+                sent += 1
+            except Exception:
+                pass
+        return sent
+
+    def status(self) -> list[dict]:
+        return [w.to_status() for w in self.workers.values()]
@@ -0,0 +1,185 @@
+# ws_protocol.py
+# 与油猴脚本之间的 WebSocket 协议 v2（二进制帧）。
+# v1 中每个数据块都是 JSON.stringify({request_id, data}) 文本帧，请求载荷中的附件以 base64 内嵌在 JSON 里。
+# v2 由脚本在连接时通过 ?protocol=2 申请，服务器回复 {"command": "protocol", "version": 2} 后生效：
+# - 每个请求分配一个连接内唯一的 32 位整数流 ID，代替 36 字符的 UUID；
+# - 脚本回传原始响应字节，一个 DATA 帧可以携带多个流的数据块（按流 ID 增量解码 UTF-8，服务器不再 json.loads）；
+# - OPEN 帧中 base64 附件以原始字节单独传输（体积减少约 1/4），较大的 JSON 部分可以用 deflate-raw 压缩
+#   （脚本通过 ?compress=deflate-raw 声明支持）。
+# 控制指令（pause/resume/refresh 等）在两个版本中都是 JSON 文本帧。
+# api_server.py 与 TampermonkeyScript/lm模型后端.py 共用此模块。
+#
+# 帧格式（整数均为大端序）:
+#   OPEN (服务器 -> 脚本): u8 类型=1, u8 标志, u32 流ID, u32 JSON长度, JSON, u16 附件数, [u32 长度, 字节]...
+#       JSON 为 {"request_id": ..., "payload": ...}，被提取的附件 url 为 null，并带有 "blob": 序号 和 "blob_type": MIME。
+#   DATA (脚本 -> 服务器): u8 类型=2, u8 标志, 之后是若干记录 [u8 种类, u32 流ID, u32 长度, 字节]
+#       种类 0 = 响应数据（UTF-8 字节，可在多字节字符中间截断），1 = 结束（等同 v1 的 "[DONE]"），2 = 错误信息。
+#   标志位 0x01 表示帧体（OPEN 帧中为 JSON 部分）经过 deflate-raw 压缩。
+
+import base64
+import binascii
+import codecs
+import re
+import struct
+import zlib
+
+from modules.json_codec import dumps_bytes
+
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+
+FRAME_OPEN = 1
+FRAME_DATA = 2
+FLAG_DEFLATE = 0x01
+
+RECORD_DATA = 0
+RECORD_DONE = 1
+RECORD_ERROR = 2
+
+DEFAULT_COMPRESS_MIN_BYTES = 32 * 1024
+
+_OPEN_HEADER = struct.Struct(">BBII")
+_RECORD_HEADER = struct.Struct(">BII")
+_U16 = struct.Struct(">H")
+_U32 = struct.Struct(">I")
+_BASE64_DATA_URL = re.compile(r"data:([^;,]*)((?:;[^;,]*)*);base64,")
+
+
+def negotiate(params, enabled: bool = True) -> tuple[int, bool]:
+    """根据连接的查询参数选择协议版本，返回 (版本, 是否可以压缩发给脚本的帧)。"""
+    if not enabled or params.get("protocol") != str(PROTOCOL_V2):
+        return PROTOCOL_V1, False
+    return PROTOCOL_V2, params.get("compress") == "deflate-raw"
+
+
+def hello_message(version: int = PROTOCOL_V2) -> dict:
+    """连接建立后发给脚本的协议确认指令。"""
+    return {"command": "protocol", "version": version}
+
+
+def _deflate(data: bytes) -> bytes:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _inflate(data) -> bytes:
+    return zlib.decompress(data, -15)
+
+
+def _extract_blobs(payload: dict) -> tuple[dict, list[bytes]]:
+    """复制载荷，把消息模板中 base64 data URL 形式的附件换成二进制块的序号（不修改原载荷）。"""
+    blobs: list[bytes] = []
+    templates = []
+    for template in payload.get("message_templates") or ():
+        attachments = template.get("attachments") if isinstance(template, dict) else None
+        if not attachments:
+            templates.append(template)
+            continue
+        converted = []
+        for attachment in attachments:
+            url = attachment.get("url") if isinstance(attachment, dict) else None
+            match = _BASE64_DATA_URL.match(url) if isinstance(url, str) else None
+            if match:
+                try:
+                    blob = base64.b64decode(url[match.end():], validate=False)
+                except (binascii.Error, ValueError):
+                    blob = None
+                if blob is not None:
+                    converted.append({**attachment, "url": None, "blob": len(blobs), "blob_type": match.group(1) or "application/octet-stream"})
+                    blobs.append(blob)
+                    continue
+            converted.append(attachment)
+        templates.append({**template, "attachments": converted})
+    if not blobs:
+        return payload, blobs
+    return {**payload, "message_templates": templates}, blobs
+
+
+class StreamCodec:
+    """
+    单个 v2 连接的编解码状态：request_id 与整数流 ID 的对应关系，以及每个流的增量 UTF-8 解码器。
+    流在收到结束记录后释放。只应在该连接的事件循环中使用（不加锁）。
+    """
+
+    def __init__(self, compress: bool = False, compress_min_bytes: int = DEFAULT_COMPRESS_MIN_BYTES):
+        self.compress = compress
+        self.compress_min_bytes = compress_min_bytes
+        self.bytes_saved = 0
+        self._next_id = 1
+        self._streams: dict[int, str] = {}
+        self._decoders: dict[int, codecs.IncrementalDecoder] = {}
+
+    def __len__(self) -> int:
+        return len(self._streams)
+
+    def open_stream(self, request_id: str) -> int:
+        stream_id = self._next_id
+        self._next_id = (self._next_id % 0xFFFFFFFF) + 1
+        self._streams[stream_id] = request_id
+        self._decoders[stream_id] = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        return stream_id
+
+    def encode_request(self, request_id: str, payload: dict) -> bytes:
+        """为请求分配流 ID 并编码 OPEN 帧。"""
+        stream_id = self.open_stream(request_id)
+        payload, blobs = _extract_blobs(payload)
+        body = dumps_bytes({"request_id": request_id, "payload": payload})
+        flags = 0
+        if self.compress and len(body) >= self.compress_min_bytes:
+            compressed = _deflate(body)
+            if len(compressed) < len(body):
+                self.bytes_saved += len(body) - len(compressed)
+                body, flags = compressed, FLAG_DEFLATE
+        parts = [_OPEN_HEADER.pack(FRAME_OPEN, flags, stream_id, len(body)), body, _U16.pack(len(blobs))]
+        for blob in blobs:
+            parts.append(_U32.pack(len(blob)))
+            parts.append(blob)
+        return b"".join(parts)
+
+    def decode(self, frame: bytes) -> list[tuple[str | None, object]]:
+        """
+        解码脚本发来的 DATA 帧，返回 [(request_id, data)]，data 与 v1 相同：文本块、"[DONE]" 或 {"error": ...}。
+        同一帧中同一个流的相邻数据块会被合并。未知流 ID 的 request_id 为 None。格式错误时抛出 ValueError。
+        """
+        if len(frame) < 2 or frame[0] != FRAME_DATA:
+            raise ValueError("不是 DATA 帧")
+        body = memoryview(frame)[2:]
+        if frame[1] & FLAG_DEFLATE:
+            try:
+                body = memoryview(_inflate(body))
+            except zlib.error as e:
+                raise ValueError(f"无法解压 DATA 帧: {e}") from e
+        results: list[tuple[str | None, object]] = []
+        offset, end = 0, len(body)
+        while offset < end:
+            if end - offset < _RECORD_HEADER.size:
+                raise ValueError("DATA 帧记录头不完整")
+            kind, stream_id, length = _RECORD_HEADER.unpack_from(body, offset)
+            offset += _RECORD_HEADER.size
+            if length > end - offset:
+                raise ValueError("DATA 帧记录长度超出帧范围")
+            chunk = body[offset:offset + length]
+            offset += length
+            request_id = self._streams.get(stream_id)
+            decoder = self._decoders.get(stream_id)
+            if kind == RECORD_DATA:
+                text = decoder.decode(chunk) if decoder else bytes(chunk).decode("utf-8", "replace")
+                if not text:
+                    continue
+                if results and results[-1][0] == request_id and request_id is not None and isinstance(results[-1][1], str) and results[-1][1] != "[DONE]":
+                    results[-1] = (request_id, results[-1][1] + text)
+                else:
+                    results.append((request_id, text))
+            elif kind == RECORD_ERROR:
+                results.append((request_id, {"error": bytes(chunk).decode("utf-8", "replace")}))
+            elif kind == RECORD_DONE:
+                if decoder:
+                    tail = decoder.decode(b"", final=True)
+                    if tail:
+                        results.append((request_id, tail))
+                self._streams.pop(stream_id, None)
+                self._decoders.pop(stream_id, None)
+                results.append((request_id, "[DONE]"))
+            else:
+                raise ValueError(f"未知的记录种类: {kind}")
+        return results